@@ -1,29 +1,38 @@
 #! /usr/bin/env python3
 
-import argparse
+# Keep module-level imports cheap: this runs from cron, often with nothing
+# to post. Heavy modules are imported on the code paths that need them.
 import json
-import logging, logging.handlers
+import logging
 import os, os.path
 import socket
 import sys
 import time
 
 from s2f import util
-import s2f.s2f
 
 
-def setupLogging():
+def setupLogging(logFormat='text'):
     """
     Set up logging.
 
+    Records are written by a background thread (see s2f.logqueue), so
+    logging doesn't slow down the requests. logFormat is 'text', or 'json'
+    for one JSON object per line. Long messages are truncated.
+
     https://docs.python.org/3.4/howto/logging-cookbook.html
     """
+    import logging.handlers
+    from s2f import logqueue
     # Log UTC times
     logging.Formatter.converter = time.gmtime
-    # Show the timezone
-    formatter = logging.Formatter(
-            '%(asctime)s %(levelname)s:%(name)s:%(message)s',
-            "%Y-%m-%d %H:%M:%S %z (%Z)")
+    if logFormat == 'json':
+        formatter = logqueue.JsonLinesFormatter()
+    else:
+        # Show the timezone
+        formatter = logqueue.TruncatingFormatter(
+                '%(asctime)s %(levelname)s:%(name)s:%(message)s',
+                "%Y-%m-%d %H:%M:%S %z (%Z)")
 
     fileH = logging.handlers.RotatingFileHandler('s2f.log', encoding='utf-8',
             maxBytes=1024*1024*1, backupCount=5)
@@ -31,9 +40,8 @@ def setupLogging():
 
     rootL = logging.getLogger()
     rootL.setLevel(logging.INFO)
-    rootL.addHandler(fileH)
+    logqueue.setupQueueLogging(fileH)
 
-setupLogging()
 
 def getLogger():
     return logging.getLogger(__name__)
@@ -41,17 +49,34 @@ def getLogger():
 
 PORT = 19876
 cfgFiles = ('sforce-config.json', 'sforce-token.json', 'flowdock-config.json',
-        'limits.json', 'known-opportunities.json')
+        'limits.json', 'known-opportunities.sqlite')
 stateFileName = 'state.json'
+checkpointFileName = 'checkpoint.json'
+seenChatterFileName = 'seen-chatter.json'
+archiveFileName = 'history.sqlite'
 
 
 def parseArgs():
+    import argparse
     p = argparse.ArgumentParser(description='''Fetch new activity from
             SalesForce and post it to FlowDock.''')
     p.add_argument('config_dir', help='''A directory where this program can
             load configuration files from and where it can write a state file
             to. Configuration files: ''' + ', '.join(cfgFiles) + '''.
-            State file: ''' + stateFileName + '''.''')
+            State files: ''' + ', '.join((stateFileName, checkpointFileName,
+                seenChatterFileName, archiveFileName)) + '''.''')
+    p.add_argument('--log-format', choices=('text', 'json'), default='text',
+            help='''Format of the s2f.log file: text lines (the default) or
+            JSON lines.''')
+    p.add_argument('--receive', type=int, metavar='PORT', help='''Keep
+            running, receiving SalesForce Outbound Messages about changed
+            Opportunities on this HTTP port and posting them right away.
+            Then all activity is only polled every --reconcile-seconds.''')
+    p.add_argument('--organization-id', help='''With --receive, refuse
+            Outbound Messages from other SalesForce organizations.''')
+    p.add_argument('--reconcile-seconds', type=float, default=3600,
+            help='''With --receive, how often to poll (default:
+            %(default)s).''')
     return p.parse_args()
 
 
@@ -78,26 +103,121 @@ def singleinstance(port):
         return False
 
 
-if __name__ == '__main__':
-    args = parseArgs()
-    if not singleinstance(PORT):
-        getLogger().warn('Another instance is already running, exiting')
-        sys.exit(0)
-
-    sCfg, sTok, fCfg, lim, opp = map(
-            lambda p: os.path.join(args.config_dir, p), cfgFiles)
-    stateF = os.path.join(args.config_dir, stateFileName)
-
-    state = {}
+def loadState(stateF):
     try:
         with open(stateF, 'r', encoding='utf-8') as f:
-            state = json.load(f)
+            return json.load(f)
     except FileNotFoundError:
-        pass
-    updatesUrl = util.getNested(state, 'updatesUrl')
+        return {}
 
-    state['updatesUrl'] = s2f.s2f.postNewActivity(sCfg, sTok, fCfg, lim, opp,
-            util.getNested(state, 'updatesUrl'))
 
+def saveState(stateF, state):
     with open(stateF, 'w', encoding='utf-8') as f:
         json.dump(state, f)
+
+
+def postNewActivity(configDir):
+    """
+    Post the new activity once, see s2f.s2f.postNewActivity().
+    """
+    import s2f.s2f
+    sCfg, sTok, fCfg, lim, opp = map(
+            lambda p: os.path.join(configDir, p), cfgFiles)
+    stateF = os.path.join(configDir, stateFileName)
+    checkpointF = os.path.join(configDir, checkpointFileName)
+
+    state = loadState(stateF)
+    try:
+        state['updatesUrl'] = s2f.s2f.postNewActivity(sCfg, sTok, fCfg, lim,
+                opp, util.getNested(state, 'updatesUrl'), state=state,
+                checkpointFileName=checkpointF,
+                seenChatterFileName=os.path.join(configDir,
+                    seenChatterFileName),
+                watchedObjectsDir=configDir,
+                archiveFileName=os.path.join(configDir, archiveFileName))
+    finally:
+        # also if the run failed: the spooled and deferred messages are only
+        # in the state now, and the spooled ones posted are gone from it
+        saveState(stateF, state)
+    # only now that the state is saved, the next run starts afresh
+    s2f.checkpoint.Checkpoint(checkpointF).clear()
+
+
+def postNotifications(configDir, notifications):
+    """
+    Post the opportunity changes in Outbound Message notifications.
+
+    The messages spooled because their flow was failing are kept in the
+    state, like by postNewActivity(), and posted first the next time.
+    """
+    import s2f.s2f
+    sCfg, sTok, fCfg, lim, opp = map(
+            lambda p: os.path.join(configDir, p), cfgFiles)
+    stateF = os.path.join(configDir, stateFileName)
+    with open(lim, 'r', encoding='utf-8') as f:
+        limits = json.load(f)
+
+    state = loadState(stateF)
+    eventIndex = None
+    if limits.get('dedupTrackedChanges', True):
+        eventIndex = s2f.dedup.EventIndex(state.get('eventIndex', []),
+                maxSize=limits.get('eventIndexSize', 1000))
+    fClient = s2f.flowdock.FClient(fCfg)
+    s2f.s2f.postSpooledMessages(fClient, state, eventIndex=eventIndex)
+    try:
+        s2f.s2f.postOpportunityNotifications(s2f.sforce.SClient(sCfg, sTok),
+                fClient, limits, opp, notifications, eventIndex=eventIndex)
+    finally:
+        fClient.close()
+        # the store already has the new values: these won't be found again
+        s2f.s2f.saveSpooledMessages(fClient, limits, state)
+        if eventIndex is not None:
+            state['eventIndex'] = eventIndex.toJson()
+        saveState(stateF, state)
+
+
+def receive(configDir, port, organizationId, reconcileSeconds):
+    """
+    Post Outbound Message notifications as they arrive, and poll rarely.
+
+    Polling every reconcileSeconds catches anything the notifications miss
+    (and the chatter). Runs until interrupted.
+    """
+    from s2f import outbound
+    receiver = outbound.OutboundReceiver(port=port,
+            organizationId=organizationId)
+    receiver.start()
+    getLogger().info('Receiving Outbound Messages on port %d', receiver.port)
+    nextPoll = 0
+    try:
+        while True:
+            if time.monotonic() >= nextPoll:
+                try:
+                    postNewActivity(configDir)
+                except:
+                    getLogger().exception('While polling:')
+                nextPoll = time.monotonic() + reconcileSeconds
+            batch = receiver.getBatch(
+                    timeout=max(0, nextPoll - time.monotonic()), linger=2)
+            if batch:
+                try:
+                    postNotifications(configDir, batch)
+                except:
+                    getLogger().exception('While posting %d notifications:',
+                            len(batch))
+    finally:
+        receiver.stop()
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    setupLogging(args.log_format)
+    if not singleinstance(PORT):
+        getLogger().warn('Another instance is already running, exiting')
+        sys.exit(0)
+
+    if args.receive is not None:
+        receive(args.config_dir, args.receive, args.organization_id,
+                args.reconcile_seconds)
+    else:
+        postNewActivity(args.config_dir)
@@ -0,0 +1,127 @@
+"""
+Local archive of the changes and chatter we detected, to query later.
+"""
+
+import json
+import sqlite3
+import threading
+
+from s2f import util
+
+
+class HistoryArchive():
+    """
+    Events (changes and chatter items) in an SQLite file, kept forever.
+
+    Indexed by record (opportunity) Id, team and time, so the history of an
+    opportunity or of a time range is answered without any API calls. An
+    event with the key of one already archived (e.g. by a run which was
+    interrupted and resumed) isn't added again. May be used from several
+    threads.
+    """
+
+    def __init__(self, fileName):
+        self._conn = sqlite3.connect(fileName, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS events (' +
+                    'id INTEGER PRIMARY KEY, ' +
+                    'recordId TEXT NOT NULL, sobject TEXT NOT NULL, ' +
+                    'team TEXT, ts REAL NOT NULL, kind TEXT NOT NULL, ' +
+                    'actor TEXT, data TEXT NOT NULL, eventKey TEXT)')
+            columns = [row[1] for row in
+                    self._conn.execute('PRAGMA table_info(events)')]
+            if 'eventKey' not in columns:
+                # archived before events had keys
+                self._conn.execute('ALTER TABLE events ADD COLUMN ' +
+                        'eventKey TEXT')
+            for cols in ('recordId, ts', 'team, ts', 'ts'):
+                self._conn.execute('CREATE INDEX IF NOT EXISTS events_' +
+                        cols.replace(', ', '_') + ' ON events (' + cols + ')')
+            self._conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS ' +
+                    'events_eventKey ON events (eventKey)')
+            self._conn.commit()
+
+
+    def add(self, recordId, sobject, team, ts, kind, actor, data, key=None):
+        """
+        Add an event. ts is a Unix timestamp, data any JSON value.
+
+        key identifies the event: if one with the same key is already
+        archived, nothing is added. Events without a key are always added.
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR IGNORE INTO events ' +
+                    '(recordId, sobject, team, ts, kind, actor, data, ' +
+                    'eventKey) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (recordId,
+                        sobject, team, ts, kind, actor, json.dumps(data),
+                        key))
+
+
+    def addOpportunityChange(self, kind, oldOp, op, sobject='Opportunity'):
+        """
+        Add a new or changed opportunity, see
+        SClient.iterOpportunityChanges().
+
+        Also used for the other watched SObjects.
+        """
+        if kind == 'new':
+            ts, actor = op['CreatedDate'], op['CreatedByName']
+        else:
+            ts, actor = op['LastModifiedDate'], op['LastModifiedByName']
+        self.add(op['Id'], sobject, op.get('FutuTeam'),
+                util.parseTimestamp(ts), kind, actor,
+                {'old': oldOp, 'new': op},
+                key='|'.join((sobject, op['Id'], kind, ts)))
+
+
+    def addChatterDetail(self, detail):
+        """
+        Add a chatter item (see SClient.getOpportunitiesChatterDetails()).
+        """
+        self.add(detail.get('opportunity_id') or '', 'Opportunity',
+                detail['futu_team'], detail['modified_ts'], 'chatter',
+                detail['actor_name'], detail, key='chatter|{}|{}'.format(
+                    detail['id'], detail['modified_ts']))
+
+
+    def query(self, recordId=None, team=None, since=None, until=None,
+            kind=None, limit=None):
+        """
+        Return the matching events, oldest first.
+
+        since and until are Unix timestamps (since inclusive, until not).
+        Each event is a dict with the fields given to add().
+        """
+        where, params = [], []
+        for col, op, value in (('recordId', '=', recordId),
+                ('team', '=', team), ('ts', '>=', since), ('ts', '<', until),
+                ('kind', '=', kind)):
+            if value is not None:
+                where.append(col + ' ' + op + ' ?')
+                params.append(value)
+        q = 'SELECT recordId, sobject, team, ts, kind, actor, data FROM events'
+        if where:
+            q += ' WHERE ' + ' AND '.join(where)
+        q += ' ORDER BY ts, id'
+        if limit is not None:
+            q += ' LIMIT ?'
+            params.append(int(limit))
+        with self._lock:
+            rows = self._conn.execute(q, params).fetchall()
+        keys = ('recordId', 'sobject', 'team', 'ts', 'kind', 'actor', 'data')
+        result = [dict(zip(keys, row)) for row in rows]
+        for event in result:
+            event['data'] = json.loads(event['data'])
+        return result
+
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,121 @@
+"""
+Run checkpoints, so a run which stopped half way can be resumed.
+"""
+
+import json
+import os
+import threading
+
+
+def _readLines(fileName):
+    """
+    Yield the JSON values of a file written by _appendLine(), if it exists.
+    """
+    try:
+        with open(fileName, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # cut short by a crash while appending
+                    pass
+    except FileNotFoundError:
+        pass
+
+
+def _appendLine(fileName, value):
+    with open(fileName, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(value) + '\n')
+
+
+class Checkpoint():
+    """
+    Progress of a run, saved to a JSON file after every change.
+
+    Holds arbitrary JSON values by key, the list of messages queued (see
+    s2f.lanes.PostingQueue) and the set of keys of items already posted.
+    The queued messages and the posted keys are appended to separate files
+    (fileName with a .queued and a .posted suffix), so adding one costs the
+    same however many there are.
+    The owner of the run clears it once the run's results are saved.
+    It may be used from several threads.
+    """
+
+    def __init__(self, fileName):
+        self._fileName = fileName
+        self._postedFileName = fileName + '.posted'
+        self._queuedFileName = fileName + '.queued'
+        try:
+            with open(fileName, 'r', encoding='utf-8') as f:
+                self._data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._data = {}
+        self._posted = set(_readLines(self._postedFileName))
+        self._queued = list(_readLines(self._queuedFileName))
+        self._lock = threading.Lock()
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+
+    def set(self, key, value):
+        self.update({key: value})
+
+
+    def update(self, values):
+        """
+        Set several keys at once, saving the file once.
+        """
+        with self._lock:
+            self._data.update(values)
+            self._save()
+
+
+    def getQueued(self):
+        """
+        Return the values passed to addQueued(), in order.
+        """
+        with self._lock:
+            return list(self._queued)
+
+
+    def addQueued(self, value):
+        with self._lock:
+            self._queued.append(value)
+            _appendLine(self._queuedFileName, value)
+
+
+    def isPosted(self, key):
+        with self._lock:
+            return key in self._posted
+
+
+    def markPosted(self, key):
+        with self._lock:
+            if key in self._posted:
+                return
+            self._posted.add(key)
+            _appendLine(self._postedFileName, key)
+
+
+    def clear(self):
+        self._data = {}
+        self._posted = set()
+        self._queued = []
+        for fileName in (self._fileName, self._postedFileName,
+                self._queuedFileName):
+            try:
+                os.remove(fileName)
+            except FileNotFoundError:
+                pass
+
+
+    def _save(self):
+        # write to a temporary file first so a crash never leaves a
+        # truncated checkpoint behind
+        tmpFileName = self._fileName + '.tmp'
+        with open(tmpFileName, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f)
+        os.replace(tmpFileName, self._fileName)
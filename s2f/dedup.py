@@ -0,0 +1,150 @@
+"""
+Bounded, persistable indexes used to avoid posting the same event twice.
+"""
+
+from collections import OrderedDict
+import json
+import os
+
+from s2f import util
+
+
+class BoundedIndex():
+    """
+    A set of string keys which keeps only the maxSize most recently added.
+
+    It is stored as a JSON list (oldest first) e.g. in the state file.
+    """
+
+    def __init__(self, keys=(), maxSize=1000):
+        if maxSize < 1:
+            raise ValueError('maxSize must be ≥ 1')
+        self._maxSize = maxSize
+        self._keys = OrderedDict()
+        for k in keys:
+            self.add(k)
+
+    def add(self, key):
+        self._keys.pop(key, None)
+        self._keys[key] = True
+        while len(self._keys) > self._maxSize:
+            self._keys.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def toJson(self):
+        return list(self._keys)
+
+    @classmethod
+    def fromFile(cls, fileName, maxSize=1000):
+        """
+        Load an index saved with saveFile(), or return an empty one.
+        """
+        try:
+            with open(fileName, 'r', encoding='utf-8') as f:
+                keys = json.load(f)
+        except (FileNotFoundError, ValueError):
+            keys = []
+        return cls(keys, maxSize=maxSize)
+
+    def saveFile(self, fileName):
+        tmpFileName = fileName + '.tmp'
+        with open(tmpFileName, 'w', encoding='utf-8') as f:
+            json.dump(self.toJson(), f)
+        os.replace(tmpFileName, fileName)
+
+
+class EventIndex(BoundedIndex):
+    """
+    Index of opportunity modifications by (opportunity id, time, actor).
+
+    An opportunity change and the chatter ‘TrackedChange’ item for the same
+    edit don't always have the exact same timestamp, so lookups accept a
+    difference of up to tolerance seconds. Only changes actually posted are
+    added, so a failed or spooled one doesn't suppress its chatter item.
+    """
+
+    @staticmethod
+    def _key(opId, ts, actorName):
+        return '{}|{}|{}'.format(opId, int(ts), actorName)
+
+    def addEvent(self, opId, ts, actorName):
+        self.add(type(self)._key(opId, ts, actorName))
+
+    def hasEvent(self, opId, ts, actorName, tolerance=5):
+        ts = int(ts)
+        for t in range(ts - tolerance, ts + tolerance + 1):
+            if type(self)._key(opId, t, actorName) in self:
+                return True
+        return False
+
+    def addOpportunityChange(self, op):
+        """
+        Add the latest modification of an opportunity from getOpportunities().
+        """
+        self.addEvent(op['Id'], util.parseTimestamp(op['LastModifiedDate']),
+                op['LastModifiedByName'])
+
+    def addPostedEvent(self, event):
+        """
+        Add the ‘event’ of a message posted to Team Inbox, if it's an
+        opportunity change (see s2f.s2f.fmtOpChangeForTeamInbox()).
+        """
+        if (event and event.get('sobject') == 'Opportunity' and
+                event.get('type') in ('new', 'changed') and
+                event.get('record')):
+            self.addOpportunityChange(event['record'])
+
+    def hasChatterEvent(self, event):
+        """
+        Return True if the ‘event’ of a chatter message is a tracked change
+        whose opportunity change is in this index.
+        """
+        if (not event or event.get('type') != 'chatter' or
+                event.get('itemType') != 'TrackedChange'):
+            return False
+        return self.hasEvent(event.get('opportunityId'),
+                event.get('modifiedTs', 0), event.get('actorName'))
+
+    def hasChatterChange(self, item):
+        """
+        Return True if item is a tracked-change chatter item for an event
+        in this index.
+        """
+        ns = util.getNested
+        if ns(item, 'type') != 'TrackedChange':
+            return False
+        modified = ns(item, 'modifiedDate')
+        if not modified:
+            return False
+        return self.hasEvent(ns(item, 'parent.id'),
+                util.parseTimestamp(modified), ns(item, 'actor.name'))
+
+
+class SeenItems(BoundedIndex):
+    """
+    Index of the chatter items already posted, by id and modified time.
+
+    An item modified since it was posted (e.g. edited) isn't in the index.
+    """
+
+    def hasItem(self, item):
+        """
+        Return True if item (from the chatter API) is in the index.
+        """
+        ns = util.getNested
+        modified = ns(item, 'modifiedDate')
+        if not modified:
+            return False
+        return '{}|{}'.format(ns(item, 'id'),
+                int(util.parseTimestamp(modified))) in self
+
+    def addDetail(self, detail):
+        """
+        Add an item from SClient.getOpportunitiesChatterDetails().
+        """
+        self.add('{}|{}'.format(detail['id'], detail['modified_ts']))
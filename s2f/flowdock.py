@@ -1,7 +1,8 @@
 import html
 import json
 import logging
-import urllib.request
+import threading
+import time
 import urllib.parse
 
 from s2f import util
@@ -23,6 +24,8 @@ def chat(flowApiToken, externalUserName, content, tags=[]):
 
     The API call may throw exceptions.
     """
+    import urllib.request
+
     url = ('https://api.flowdock.com/v1/messages/chat/' +
             urllib.parse.quote(flowApiToken))
     data = json.dumps({
@@ -34,23 +37,25 @@ def chat(flowApiToken, externalUserName, content, tags=[]):
         'Content-Type': 'application/json; charset=UTF-8',
     }
     req = urllib.request.Request(url, data, headers)
-    getLogger().info('Posting chat message: ' + content)
+    getLogger().info('Posting chat message: %s', content)
     urllib.request.urlopen(req)
 
 
-def postToInbox(flowApiToken, source, from_address, subject, textContent,
+INBOX_HOST = 'api.flowdock.com'
+INBOX_PATH = '/v1/messages/team_inbox/'
+# the most flows a message is posted to at the same time
+MAX_FAN_OUT_THREADS = 8
+
+
+def renderInboxMessage(source, from_address, subject, textContent,
         from_name=None, project=None, tags=[], link=None):
     """
-    Post a message to a flow's Team Inbox, escaping textContent to valid HTML.
+    Return the JSON request body (bytes) for a Team Inbox message.
 
-    https://www.flowdock.com/api/team-inbox
-    textContent is escaped to valid HTML and newlines are replaced with <br>.
-    The API call may throw exceptions.
+    The body doesn't depend on the flow, so it can be posted to several.
+    See postToInbox() for the arguments.
     """
     htmlContent = html.escape(textContent).replace('\n', '<br>')
-    url = ('https://api.flowdock.com/v1/messages/team_inbox/' +
-            urllib.parse.quote(flowApiToken))
-
     data = {
         # required fields
         'source': source,
@@ -67,14 +72,205 @@ def postToInbox(flowApiToken, source, from_address, subject, textContent,
         data['project'] = project
     if link:
         data['link'] = link
-    data = json.dumps(data).encode('utf-8')
+    getLogger().info('Posting message to Team Inbox: %s', util.LazyJson(data))
+    return json.dumps(data).encode('utf-8')
+
+
+def postToInbox(flowApiToken, source, from_address, subject, textContent,
+        from_name=None, project=None, tags=[], link=None, timeout=None):
+    """
+    Post a message to a flow's Team Inbox, escaping textContent to valid HTML.
+
+    https://www.flowdock.com/api/team-inbox
+    textContent is escaped to valid HTML and newlines are replaced with <br>.
+    timeout is in seconds, by default the global socket timeout.
+    The API call may throw exceptions.
+    """
+    import urllib.request
+
+    url = ('https://' + INBOX_HOST + INBOX_PATH +
+            urllib.parse.quote(flowApiToken))
+    data = renderInboxMessage(source, from_address, subject, textContent,
+            from_name, project, tags, link)
 
     headers = {
         'Content-Type': 'application/json; charset=UTF-8',
     }
     req = urllib.request.Request(url, data, headers)
-    getLogger().info('Posting message to Team Inbox: ' + data.decode('utf-8'))
-    urllib.request.urlopen(req)
+    if timeout is None:
+        urllib.request.urlopen(req)
+    else:
+        urllib.request.urlopen(req, timeout=timeout)
+
+
+class InboxConnectionPool():
+    """
+    Keep-alive HTTPS connections to the Team Inbox API, for any thread.
+
+    Each post takes an idle connection (or opens one) and returns it after
+    reading the response, so concurrent posts each have their own and
+    consecutive ones skip the TCP and TLS handshakes. Connections go through
+    the HTTPS proxy from the environment (see urllib.request.getproxies()),
+    like urlopen().
+    """
+
+    def __init__(self, timeout=None):
+        self._timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        import base64
+        import http.client
+        import urllib.request
+
+        proxy = None
+        if not urllib.request.proxy_bypass(INBOX_HOST):
+            proxy = urllib.request.getproxies().get('https')
+        if not proxy:
+            return http.client.HTTPSConnection(INBOX_HOST,
+                    timeout=self._timeout)
+
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urllib.parse.urlsplit(proxy)
+        headers = {}
+        if parts.username is not None:
+            credentials = (urllib.parse.unquote(parts.username) + ':' +
+                    urllib.parse.unquote(parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+                    credentials.encode('utf-8')).decode('ascii')
+        conn = http.client.HTTPSConnection(parts.hostname, parts.port,
+                timeout=self._timeout)
+        conn.set_tunnel(INBOX_HOST, headers=headers)
+        return conn
+
+    def _request(self, conn, path, body):
+        conn.request('POST', path, body, {
+            'Content-Type': 'application/json; charset=UTF-8',
+        })
+        return conn.getresponse()
+
+    def post(self, flowApiToken, body):
+        """
+        Post the body from renderInboxMessage() to the flow.
+
+        If an idle connection fails before any response (the server closed
+        it meanwhile), the post is retried once on a new connection.
+        Raises urllib.error.HTTPError for an error response, like urlopen().
+        """
+        import http.client
+        import urllib.error
+
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        reused = conn is not None
+        if not reused:
+            conn = self._connect()
+        path = INBOX_PATH + urllib.parse.quote(flowApiToken)
+        try:
+            try:
+                resp = self._request(conn, path, body)
+            except (http.client.BadStatusLine, ConnectionError):
+                # RemoteDisconnected is both, on Python 3.5+
+                if not reused:
+                    raise
+                conn.close()
+                conn = self._connect()
+                resp = self._request(conn, path, body)
+            content = resp.read()
+        except:
+            conn.close()
+            raise
+        if resp.status >= 400:
+            conn.close()
+            raise urllib.error.HTTPError('https://' + INBOX_HOST + path,
+                    resp.status, resp.reason, resp.headers, None)
+        with self._lock:
+            self._idle.append(conn)
+        return content
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class CircuitBreaker():
+    """
+    Stops calling a failing service for a while, then probes it.
+
+    Closed: calls are allowed. After failureThreshold consecutive failures
+    it opens: calls are refused for resetSeconds. Then it's half-open: one
+    call is allowed as a probe; its success closes the breaker, its failure
+    opens it again. Thread-safe.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failureThreshold=3, resetSeconds=60,
+            clock=time.monotonic):
+        self._failureThreshold = failureThreshold
+        self._resetSeconds = resetSeconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = type(self).CLOSED
+        self._failures = 0
+        self._openedAt = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if (self._state == type(self).OPEN and
+                    self._clock() - self._openedAt >= self._resetSeconds):
+                return type(self).HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """
+        Return True if a call may be made now.
+        """
+        with self._lock:
+            cls = type(self)
+            if self._state == cls.CLOSED:
+                return True
+            if (self._state == cls.OPEN and
+                    self._clock() - self._openedAt >= self._resetSeconds):
+                self._state = cls.HALF_OPEN
+                self._probing = False
+            if self._state == cls.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def recordSuccess(self):
+        with self._lock:
+            self._state = type(self).CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def recordFailure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._state == type(self).HALF_OPEN or
+                    self._failures >= self._failureThreshold):
+                self._state = type(self).OPEN
+                self._openedAt = self._clock()
+                self._probing = False
+
+
+def _isFlowFailure(exc):
+    """
+    Return True if exc says the flow (not just this message) has a problem.
+
+    A 400 Bad Request is about the message, anything else (invalid token,
+    server errors, timeouts, connection errors) about the flow.
+    """
+    return getattr(exc, 'code', None) != 400
 
 
 class FClient():
@@ -85,6 +281,14 @@ class FClient():
     a mapping from the Futu_Team name to the secret API Token for a Flowdock
     channel. You can define an optional default flow for messages with an
     unknown team name.
+
+    Each flow has a CircuitBreaker. When a flow keeps failing, messages to it
+    are spooled instead of posted (see spooled) until a probe succeeds.
+    Configured with the optional ‘timeout’ (seconds, default 10) and
+    ‘circuitBreaker’ (‘failureThreshold’, ‘resetSeconds’) fields.
+
+    Messages are also posted to the flows of the matching ‘fanOut’ rules.
+    Those flows are looked up in the optional ‘flows’ field, then in ‘teams’.
     """
 
     def __init__(self, cfgFileName):
@@ -95,6 +299,48 @@ class FClient():
 
         self.teamInbox = data['teamInbox']
 
+        self.timeout = data.get('timeout', 10)
+        self._breakerCfg = data.get('circuitBreaker', {})
+        self._breakers = {}
+        self._lock = threading.Lock()
+        # postToInbox(…) keyword arguments for the messages not sent because
+        # their flow's circuit breaker was open.
+        self.spooled = []
+
+        self.flows = data.get('flows', {})
+        self.fanOut = data.get('fanOut', [])
+        self._pool = InboxConnectionPool(timeout=self.timeout)
+        # posts to the fan-out flows, created when first needed
+        self._executor = None
+
+
+    def close(self):
+        """
+        Stop the fan-out threads and close the idle connections.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+        self._pool.close()
+
+
+    def _getBreaker(self, flowName):
+        with self._lock:
+            if flowName not in self._breakers:
+                self._breakers[flowName] = CircuitBreaker(
+                        **self._breakerCfg)
+            return self._breakers[flowName]
+
+
+    def getBreakerStates(self):
+        """
+        Return {flow name: circuit breaker state} for the flows used so far.
+        """
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {k:v.state for k, v in breakers.items()}
+
 
     def getTeamTzName(self, teamName):
         if teamName in self.teams:
@@ -109,25 +355,146 @@ class FClient():
             return 'UTC'
 
 
-    def postToInbox(self, teamName, subject, textContent, project=None,
-            link=None):
+    def _getFlowToken(self, flowName):
+        if flowName in self.flows:
+            return self.flows[flowName]['apiToken']
+        if flowName in self.teams:
+            return self.teams[flowName]['apiToken']
+        getLogger().warn('Unknown fan-out flow: %s', flowName)
+        return None
+
+
+    def getDestinations(self, teamName, event=None):
         """
-        Posts to the Team Inbox.
+        Return [(flowName, apiToken)] to post a message for teamName to.
 
-        May throw exceptions.
+        The first is the team's flow (flowName None for the default flow),
+        followed by the flows of the matching ‘fanOut’ rules.
         """
+        result = []
         if teamName in self.teams:
-            apiToken = self.teams[teamName]['apiToken']
+            result.append((teamName, self.teams[teamName]['apiToken']))
         elif self.defaultTeam:
-            getLogger().warn('Unknown Team: ' + teamName +
+            getLogger().warn('Unknown Team: ' + str(teamName) +
                     ', posting to default flow')
-            apiToken = self.defaultTeam['apiToken']
+            result.append((None, self.defaultTeam['apiToken']))
         else:
-            getLogger().warn('Unknown Team: ' + teamName + ' and no default ' +
-                    'flow configured')
-            return
+            getLogger().warn('Unknown Team: ' + str(teamName) +
+                    ' and no default flow configured')
+
+        tokens = {t for n, t in result}
+        for rule in self.fanOut:
+            if not util.eventMatches(rule, teamName, event):
+                continue
+            for flowName in rule['flows']:
+                apiToken = self._getFlowToken(flowName)
+                if apiToken and apiToken not in tokens:
+                    tokens.add(apiToken)
+                    result.append((flowName, apiToken))
+        return result
+
+
+    def _postToFlow(self, flowName, apiToken, body, message):
+        """
+        Post the rendered body to one flow, through its circuit breaker.
+
+        Return True if posted, False if spooled.
+        """
+        breaker = self._getBreaker(flowName)
+        if not breaker.allow():
+            getLogger().warn('Flow %s is failing, spooling message: %s',
+                    flowName, message['subject'])
+            self._spool(flowName, message)
+            return False
 
-        postToInbox(apiToken, self.teamInbox['source'],
+        try:
+            self._pool.post(apiToken, body)
+        except Exception as e:
+            if _isFlowFailure(e):
+                breaker.recordFailure()
+            else:
+                breaker.recordSuccess()
+            raise
+        breaker.recordSuccess()
+        return True
+
+
+    def _spool(self, flowName, message):
+        with self._lock:
+            self.spooled.append(dict(message, flowName=flowName,
+                fanOut=False))
+
+
+    def _postToFanOutFlow(self, flowName, apiToken, body, message):
+        """
+        Like _postToFlow(), but spools the message for the flow if it fails
+        instead of raising.
+        """
+        try:
+            return self._postToFlow(flowName, apiToken, body, message)
+        except Exception as e:
+            getLogger().error('While posting to flow %s «%s»:', flowName,
+                    message['subject'], exc_info=True)
+            # a bad request would fail again
+            if _isFlowFailure(e):
+                self._spool(flowName, message)
+            return False
+
+
+    def postToInbox(self, teamName, subject, textContent, project=None,
+            link=None, event=None, flowName=None, fanOut=True):
+        """
+        Posts to the Team Inbox of the team's flow and the fan-out flows.
+
+        event describes what the message is about, for the ‘fanOut’ rules
+        (see README). The message is rendered once and posted to all the
+        flows concurrently. If flowName is given, the message is only posted
+        to that flow; if fanOut is False, only to the team's flow (e.g. when
+        it was spooled for that flow).
+
+        If a flow's circuit breaker is open, the message is added to
+        self.spooled for that flow instead. When posting to several flows,
+        a flow failing is logged and the message is spooled for it too, the
+        other flows still get it; with a single flow, the exception is
+        raised. Returns True if the message was posted to all its flows,
+        False if it was spooled or failed for some, or there were none.
+        """
+        if flowName is not None:
+            apiToken = self._getFlowToken(flowName)
+            destinations = [(flowName, apiToken)] if apiToken else []
+        else:
+            destinations = self.getDestinations(teamName, event)
+            if not fanOut:
+                destinations = destinations[:1]
+        if not destinations:
+            return False
+
+        body = renderInboxMessage(self.teamInbox['source'],
                 self.teamInbox['from_address'], subject, textContent,
                 self.teamInbox['from_name'], project, self.teamInbox['tags'],
                 link)
+        message = {
+            'teamName': teamName,
+            'subject': subject,
+            'textContent': textContent,
+            'project': project,
+            'link': link,
+            'event': event,
+        }
+        if len(destinations) == 1:
+            name, token = destinations[0]
+            return self._postToFlow(name, token, body, message)
+
+        executor = self._getExecutor()
+        futures = [executor.submit(self._postToFanOutFlow, name, token, body,
+            message) for name, token in destinations]
+        return all([f.result() for f in futures])
+
+
+    def _getExecutor(self):
+        import concurrent.futures
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=MAX_FAN_OUT_THREADS)
+            return self._executor
@@ -0,0 +1,168 @@
+"""
+Posting messages in priority order, within a time budget.
+"""
+
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+
+from s2f import util
+
+
+def getLogger():
+    return logging.getLogger(__name__)
+
+
+# Used when the ‘priorityRules’ limit isn't set. The first matching rule
+# (see util.eventMatches()) gives a message its priority, lower is sooner.
+DEFAULT_PRIORITY_RULES = [
+    {'types': ['new'], 'sobjects': ['Opportunity'], 'priority': 0},
+    {'changedFields': ['IsWon', 'StageName'], 'priority': 0},
+    {'types': ['chatter'], 'priority': 2},
+]
+DEFAULT_PRIORITY = 1
+
+
+def getPriority(message, rules):
+    """
+    Return the priority of a message (FClient.postToInbox() arguments).
+    """
+    for rule in rules:
+        if util.eventMatches(rule, message.get('teamName'),
+                message.get('event')):
+            return rule['priority']
+    return DEFAULT_PRIORITY
+
+
+class PostingQueue():
+    """
+    Messages waiting to be posted, by priority then in the order added.
+
+    Each message has a key. A key already in the queue, or marked as posted
+    in the checkpoint (an s2f.checkpoint.Checkpoint), isn't added again.
+    Messages added are appended to the checkpoint's queued messages (see
+    toJson()), and their keys are marked as posted once posted, so an
+    interrupted run can resume(). Messages may be added from several threads.
+    """
+
+    def __init__(self, rules=None, checkpoint=None):
+        self._rules = DEFAULT_PRIORITY_RULES if rules is None else rules
+        self._checkpoint = checkpoint
+        self._heap = []
+        self._keys = set()
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+
+    def add(self, key, message, priority=None, onDone=None):
+        """
+        Queue a message, return False if its key is already known.
+
+        onDone() is called once the message has been posted, not if posting
+        failed or it was spooled or deferred (see drain()).
+        """
+        if priority is None:
+            priority = getPriority(message, self._rules)
+        with self._lock:
+            added = self._push(key, message, priority, onDone)
+            if added:
+                self._save(key, message, priority)
+        return added
+
+
+    def addAll(self, entries):
+        """
+        Queue the entries from toJson(), e.g. deferred by an earlier run.
+        """
+        with self._lock:
+            for e in entries:
+                if self._push(e['key'], e['message'], e['priority']):
+                    self._save(e['key'], e['message'], e['priority'])
+
+
+    def resume(self):
+        """
+        Queue the messages an interrupted run had queued in the checkpoint,
+        except those already posted.
+        """
+        if self._checkpoint is None:
+            return
+        with self._lock:
+            for e in self._checkpoint.getQueued():
+                self._push(e['key'], e['message'], e['priority'])
+
+
+    def _push(self, key, message, priority, onDone=None):
+        if key in self._keys:
+            return False
+        if self._checkpoint is not None and self._checkpoint.isPosted(key):
+            return False
+        self._keys.add(key)
+        heapq.heappush(self._heap, (priority, next(self._order), key,
+            message, onDone))
+        return True
+
+
+    def _save(self, key, message, priority):
+        if self._checkpoint is not None:
+            self._checkpoint.addQueued({'key': key, 'priority': priority,
+                'message': message})
+
+
+    def toJson(self):
+        """
+        Return the queued messages, in order, as a JSON-serializable list.
+        """
+        with self._lock:
+            return self._toJson()
+
+
+    def _toJson(self):
+        return [{'key': key, 'priority': priority, 'message': message}
+                for priority, order, key, message, onDone in
+                sorted(self._heap)]
+
+
+    def drain(self, post, deadline=None, clock=time.monotonic):
+        """
+        Call post(message) for the queued messages in order, until deadline.
+
+        post() returns True if the message was posted; only then its onDone
+        is called. Errors are logged and the next message is posted. Once
+        clock() reaches deadline, the remaining messages are removed from the
+        queue and returned (see toJson()) to be posted later.
+        """
+        while True:
+            with self._lock:
+                if not self._heap or (deadline is not None and
+                        clock() >= deadline):
+                    break
+                priority, order, key, message, onDone = heapq.heappop(
+                        self._heap)
+            posted = False
+            try:
+                posted = post(message)
+            except:
+                getLogger().error('While posting «%s»:',
+                        util.LazyJson(message), exc_info=sys.exc_info())
+            if self._checkpoint is not None:
+                self._checkpoint.markPosted(key)
+            if posted and onDone is not None:
+                onDone()
+
+        with self._lock:
+            remaining, self._heap = sorted(self._heap), []
+        deferred = [{'key': key, 'priority': priority, 'message': message}
+                for priority, order, key, message, onDone in remaining]
+        if deferred:
+            getLogger().warn('Out of time, deferring %d messages',
+                    len(deferred))
+        return deferred
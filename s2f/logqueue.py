@@ -0,0 +1,102 @@
+"""
+Non-blocking logging: records go through a queue to a background thread,
+which formats (truncating long messages) and writes them.
+
+https://docs.python.org/3.4/howto/logging-cookbook.html#dealing-with-handlers-that-block
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+from s2f.util import MAX_MESSAGE_LENGTH, truncate
+
+
+class TruncatingFormatter(logging.Formatter):
+    """
+    Formatter which truncates the message, but not the traceback.
+    """
+
+    def __init__(self, *args, maxLength=MAX_MESSAGE_LENGTH, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._maxLength = maxLength
+
+    def formatMessage(self, record):
+        record.message = truncate(record.message, self._maxLength)
+        return super().formatMessage(record)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats each record as a JSON object on one line.
+    """
+
+    def __init__(self, maxLength=MAX_MESSAGE_LENGTH):
+        super().__init__()
+        self._maxLength = maxLength
+
+    def format(self, record):
+        data = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S',
+                time.gmtime(record.created)) +
+                '.{:03d}Z'.format(int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': truncate(record.getMessage(), self._maxLength),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which leaves all formatting to the listener's thread.
+
+    The stock QueueHandler formats the message in the logging thread. Here
+    the record is queued as is, so log arguments must not be modified after
+    the logging call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class QueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener which may be stopped more than once, e.g. at exit.
+
+    Each handler only gets the records at or above its level (Python 3.4
+    has no respect_handler_level).
+    """
+
+    def handle(self, record):
+        record = self.prepare(record)
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def setupQueueLogging(*handlers):
+    """
+    Route all logging through a queue to handlers, in a background thread.
+
+    Replaces the root logger's handlers. The queue is flushed at exit.
+    Returns the QueueListener.
+    """
+    q = queue.Queue()
+    listener = QueueListener(q, *handlers)
+    rootL = logging.getLogger()
+    for h in list(rootL.handlers):
+        rootL.removeHandler(h)
+    rootL.addHandler(DeferredQueueHandler(q))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
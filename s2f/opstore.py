@@ -0,0 +1,110 @@
+"""
+Persistent store of the opportunities we know, to detect changes.
+"""
+
+import json
+import sqlite3
+
+from s2f import util
+
+
+class OpportunityStore():
+    """
+    Known opportunities keyed by Id, in an SQLite file.
+
+    Opportunities are read and written one at a time, so memory use doesn't
+    grow with their number. Writes are only committed by commit() and
+    close(), so the caller decides when, e.g. once the events of a page of
+    opportunities have been queued.
+    """
+
+    def __init__(self, fileName):
+        self._conn = sqlite3.connect(fileName)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS opportunities (' +
+                'id TEXT PRIMARY KEY, modified REAL NOT NULL, ' +
+                'data TEXT NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ' +
+                'opportunities_modified ON opportunities (modified)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (' +
+                'key TEXT PRIMARY KEY, value TEXT)')
+
+
+    def get(self, opId):
+        """
+        Return the opportunity with this Id, or None.
+        """
+        row = self._conn.execute('SELECT data FROM opportunities WHERE id = ?',
+                (opId,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+    def put(self, op):
+        """
+        Insert or replace an opportunity (from SClient.getOpportunities()).
+        """
+        self._conn.execute('INSERT OR REPLACE INTO opportunities ' +
+                '(id, modified, data) VALUES (?, ?, ?)', (op['Id'],
+                    util.parseTimestamp(op['LastModifiedDate']),
+                    json.dumps(op)))
+
+
+    def isEmpty(self):
+        return self._conn.execute(
+                'SELECT 1 FROM opportunities LIMIT 1').fetchone() is None
+
+
+    def latestModified(self):
+        """
+        Return the newest LastModifiedDate in the store, or None.
+        """
+        row = self._conn.execute('SELECT data FROM opportunities ' +
+                'ORDER BY modified DESC LIMIT 1').fetchone()
+        return json.loads(row[0])['LastModifiedDate'] if row else None
+
+
+    def idsModifiedAt(self, modified):
+        """
+        Return the Ids of the opportunities with LastModifiedDate = modified.
+        """
+        return [row[0] for row in self._conn.execute('SELECT id FROM ' +
+                'opportunities WHERE modified = ?',
+                (util.parseTimestamp(modified),))]
+
+
+    def getMeta(self, key, default=None):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?',
+                (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+
+    def setMeta(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, value) ' +
+                'VALUES (?, ?)', (key, json.dumps(value)))
+
+
+    def importJsonFile(self, fileName):
+        """
+        Import the opportunities from a JSON list, the old store format.
+        """
+        with open(fileName, 'r', encoding='utf-8') as f:
+            ops = json.load(f)
+        for op in ops:
+            self.put(op)
+        self.setMeta('watermark', self.latestModified())
+        self.commit()
+
+
+    def commit(self):
+        self._conn.commit()
+
+
+    def rollback(self):
+        """
+        Undo the writes since the last commit.
+        """
+        self._conn.rollback()
+
+
+    def close(self):
+        self.commit()
+        self._conn.close()
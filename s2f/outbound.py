@@ -0,0 +1,190 @@
+"""
+Receive SalesForce Outbound Messages (workflow SOAP notifications).
+
+https://developer.salesforce.com/docs/atlas.en-us.api.meta/api/sforce_api_om_outboundmessaging.htm
+Notifications are acknowledged as soon as they're parsed and queued, then
+processed in batches by the caller (see s2f.s2f.postOpportunityNotifications).
+"""
+
+import logging
+import queue
+import threading
+import time
+
+
+def getLogger():
+    return logging.getLogger(__name__)
+
+
+OUTBOUND_NS = 'http://soap.sforce.com/2005/09/outbound'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+ACK_RESPONSE = ('<?xml version="1.0" encoding="UTF-8"?>' +
+        '<soapenv:Envelope ' +
+        'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">' +
+        '<soapenv:Body><notificationsResponse xmlns="' + OUTBOUND_NS + '">' +
+        '<Ack>true</Ack></notificationsResponse></soapenv:Body>' +
+        '</soapenv:Envelope>').encode('utf-8')
+
+
+def parseOutboundMessage(body):
+    """
+    Parse an Outbound Message (bytes) into a dict.
+
+    {'organizationId': …, 'notifications': [{'id': notification Id,
+    'sobject': e.g. 'Opportunity', 'fields': {API name: text}}]}.
+    Fields SalesForce sent as nil are None. Raises ValueError if body isn't
+    an Outbound Message.
+    """
+    import xml.etree.ElementTree as ET
+
+    try:
+        root = ET.fromstring(body)
+    except ET.ParseError as e:
+        raise ValueError('Invalid XML: ' + str(e))
+    msg = root.find('.//{' + OUTBOUND_NS + '}notifications')
+    if msg is None:
+        raise ValueError('Not an Outbound Message')
+
+    def localName(tag):
+        return tag.rsplit('}', 1)[-1]
+
+    notifications = []
+    for n in msg.iterfind('{' + OUTBOUND_NS + '}Notification'):
+        sObject = n.find('{' + OUTBOUND_NS + '}sObject')
+        if sObject is None:
+            raise ValueError('Notification without an sObject')
+        fields = {}
+        for f in sObject:
+            if f.get('{' + XSI_NS + '}nil') == 'true':
+                fields[localName(f.tag)] = None
+            else:
+                fields[localName(f.tag)] = f.text or ''
+        notifications.append({
+            'id': n.findtext('{' + OUTBOUND_NS + '}Id'),
+            'sobject': sObject.get('{' + XSI_NS + '}type',
+                '').split(':')[-1],
+            'fields': fields,
+        })
+    return {
+        'organizationId': msg.findtext('{' + OUTBOUND_NS + '}OrganizationId'),
+        'notifications': notifications,
+    }
+
+
+class OutboundReceiver():
+    """
+    A small HTTP server queueing the notifications of Outbound Messages.
+
+    Runs in a background thread. Each message is answered with an Ack once
+    its notifications are in self.notifications (a queue.Queue), so
+    SalesForce doesn't wait for our processing. If organizationId is given,
+    messages from other organizations are refused.
+    """
+
+    def __init__(self, host='', port=0, organizationId=None):
+        import http.server
+        import socketserver
+
+        receiver = self
+
+        # http.server.ThreadingHTTPServer is Python 3.7+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                try:
+                    msg = parseOutboundMessage(body)
+                except ValueError as e:
+                    getLogger().warn('Bad Outbound Message: %s', e)
+                    self.send_error(400)
+                    return
+                if (organizationId and not (msg['organizationId'] or
+                        '').startswith(organizationId[:15])):
+                    getLogger().warn('Outbound Message from organization %s',
+                            msg['organizationId'])
+                    self.send_error(403)
+                    return
+                for n in msg['notifications']:
+                    receiver.notifications.put(n)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(ACK_RESPONSE)))
+                self.end_headers()
+                self.wfile.write(ACK_RESPONSE)
+
+            def log_message(self, format, *args):
+                getLogger().info('%s ' + format, self.address_string(),
+                        *args)
+
+        self.notifications = queue.Queue()
+        self._server = Server((host, port), Handler)
+        self._thread = None
+
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+    def getBatch(self, timeout=None, maxSize=200, linger=0):
+        """
+        Return the queued notifications, waiting up to timeout for the first.
+
+        After the first, more are collected for linger seconds, so a burst
+        is processed together. Returns at most maxSize, an empty list if none
+        arrived.
+        """
+        try:
+            batch = [self.notifications.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        end = time.monotonic() + linger
+        while len(batch) < maxSize:
+            try:
+                batch.append(self.notifications.get(
+                    timeout=max(0, end - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+
+def replay(url, bodies, timeout=10):
+    """
+    POST captured Outbound Messages (bytes) to url, like SalesForce does.
+
+    Returns the HTTP status of each. For testing the receiver locally.
+    """
+    import urllib.error
+    import urllib.request
+
+    statuses = []
+    for body in bodies:
+        req = urllib.request.Request(url, body, {
+            'Content-Type': 'text/xml; charset=utf-8',
+            'SOAPAction': '""',
+        })
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                resp.read()
+                statuses.append(resp.status)
+        except urllib.error.HTTPError as e:
+            statuses.append(e.code)
+    return statuses
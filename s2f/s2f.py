@@ -1,12 +1,19 @@
 import datetime
-import iso8601
 import json
 import logging
-import pytz
+import os.path
 import sys
+import time
+import urllib.parse
 
+import s2f.archive
+import s2f.checkpoint
+import s2f.dedup
+import s2f.lanes
+import s2f.opstore
 import s2f.sforce
 import s2f.flowdock
+from s2f import util
 
 
 def getLogger():
@@ -20,6 +27,8 @@ def fmtNr(n):
 
 
 def fmtTimeStamp(ts, tzName):
+    # pytz loads its zone database on import; only pay for it when formatting
+    import pytz
     naive = datetime.datetime.utcfromtimestamp(ts)
     aware = pytz.utc.localize(naive)
     aware = aware.astimezone(pytz.timezone(tzName))
@@ -28,20 +37,27 @@ def fmtTimeStamp(ts, tzName):
 
 
 def fmtOpportunitySummary(op):
-    txt = ('Stage: ' +
-            '{StageName}, Owner: {OwnerName}, Account: {AccountName}.'
-            ).format(**op)
+    """
+    Format the summary lines of an opportunity.
+
+    Fields not configured in SClient.opportunityFields are left out.
+    """
+    txt = ', '.join('{}: {}'.format(label, op[f]) for f, label in (
+        ('StageName', 'Stage'),
+        ('OwnerName', 'Owner'),
+        ('AccountName', 'Account'),
+    ) if f in op) + '.'
 
     lineItems = []
-    if op['Amount']:
+    if op.get('Amount'):
         lineItems.append('Amount: ' + fmtNr(op['Amount']))
-    if op['Probability']:
+    if op.get('Probability'):
         lineItems.append('Probability: ' + fmtNr(op['Probability']) + '%')
-    if op['AvgHourPrice']:
+    if op.get('AvgHourPrice'):
         lineItems.append('Avg. hour price: ' + fmtNr(op['AvgHourPrice']))
-    if op['CloseDate']:
+    if op.get('CloseDate'):
         lineItems.append('Close date: ' + op['CloseDate'])
-    if op['TypeOfSales']:
+    if op.get('TypeOfSales'):
         lineItems.append('Type of sales: ' + op['TypeOfSales'])
     if lineItems:
         txt += '\n' + ', '.join(lineItems) + '.'
@@ -52,22 +68,26 @@ def fmtOpportunitySummary(op):
 def fmtForChat(detail):
     """
     Format opportunity chatter details into a message string for Chat.
+
+    Fields missing from the details (not configured) are left out.
     """
-    result = ('{opportunity_name} ' +
-            '({stage}, owner {opportunity_owner}, account {account_name}) '
+    parts = ['owner {opportunity_owner}', 'account {account_name}']
+    if 'stage' in detail:
+        parts.insert(0, '{stage}')
+    result = ('{opportunity_name} (' + ', '.join(parts) + ') '
             ).format(**detail)
 
     lineItems = []
-    if detail['amount']:
+    if detail.get('amount'):
         lineItems.append('Amount: ' + fmtNr(detail['amount']))
-    if detail['probability']:
+    if detail.get('probability'):
         lineItems.append('Probability: ' + fmtNr(detail['probability']))
-    if detail['average_hour_price']:
+    if detail.get('average_hour_price'):
         lineItems.append('Avg. hour price: ' +
                 fmtNr(detail['average_hour_price']))
-    if detail['close_date']:
+    if detail.get('close_date'):
         lineItems.append('Close date: ' + detail['close_date'])
-    if detail['type_of_sales']:
+    if detail.get('type_of_sales'):
         lineItems.append('Type of sales: ' + detail['type_of_sales'])
     result += '\n' + ', '.join(lineItems)
 
@@ -82,6 +102,8 @@ def fmtForChat(detail):
 def fmtOpChatterForTeamInbox(detail, tzName):
     """
     Format opportunity chatter details to a data structure for Team Inbox.
+
+    Fields missing from the details (not configured) are left out.
     """
     txt = ''
     if detail['text']:
@@ -90,21 +112,28 @@ def fmtOpChatterForTeamInbox(detail, tzName):
     timeStr = fmtTimeStamp(detail['modified_ts'], tzName)
     txt += '– ' + detail['actor_name'] + ' (' + timeStr + ')'
 
-    txt += ('\n\nStage: ' +
-            '{stage}, Owner: {opportunity_owner}, Account: {account_name}.'
-            ).format(**detail)
+    if detail.get('comments'):
+        txt += '\n\nComments:'
+        for c in detail['comments']:
+            txt += '\n' + (c['text'] or '') + '\n– {} ({})'.format(
+                    c['actor_name'], fmtTimeStamp(c['created_ts'], tzName))
+
+    parts = ['Owner: {opportunity_owner}', 'Account: {account_name}']
+    if 'stage' in detail:
+        parts.insert(0, 'Stage: {stage}')
+    txt += ('\n\n' + ', '.join(parts) + '.').format(**detail)
 
     lineItems = []
-    if detail['amount']:
+    if detail.get('amount'):
         lineItems.append('Amount ' + fmtNr(detail['amount']))
-    if detail['probability']:
+    if detail.get('probability'):
         lineItems.append('Probability ' + fmtNr(detail['probability']) + '%')
-    if detail['average_hour_price']:
+    if detail.get('average_hour_price'):
         lineItems.append('Avg. hour price ' +
                 fmtNr(detail['average_hour_price']))
-    if detail['close_date']:
+    if detail.get('close_date'):
         lineItems.append('Close date ' + detail['close_date'])
-    if detail['type_of_sales']:
+    if detail.get('type_of_sales'):
         lineItems.append('Type of sales: ' + detail['type_of_sales'])
     txt += '\n' + ', '.join(lineItems) + '.'
 
@@ -114,6 +143,15 @@ def fmtOpChatterForTeamInbox(detail, tzName):
             **detail),
         'textContent': txt,
         'project': detail['account_name'],
+        'event': {
+            'type': 'chatter',
+            'sobject': 'Opportunity',
+            # to recognize tracked changes already posted, see s2f.dedup
+            'itemType': detail['type'],
+            'opportunityId': detail.get('opportunity_id'),
+            'modifiedTs': detail['modified_ts'],
+            'actorName': detail['actor_name'],
+        },
     }
 
 
@@ -122,15 +160,15 @@ def fmtNewOpForTeamInbox(op, tzName):
     Format new opportunity to a data structure for Team Inbox.
     """
     txt = ''
-    if op['Description']:
+    if op.get('Description'):
         txt += op['Description'] + '\n\n'
 
-    ts = int(iso8601.parse_date(op['CreatedDate']).timestamp())
+    ts = int(util.parseTimestamp(op['CreatedDate']))
     timeStr = fmtTimeStamp(ts, tzName)
     txt += '– {} created by {}'.format(timeStr, op['CreatedByName'])
 
     if op['LastModifiedDate'] != op['CreatedDate']:
-        ts = int(iso8601.parse_date(op['LastModifiedDate']).timestamp())
+        ts = int(util.parseTimestamp(op['LastModifiedDate']))
         timeStr = fmtTimeStamp(ts, tzName)
         txt += '\n– {} modified by {}'.format(timeStr, op['LastModifiedByName'])
 
@@ -139,16 +177,29 @@ def fmtNewOpForTeamInbox(op, tzName):
 
     return {
         'teamName': op['FutuTeam'],
-        'subject': '{Name} — {CreatedByName}'.format(**op),
+        'subject': '{} — {}'.format(op.get('Name'), op['CreatedByName']),
         'textContent': txt,
-        'project': op['AccountName'],
+        'project': op.get('AccountName'),
+        'event': {
+            'type': 'new',
+            'sobject': 'Opportunity',
+            'changedFields': [],
+            'record': op,
+        },
     }
 
 
-def fmtOpChangeForTeamInbox(oldOp, newOp, tzName):
+def fmtOpChangeForTeamInbox(oldOp, newOp, tzName, changedFields=None):
     """
     Format a changed opportunity to a data structure for Team Inbox.
+
+    changedFields maps the field names to check to their labels, by default
+    s2f.sforce.OPPORTUNITY_CHANGED_FIELDS.
+    Like the other fmt…ForTeamInbox() results, it includes an ‘event’ for
+    the fan-out rules (see FClient.postToInbox()).
     """
+    if changedFields is None:
+        changedFields = s2f.sforce.OPPORTUNITY_CHANGED_FIELDS
     def snippet(text, maxLen=40):
         """
         Return text or "prefix…" if text is too long.
@@ -159,14 +210,15 @@ def fmtOpChangeForTeamInbox(oldOp, newOp, tzName):
             return text[:maxLen-1] + '…'
         return text
 
+    changed = [f for f in changedFields if oldOp.get(f) != newOp.get(f)]
     txt = 'Updated fields:\n'
-    for fName, fDisplay in s2f.sforce.OPPORTUNITY_CHANGED_FIELDS.items():
-        if oldOp[fName] != newOp[fName]:
+    for fName, fDisplay in changedFields.items():
+        if fName in changed:
             # str(…) in case these fields aren't strings (int, None, etc)
             if fName == 'Description':
                 txt += '{}: {}\n'.format(fDisplay, str(newOp[fName]))
             else:
-                oldVal, newVal = oldOp[fName], newOp[fName]
+                oldVal, newVal = oldOp.get(fName), newOp.get(fName)
 
                 # print 50000 as 50,000; check types: we also get string, None.
                 numTypes = {int, float}
@@ -184,7 +236,7 @@ def fmtOpChangeForTeamInbox(oldOp, newOp, tzName):
                 txt += '{}: {} → {}\n'.format(fDisplay,
                         snippet(str(oldVal)), snippet(str(newVal)))
 
-    ts = int(iso8601.parse_date(newOp['LastModifiedDate']).timestamp())
+    ts = int(util.parseTimestamp(newOp['LastModifiedDate']))
     timeStr = fmtTimeStamp(ts, tzName)
     txt += '\n– {} modified by {}'.format(timeStr, newOp['LastModifiedByName'])
 
@@ -193,101 +245,802 @@ def fmtOpChangeForTeamInbox(oldOp, newOp, tzName):
 
     return {
         'teamName': newOp['FutuTeam'],
-        'subject': '[updated] {Name} — {LastModifiedByName}'.format(**newOp),
+        'subject': '[updated] {} — {}'.format(newOp.get('Name'),
+            newOp['LastModifiedByName']),
         'textContent': txt,
-        'project': newOp['AccountName'],
+        'project': newOp.get('AccountName'),
+        'event': {
+            'type': 'changed',
+            'sobject': 'Opportunity',
+            'changedFields': changed,
+            'record': newOp,
+        },
     }
 
 
+def fmtWatchedChangeForTeamInbox(sobjectName, kind, oldRec, newRec, tzName,
+        changedFields, teamName):
+    """
+    Format a new or changed watched record to a data structure for Team Inbox.
+
+    kind is 'new' or 'changed' (see SClient.getWatchedChanges()).
+    changedFields maps the field names to check to their labels.
+    """
+    title = newRec.get('Title') or newRec['Id']
+    if kind == 'new':
+        actor = newRec['CreatedByName']
+        ts = int(util.parseTimestamp(newRec['CreatedDate']))
+        subject = '[{}] {} — {}'.format(sobjectName, title, actor)
+        txt = ''.join('{}: {}\n'.format(fDisplay, newRec.get(fName))
+                for fName, fDisplay in changedFields.items())
+        if txt:
+            txt += '\n'
+        txt += '– {} created by {}'.format(fmtTimeStamp(ts, tzName), actor)
+    else:
+        actor = newRec['LastModifiedByName']
+        ts = int(util.parseTimestamp(newRec['LastModifiedDate']))
+        subject = '[{} updated] {} — {}'.format(sobjectName, title, actor)
+        txt = 'Updated fields:\n'
+        for fName, fDisplay in changedFields.items():
+            if oldRec.get(fName) != newRec.get(fName):
+                txt += '{}: {} → {}\n'.format(fDisplay, oldRec.get(fName),
+                        newRec.get(fName))
+        txt += '\n– {} modified by {}'.format(fmtTimeStamp(ts, tzName),
+                actor)
+
+    return {
+        'teamName': teamName,
+        'subject': subject,
+        'textContent': txt,
+        'event': {
+            'type': kind,
+            'sobject': sobjectName,
+            'changedFields': [f for f in changedFields if kind == 'changed'
+                and oldRec.get(f) != newRec.get(f)],
+            'record': newRec,
+        },
+    }
+
+
+def openOpportunityStore(opportunitiesFileName):
+    """
+    Return the OpportunityStore, importing the old JSON store if present.
+
+    The JSON file is the one with the same name but a .json extension.
+    """
+    store = s2f.opstore.OpportunityStore(opportunitiesFileName)
+    if store.isEmpty():
+        legacyFileName = os.path.splitext(opportunitiesFileName)[0] + '.json'
+        if (legacyFileName != opportunitiesFileName and
+                os.path.exists(legacyFileName)):
+            getLogger().info('Importing ' + legacyFileName)
+            try:
+                store.importJsonFile(legacyFileName)
+            except ValueError:
+                getLogger().warn('While importing opportunities file:',
+                        exc_info=sys.exc_info())
+    return store
+
+
+def queueOpportunityEvents(sClient, fClient, postingQueue, events,
+        archive=None):
+    """
+    Format the (kind, oldOp, op) events and add them to postingQueue.
+
+    Each event is added to archive (an s2f.archive.HistoryArchive), if given,
+    and queued as it comes, so events may be an iterator.
+    """
+    for kind, oldOp, op in events:
+        if archive is not None:
+            archive.addOpportunityChange(kind, oldOp, op)
+        try:
+            tzName = fClient.getTeamTzName(op['FutuTeam'])
+            if kind == 'new':
+                message = fmtNewOpForTeamInbox(op, tzName)
+            else:
+                message = fmtOpChangeForTeamInbox(oldOp, op, tzName,
+                        sClient.opportunityChangedFields)
+        except:
+            getLogger().error('While formatting %s opportunity «%s»:', kind,
+                    util.LazyJson(op), exc_info=sys.exc_info())
+            continue
+        postingQueue.add('opportunity|' + op['Id'] + '|' +
+                op['LastModifiedDate'], message)
+
+
 def postNewAndModifiedOpportunities(sClient, fClient, limits,
-        opportunitiesFileName):
+        opportunitiesFileName, eventIndex=None, checkpoint=None,
+        archive=None, postingQueue=None):
     """
     Post new and modified opportunities to Team Inbox.
+
+    opportunitiesFileName is the OpportunityStore of known opportunities.
+    Changes are streamed from SalesForce and written to the store, and the
+    new and changed ones (at most maxTeamOpportunities per team) are queued
+    as they come, then posted.
+    If eventIndex (an s2f.dedup.EventIndex) is given, the opportunities
+    posted are added to it (see drainQueue()).
+    If checkpoint (an s2f.checkpoint.Checkpoint) is given, progress through
+    the query pages is recorded in it, and an interrupted run is resumed.
+    A page is only recorded once its messages are queued, and so saved in
+    the checkpoint too (see s2f.lanes.PostingQueue).
+    If SClient.hasOpportunityChanges() shows nothing was modified since the
+    watermark, nothing else is fetched or written.
+    The new and changed opportunities are added to archive (an
+    s2f.archive.HistoryArchive), if given.
+    If postingQueue (an s2f.lanes.PostingQueue) is given, the messages are
+    added to it instead of posted.
+    """
+    kwArgs = {}
+    if checkpoint is not None:
+        if checkpoint.get('opportunitiesDone'):
+            getLogger().info('Opportunities already done in this run')
+            return
+        kwArgs['resumeUrl'] = checkpoint.get('opportunitiesNextUrl')
+        kwArgs['teamCounts'] = checkpoint.get('opportunityTeamCounts', {})
+        def onPage(nextUrl):
+            if archive is not None:
+                archive.commit()
+            store.commit()
+            checkpoint.update({
+                'opportunitiesNextUrl': nextUrl,
+                'opportunityTeamCounts': kwArgs['teamCounts'],
+            })
+        kwArgs['onPage'] = onPage
+
+    store = openOpportunityStore(opportunitiesFileName)
+    # The watermark only moves after all changes have been processed. If we
+    # stop half way, the next run gets them again; those already stored
+    # compare equal and aren't posted twice.
+    watermark = store.getMeta('watermark')
+    # likely first run (no complete run yet). Save but don't post.
+    skipFlowdock = watermark is None
+    if skipFlowdock:
+        getLogger().warn('No known opportunities, not posting changes')
+    elif (not kwArgs.get('resumeUrl') and
+            not sClient.hasOpportunityChanges(watermark,
+                store.idsModifiedAt(watermark),
+                filters=limits.get('teamFilters'))):
+        # Only those we already have at the watermark: nothing changed.
+        getLogger().info('No opportunities changed')
+        store.close()
+        if checkpoint is not None:
+            checkpoint.set('opportunitiesDone', True)
+        return
+
+    events = sClient.iterOpportunityChanges(store.get, store.put,
+            limits['maxTeamOpportunities'], minModified=watermark,
+            filters=limits.get('teamFilters'), **kwArgs)
+    def setWatermark():
+        store.setMeta('watermark', store.latestModified())
+        store.commit()
+    try:
+        if skipFlowdock:
+            for event in events:
+                pass
+            events = []
+        postOpportunityEvents(sClient, fClient, limits, events,
+                eventIndex=eventIndex, checkpoint=checkpoint, archive=archive,
+                postingQueue=postingQueue, beforePosting=setWatermark)
+    finally:
+        store.close()
+
+
+def postOpportunityFieldHistory(sClient, fClient, limits,
+        opportunitiesFileName, eventIndex=None, checkpoint=None,
+        archive=None, postingQueue=None):
+    """
+    Post the opportunity changes in OpportunityFieldHistory to Team Inbox.
+
+    Used instead of postNewAndModifiedOpportunities() with the
+    ‘changeSource’ limit set to ‘fieldHistory’, see
+    SClient.getOpportunityHistoryChanges(). Only the history watermark is
+    kept, in the meta of the OpportunityStore opportunitiesFileName; the
+    opportunities aren't stored. The snapshot watermark is cleared, so
+    switching back starts over without posting. The arguments are like for
+    postNewAndModifiedOpportunities(). Like there, the watermark only moves
+    once the events are queued (and so in the checkpoint, if given).
+    """
+    if checkpoint is not None and checkpoint.get('opportunitiesDone'):
+        getLogger().info('Opportunities already done in this run')
+        return
+
+    store = openOpportunityStore(opportunitiesFileName)
+    try:
+        watermark = store.getMeta('historyWatermark')
+        if watermark is None:
+            getLogger().warn('No opportunity history watermark, ' +
+                    'not posting changes')
+            watermark = [s2f.sforce.soqlDateTime(time.time()), []]
+            events = []
+        else:
+            events, watermark = sClient.getOpportunityHistoryChanges(
+                    limits['maxTeamOpportunities'], *watermark,
+                    filters=limits.get('teamFilters'))
+        def setWatermark():
+            store.setMeta('historyWatermark', watermark)
+            store.setMeta('watermark', None)
+            store.commit()
+        postOpportunityEvents(sClient, fClient, limits, events,
+                eventIndex=eventIndex, checkpoint=checkpoint,
+                archive=archive, postingQueue=postingQueue,
+                beforePosting=setWatermark)
+    finally:
+        store.close()
+
+
+def postOpportunityEvents(sClient, fClient, limits, events, eventIndex=None,
+        checkpoint=None, archive=None, postingQueue=None, beforePosting=None):
     """
-    skipFlowdock = False
+    Archive and post the (kind, oldOp, op) opportunity events.
+
+    events may be an iterator, see queueOpportunityEvents(). Once all are
+    queued, beforePosting() is called, if given. See
+    postNewAndModifiedOpportunities() for the other arguments.
+    """
+    queue = postingQueue
+    if queue is None:
+        queue = openPostingQueue(limits, checkpoint)
+    queueOpportunityEvents(sClient, fClient, queue, events, archive=archive)
+    if archive is not None:
+        archive.commit()
+    if beforePosting is not None:
+        beforePosting()
+    if postingQueue is None:
+        drainQueue(fClient, queue, eventIndex=eventIndex)
+    if checkpoint is not None:
+        checkpoint.update({
+            'opportunitiesDone': True,
+            'opportunitiesNextUrl': None,
+        })
+
+
+def postOpportunityNotifications(sClient, fClient, limits,
+        opportunitiesFileName, notifications, eventIndex=None):
+    """
+    Post the changes of the opportunities in Outbound Message notifications.
+
+    notifications are from s2f.outbound. Their opportunities are fetched
+    again, with one query, and compared to the known ones in the
+    OpportunityStore like in postNewAndModifiedOpportunities(). So a change
+    seen by both the notifications and the polling is posted once, and
+    notifications SalesForce sends again are ignored. The watermark isn't
+    moved, the polling still picks up any change missed here. If eventIndex
+    is given, the opportunities posted are added to it.
+
+    With the ‘changeSource’ limit set to ‘fieldHistory’ the known
+    opportunities aren't kept up to date, so the notifications only trigger
+    postOpportunityFieldHistory(), which posts them with the other new
+    history.
+    """
+    ids = [n['fields']['Id'] for n in notifications
+            if n['sobject'] == 'Opportunity' and n['fields'].get('Id')]
+    if not ids:
+        return
+    if limits.get('changeSource') == 'fieldHistory':
+        getLogger().info('Posting the field history for %d notifications',
+                len(ids))
+        postOpportunityFieldHistory(sClient, fClient, limits,
+                opportunitiesFileName, eventIndex=eventIndex)
+        return
+    store = openOpportunityStore(opportunitiesFileName)
     try:
-        with open(opportunitiesFileName, 'r', encoding='utf-8') as f:
-            knownOps = json.load(f)
-    except (FileNotFoundError, ValueError):
-        # likely first run (missing or invalid file). Save file but don't post.
-        skipFlowdock = True
-        knownOps = []
-        getLogger().warn('While reading opportunities file:',
-                exc_info=sys.exc_info())
-    knownOps = {op['Id']:op for op in knownOps}
-
-    allOps, newOps, changedOps = sClient.getOpportunityChanges(knownOps,
-            maxTeamItems = limits['maxTeamOpportunities'])
+        if store.getMeta('watermark') is None:
+            getLogger().warn('No known opportunities, ignoring %d ' +
+                    'notifications', len(ids))
+            return
+        events = list(sClient.iterOpportunityChanges(store.get, store.put,
+            limits['maxTeamOpportunities'],
+            opportunities=sClient.iterOpportunitiesById(ids),
+            filters=limits.get('teamFilters')))
+    finally:
+        store.close()
+
+    queue = s2f.lanes.PostingQueue(rules=limits.get('priorityRules'))
+    queueOpportunityEvents(sClient, fClient, queue, events)
+    drainQueue(fClient, queue, eventIndex=eventIndex)
+
+
+def postWatchedObjectChanges(sClient, fClient, limits, watchedObjectsDir,
+        extraUrls=None, archive=None, postingQueue=None):
+    """
+    Post new and changed records of the watched SObjects to Team Inbox.
+
+    The records of each SObject are stored like the opportunities, in
+    known-<SObject>.sqlite in watchedObjectsDir. At most the ‘maxWatchedItems’
+    limit (default maxTeamOpportunities) of each SObject are posted.
+    extraUrls are fetched with the same request, see
+    SClient.getWatchedChanges(), and their JSON is returned.
+    The changes are added to archive (an s2f.archive.HistoryArchive), if
+    given. If postingQueue (an s2f.lanes.PostingQueue) is given, the
+    messages are added to it instead of posted.
+    The records fetched are only committed to the stores once their changes
+    are queued, so if this fails the next run finds the same changes.
+    """
+    stores = {name:s2f.opstore.OpportunityStore(os.path.join(
+        watchedObjectsDir, 'known-' + name + '.sqlite'))
+        for name in sClient.watchedObjects}
+    queue = postingQueue
+    if queue is None:
+        queue = s2f.lanes.PostingQueue(rules=limits.get('priorityRules'))
     try:
-        with open(opportunitiesFileName, 'w', encoding='utf-8') as f:
-            json.dump(allOps, f)
+        watermarks = {name:store.getMeta('watermark')
+                for name, store in stores.items()}
+        for name, watermark in watermarks.items():
+            if watermark is None:
+                getLogger().warn('No known %s records, not posting changes',
+                        name)
+        events, extras = sClient.getWatchedChanges(
+                lambda name, recId: stores[name].get(recId),
+                lambda name, rec: stores[name].put(rec),
+                watermarks,
+                limits.get('maxWatchedItems', limits['maxTeamOpportunities']),
+                extraUrls=extraUrls)
+
+        if archive is not None:
+            for name, kind, oldRec, rec in events:
+                archive.addOpportunityChange(kind, oldRec, rec, sobject=name)
+            archive.commit()
+
+        for name, kind, oldRec, rec in events:
+            cfg = sClient.watchedObjects[name]
+            teamName = rec.get('FutuTeam') or cfg['team'] or ''
+            try:
+                message = fmtWatchedChangeForTeamInbox(name, kind, oldRec,
+                        rec, fClient.getTeamTzName(teamName),
+                        cfg['changedFields'], teamName)
+            except:
+                getLogger().error('While formatting %s %s «%s»:', kind, name,
+                        util.LazyJson(rec), exc_info=sys.exc_info())
+                continue
+            queue.add(name + '|' + rec['Id'] + '|' + rec['LastModifiedDate'],
+                    message)
+
+        # only now that their changes are queued, the records are known
+        for store in stores.values():
+            store.setMeta('watermark', store.latestModified())
+            store.commit()
     except:
-        getLogger().error('While saving opportunities file:',
-                exc_info=sys.exc_info())
+        # the records saved so far would hide their changes next time
+        for store in stores.values():
+            store.rollback()
+        raise
+    finally:
+        for store in stores.values():
+            store.close()
 
-    if skipFlowdock:
-        return
+    if postingQueue is None:
+        drainQueue(fClient, queue)
+    return extras
+
+
+def postOpportunitiesChatter(sClient, fClient, limits, startUrl=None,
+        skipItem=None, recentItemCounts=None, checkpoint=None,
+        beforePosting=None, seenItems=None, firstPage=None, archive=None,
+        postingQueue=None):
+    """
+    Post opportunities chatter to Team Inbox and return the updatesUrl.
+
+    With the ‘chatterSource’ limit set to ‘opportunityFeed’, only opportunity
+    chatter is queried (SClient.getOpportunityFeedDetails()), otherwise the
+    company feed is fetched and filtered.
+    With the ‘chatterComments’ limit true, each item's comments are fetched
+    too (with few extra requests) and shown in its message.
+
+    skipItem is an optional function which returns True for the chatter items
+    (from the chatter API) to leave out, see SClient.getOpportunitiesChatter().
+    recentItemCounts is an optional list used to size the company feed pages
+    (see SClient.getCompanyChatter()).
+    If checkpoint (an s2f.checkpoint.Checkpoint) is given, the fetched items
+    and the ones posted are recorded in it. An interrupted run then posts
+    the remaining items without fetching them again.
+    beforePosting is an optional function called after fetching the items
+    and before posting them.
+    seenItems is an optional s2f.dedup.SeenItems. Items in it are dropped
+    before any other lookups, and the items posted are added to it.
+    firstPage is the company feed page at companyChatterUrl(), if already
+    fetched.
+    The items are added to archive (an s2f.archive.HistoryArchive), if given.
+    If postingQueue (an s2f.lanes.PostingQueue) is given, the messages are
+    added to it instead of posted; beforePosting is called before that.
+    """
+    if seenItems is not None:
+        otherSkipItem = skipItem
+        def skipItem(item):
+            if seenItems.hasItem(item):
+                return True
+            return otherSkipItem is not None and otherSkipItem(item)
 
-    for op in newOps:
+    fetched = checkpoint.get('chatter') if checkpoint is not None else None
+    if fetched:
+        getLogger().info('Resuming chatter from checkpoint')
+        items, updatesUrl = fetched['items'], fetched['updatesUrl']
+    else:
+        items, updatesUrl = getOpportunitiesChatter(sClient, limits,
+                startUrl=startUrl, skipItem=skipItem,
+                recentItemCounts=recentItemCounts, firstPage=firstPage)
+        if checkpoint is not None:
+            checkpoint.set('chatter', {
+                'items': items,
+                'updatesUrl': updatesUrl,
+            })
+
+    if beforePosting is not None:
+        beforePosting()
+    queue = postingQueue
+    if queue is None:
+        queue = s2f.lanes.PostingQueue(rules=limits.get('priorityRules'),
+                checkpoint=checkpoint)
+    for item in items:
         try:
-            fClient.postToInbox(**fmtNewOpForTeamInbox(op,
-                fClient.getTeamTzName(op['FutuTeam'])))
+            message = fmtOpChatterForTeamInbox(item,
+                    fClient.getTeamTzName(item['futu_team']))
         except:
-            getLogger().error('While posting new opportunity «' +
-                    json.dumps(op) + '»:', exc_info=sys.exc_info())
-
-    for newOp in changedOps:
-        opId = newOp['Id']
-        if opId not in knownOps:
-            getLogger().warn('Changed Opportunity ID ' + opId +
-                ' not in old opportunities')
+            getLogger().error('While formatting item «%s»:',
+                    util.LazyJson(item), exc_info=sys.exc_info())
             continue
-        oldOp = knownOps[opId]
-        try:
-            fClient.postToInbox(**fmtOpChangeForTeamInbox(oldOp, newOp,
-                fClient.getTeamTzName(newOp['FutuTeam'])))
-        except:
-            getLogger().error('While posting changed opportunity «' +
-                    json.dumps(newOp) + '»:', exc_info=sys.exc_info())
+        onDone = None
+        if seenItems is not None:
+            onDone = lambda item=item: seenItems.addDetail(item)
+        if (queue.add('chatter|' + str(item['id']), message, onDone=onDone)
+                and archive is not None):
+            archive.addChatterDetail(item)
+    if archive is not None:
+        archive.commit()
+    if postingQueue is None:
+        drainQueue(fClient, queue)
+    return updatesUrl
 
 
-def postOpportunitiesChatter(sClient, fClient, limits, startUrl=None):
+def companyChatterUrl(limits, startUrl=None, recentItemCounts=None):
     """
-    Post opportunities chatter to Team Inbox and return the updatesUrl.
+    Return the url of the first company feed page to fetch, or None.
+
+    None means the chatter doesn't come from the company feed. See
+    postOpportunitiesChatter() for the arguments.
+    """
+    if (limits.get('chatterSource') == 'opportunityFeed' or
+            (startUrl and startUrl.startswith('query/'))):
+        return None
+    url = startUrl or 'chatter/feeds/company/feed-items'
+    pageSize = None
+    if recentItemCounts is not None:
+        pageSize = s2f.sforce.chooseChatterPageSize(recentItemCounts)
+    if pageSize is None:
+        # no history yet: leave it to the server (or the startUrl)
+        return url
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query,
+        keep_blank_values=True) if k != 'pageSize']
+    query.append(('pageSize', str(pageSize)))
+    return urllib.parse.urlunsplit(parts._replace(
+        query=urllib.parse.urlencode(query)))
+
+
+def getOpportunitiesChatter(sClient, limits, startUrl=None, skipItem=None,
+        recentItemCounts=None, firstPage=None):
+    """
+    Return the opportunities chatter details to post and the updatesUrl.
+
+    See postOpportunitiesChatter() for the arguments.
     """
     kwArgs = {
         'maxSeconds': limits['maxSeconds'],
         'maxPages': limits['maxPages'],
         'maxTeamOpportunities': limits['maxTeamOpportunities'],
     }
+    fromOpportunityFeed = limits.get('chatterSource') == 'opportunityFeed'
+    if startUrl and fromOpportunityFeed != startUrl.startswith('query/'):
+        # the updatesUrl is from the other chatter source
+        startUrl = None
     if startUrl:
         kwArgs['url'] = startUrl
-    items, updatesUrl = sClient.getOpportunitiesChatterDetails(**kwArgs)
-    for item in items:
+    if skipItem is not None:
+        kwArgs['skipItem'] = skipItem
+    if limits.get('chatterComments'):
+        kwArgs['includeComments'] = True
+    if limits.get('teamFilters'):
+        kwArgs['filters'] = limits['teamFilters']
+    if fromOpportunityFeed:
+        items, updatesUrl = sClient.getOpportunityFeedDetails(**kwArgs)
+    else:
+        if recentItemCounts is not None:
+            kwArgs['recentItemCounts'] = recentItemCounts
+        if firstPage is not None:
+            kwArgs['firstPage'] = firstPage
+        items, updatesUrl = sClient.getOpportunitiesChatterDetails(**kwArgs)
+    return items, updatesUrl
+
+
+def openPostingQueue(limits, checkpoint=None):
+    """
+    Return a PostingQueue (see s2f.lanes) with the ‘priorityRules’ limit.
+
+    If checkpoint is given, the messages an interrupted run had queued in it
+    are queued again, except those already posted.
+    """
+    postingQueue = s2f.lanes.PostingQueue(rules=limits.get('priorityRules'),
+            checkpoint=checkpoint)
+    postingQueue.resume()
+    return postingQueue
+
+
+def drainQueue(fClient, postingQueue, deadline=None, eventIndex=None):
+    """
+    Post the queued messages until the deadline, return the ones left.
+
+    See s2f.lanes.PostingQueue.drain(). If eventIndex (an
+    s2f.dedup.EventIndex) is given, tracked-change chatter messages for an
+    opportunity change in it aren't posted, and the opportunity changes are
+    added to it once posted (not when failed or spooled).
+    """
+    def post(message):
+        if eventIndex is not None and eventIndex.hasChatterEvent(
+                message.get('event')):
+            getLogger().info('Change already posted, skipping «%s»',
+                    message['subject'])
+            return True
+        posted = fClient.postToInbox(**message)
+        if posted and eventIndex is not None:
+            eventIndex.addPostedEvent(message.get('event'))
+        return posted
+    return postingQueue.drain(post, deadline=deadline)
+
+
+def postSpooledMessages(fClient, state, eventIndex=None):
+    """
+    Post the messages spooled by an earlier run, kept in the state by
+    saveSpooledMessages().
+
+    Messages whose flow is still failing are spooled again by fClient.
+    Posted opportunity changes are added to eventIndex, if given.
+    """
+    for msg in state.pop('spooledMessages', []):
         try:
-            fClient.postToInbox(**fmtOpChatterForTeamInbox(item,
-                fClient.getTeamTzName(item['futu_team'])))
+            if fClient.postToInbox(**msg) and eventIndex is not None:
+                eventIndex.addPostedEvent(msg.get('event'))
         except:
-            getLogger().error('While posting item «' + json.dumps(item) + '»:',
-                    exc_info=sys.exc_info())
-    return updatesUrl
+            getLogger().exception('While posting spooled message «%s»:',
+                    msg.get('subject'))
+
+
+def saveSpooledMessages(fClient, limits, state):
+    """
+    Keep the messages fClient spooled (see FClient.spooled) in the state,
+    for postSpooledMessages() to post next time.
+
+    At most the ‘maxSpooledMessages’ limit (default 500), the newest ones.
+    state may be None, then they're lost.
+    """
+    if not fClient.spooled:
+        return
+    maxSpooled = limits.get('maxSpooledMessages', 500)
+    spooled = fClient.spooled[-maxSpooled:]
+    dropped = len(fClient.spooled) - len(spooled)
+    if dropped:
+        getLogger().warn('Dropping %d spooled messages', dropped)
+    if state is not None:
+        state['spooledMessages'] = spooled
+    else:
+        getLogger().warn('No state, %d spooled messages are lost',
+                len(spooled))
 
 
 def postNewActivity(sforceCfgFileName, sforceTokenFileName,
         flowdockCfgFileName, limitsFileName, opportunitiesFileName,
-        startUrl=None):
+        startUrl=None, state=None, checkpointFileName=None,
+        seenChatterFileName=None, watchedObjectsDir=None,
+        archiveFileName=None):
     """
     Post new SalesForce Opportunities activity to Flowdock Team Inbox.
 
+    state is an optional dict which the caller persists between runs. If
+    given, it's used to remember the opportunity changes posted recently so
+    the matching tracked-change chatter items aren't posted again, and how
+    many chatter items recent runs fetched, and the messages not posted
+    because their flow was failing (up to the ‘maxSpooledMessages’ limit,
+    default 500). Those are posted first in the next run. The state is
+    updated even if the run fails, so the caller saves it either way.
+
+    checkpointFileName is an optional JSON file where the progress of the run
+    is recorded. If the run stops half way, the next one resumes from there,
+    without fetching or posting the same things again. The caller must
+    clear() the checkpoint (see s2f.checkpoint) after saving the returned
+    updatesUrl.
+
+    seenChatterFileName is an optional JSON file listing the chatter items
+    posted recently (the last ‘seenChatterItems’ limit, default 5000). They
+    aren't posted again, even if the state or updatesUrl is lost.
+
+    If the SalesForce configuration has ‘watchedObjects’ and
+    watchedObjectsDir is given, their changes are posted too (see
+    postWatchedObjectChanges()). The first company feed page is fetched in
+    the same request.
+
+    archiveFileName is an optional SQLite file where all the changes and
+    chatter items found are kept (see s2f.archive), to query them later.
+
+    The ‘teamFilters’ limit (see s2f.util.recordMatches()) drops the events
+    a team doesn't want. Where the SalesForce query allows it they aren't
+    fetched at all, otherwise they're dropped before fetching anything else
+    for them or formatting them.
+
+    With the ‘changeSource’ limit set to ‘fieldHistory’, the opportunity
+    changes come from OpportunityFieldHistory (see
+    postOpportunityFieldHistory()) instead of comparing snapshots.
+
+    The opportunities and the chatter are fetched concurrently. Then all
+    messages are posted by priority (the ‘priorityRules’ limit, see
+    s2f.lanes), and in the order found within a priority. If fetching fails,
+    the messages queued so far are still posted before the error is raised.
+    If the run takes longer than the ‘timeBudgetSeconds’ limit, the messages
+    not posted yet are deferred to the next run, in the state (up to the
+    ‘maxDeferredMessages’ limit, default 1000, the most urgent ones).
+
     Returns the updatesUrl to use next time to fetch only newer activity.
     """
+    startTime = time.monotonic()
+
     sClient = s2f.sforce.SClient(sforceCfgFileName, sforceTokenFileName)
     fClient = s2f.flowdock.FClient(flowdockCfgFileName)
     with open(limitsFileName, 'r', encoding='utf-8') as f:
         limits = json.load(f)
+    # raises ValueError for bad filters before any changes are fetched
+    sClient.opportunityFilterSoql(limits.get('teamFilters'))
+
+    eventIndex = None
+    if state is not None and limits.get('dedupTrackedChanges', True):
+        eventIndex = s2f.dedup.EventIndex(state.get('eventIndex', []),
+                maxSize=limits.get('eventIndexSize', 1000))
+
+    checkpoint = None
+    if checkpointFileName is not None:
+        checkpoint = s2f.checkpoint.Checkpoint(checkpointFileName)
+
+    if state is not None:
+        postSpooledMessages(fClient, state, eventIndex=eventIndex)
+    try:
+        updatesUrl = postActivity(sClient, fClient, limits,
+                opportunitiesFileName, startTime, startUrl=startUrl,
+                state=state, eventIndex=eventIndex, checkpoint=checkpoint,
+                seenChatterFileName=seenChatterFileName,
+                watchedObjectsDir=watchedObjectsDir,
+                archiveFileName=archiveFileName)
+    finally:
+        # even if this run failed, the spooled messages it posted are gone
+        # from the state and the ones it spooled must be kept
+        if eventIndex is not None:
+            state['eventIndex'] = eventIndex.toJson()
+        fClient.close()
+        saveSpooledMessages(fClient, limits, state)
+
+    hedgeStats = sClient.getHedgeStats()
+    if hedgeStats is not None:
+        getLogger().info('Hedged %d of %d SalesForce requests',
+                hedgeStats[1], hedgeStats[0])
+
+    for flowName, breakerState in sorted(fClient.getBreakerStates().items(),
+            key=lambda kv: str(kv[0])):
+        if breakerState != s2f.flowdock.CircuitBreaker.CLOSED:
+            getLogger().warn('Flow %s circuit breaker is %s', flowName,
+                    breakerState)
+    return updatesUrl
+
+
+def postActivity(sClient, fClient, limits, opportunitiesFileName, startTime,
+        startUrl=None, state=None, eventIndex=None, checkpoint=None,
+        seenChatterFileName=None, watchedObjectsDir=None,
+        archiveFileName=None):
+    """
+    Fetch and post the new activity for postNewActivity(), return the
+    updatesUrl.
+
+    startTime is the time.monotonic() the run started at, for the
+    ‘timeBudgetSeconds’ limit. The messages deferred are kept in the state,
+    also if this fails.
+    """
+    import concurrent.futures
+
+    postingQueue = openPostingQueue(limits, checkpoint)
+    if state is not None:
+        postingQueue.addAll(state.pop('deferredMessages', []))
 
-    postNewAndModifiedOpportunities(sClient, fClient, limits,
-            opportunitiesFileName)
+    # Tracked changes of opportunity changes posted by earlier runs are
+    # dropped right away. Those of this run's changes are only dropped when
+    # posting (see drainQueue()), once their change was actually posted.
+    skipItem = None
+    if eventIndex is not None:
+        skipItem = eventIndex.hasChatterChange
 
-    return postOpportunitiesChatter(sClient, fClient, limits,
-            startUrl=startUrl)
+    recentItemCounts = None
+    if state is not None:
+        recentItemCounts = state.setdefault('chatterItemCounts', [])
+
+    seenItems = None
+    if seenChatterFileName is not None:
+        seenItems = s2f.dedup.SeenItems.fromFile(seenChatterFileName,
+                maxSize=limits.get('seenChatterItems', 5000))
+
+    archive = None
+    if archiveFileName is not None:
+        # added events are committed right away, so they're kept even if
+        # this run fails
+        archive = s2f.archive.HistoryArchive(archiveFileName)
+
+    deadline = None
+    if limits.get('timeBudgetSeconds'):
+        deadline = startTime + limits['timeBudgetSeconds']
+
+    try:
+        firstChatterPage = None
+        if watchedObjectsDir is not None and sClient.watchedObjects:
+            extraUrls = {}
+            chatterUrl = companyChatterUrl(limits, startUrl, recentItemCounts)
+            if chatterUrl and not (checkpoint is not None and
+                    checkpoint.get('chatter')):
+                extraUrls['chatter'] = chatterUrl
+            extras = postWatchedObjectChanges(sClient, fClient, limits,
+                    watchedObjectsDir, extraUrls=extraUrls, archive=archive,
+                    postingQueue=postingQueue)
+            firstChatterPage = extras.get('chatter')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            postOpportunities = postNewAndModifiedOpportunities
+            if limits.get('changeSource') == 'fieldHistory':
+                postOpportunities = postOpportunityFieldHistory
+            opportunitiesDone = executor.submit(postOpportunities, sClient,
+                    fClient, limits, opportunitiesFileName,
+                    eventIndex=eventIndex, checkpoint=checkpoint,
+                    archive=archive, postingQueue=postingQueue)
+
+            # If the opportunities failed, .result() raises their exception
+            # and the chatter isn't posted.
+            chatterDone = executor.submit(postOpportunitiesChatter, sClient,
+                    fClient, limits, startUrl=startUrl, skipItem=skipItem,
+                    recentItemCounts=recentItemCounts, checkpoint=checkpoint,
+                    beforePosting=opportunitiesDone.result,
+                    seenItems=seenItems, firstPage=firstChatterPage,
+                    archive=archive, postingQueue=postingQueue)
+
+            opportunitiesDone.result()
+            updatesUrl = chatterDone.result()
+    except:
+        # The queue is in the checkpoint (if any), but the opportunity
+        # watermark may have moved already: don't leave the messages behind.
+        getLogger().error('Posting %d queued messages before failing',
+                len(postingQueue))
+        saveDeferredMessages(limits, state, drainQueue(fClient, postingQueue,
+            deadline=deadline, eventIndex=eventIndex))
+        raise
+
+    if archive is not None:
+        archive.close()
+
+    saveDeferredMessages(limits, state, drainQueue(fClient, postingQueue,
+        deadline=deadline, eventIndex=eventIndex))
+
+    if seenItems is not None:
+        seenItems.saveFile(seenChatterFileName)
+    return updatesUrl
+
+
+def saveDeferredMessages(limits, state, deferred):
+    """
+    Keep the messages deferred by drainQueue() in the state, to be posted
+    next time.
+
+    At most the ‘maxDeferredMessages’ limit (default 1000), the most urgent
+    ones. state may be None, then they're lost.
+    """
+    if not deferred:
+        return
+    maxDeferred = limits.get('maxDeferredMessages', 1000)
+    if len(deferred) > maxDeferred:
+        getLogger().warn('Dropping %d deferred messages',
+                len(deferred) - maxDeferred)
+        deferred = deferred[:maxDeferred]
+    if state is not None:
+        state['deferredMessages'] = deferred
+    else:
+        getLogger().warn('No state, %d deferred messages are lost',
+                len(deferred))
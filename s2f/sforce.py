@@ -5,13 +5,13 @@ https://developer.salesforce.com/page/REST_API
 
 from collections import OrderedDict
 import contextlib
-import datetime
-import iso8601
 import json
 import logging
-import requests_oauthlib
-from urllib.parse import urljoin
-import urllib.request
+import os.path
+import re
+import threading
+import time
+from urllib.parse import urlencode, urljoin, urlsplit
 
 from s2f import util
 
@@ -38,6 +38,331 @@ OPPORTUNITY_CHANGED_FIELDS = OrderedDict((
     ('IsWon', 'Won'),
 ))
 
+# Opportunity fields we always need, to detect, route and describe changes.
+# Like DEFAULT_OPPORTUNITY_FIELDS, this maps our field names (used in the
+# records returned by getOpportunities()) to SOQL field paths. The paths may
+# be overridden from the configuration, the names may not.
+REQUIRED_OPPORTUNITY_FIELDS = OrderedDict((
+    ('Id', 'Id'),
+    ('FutuTeam', 'Futu_Team__c'),
+    ('CreatedDate', 'CreatedDate'),
+    ('CreatedByName', 'CreatedBy.Name'),
+    ('LastModifiedDate', 'LastModifiedDate'),
+    ('LastModifiedByName', 'LastModifiedBy.Name'),
+))
+
+# Opportunity fields shown in messages, unless the configuration's
+# ‘opportunityFields’ says otherwise.
+DEFAULT_OPPORTUNITY_FIELDS = OrderedDict((
+    ('Name', 'Name'),
+    ('Description', 'Description'),
+    ('AccountName', 'Account.Name'),
+    ('OwnerName', 'Owner.Name'),
+    ('StageName', 'StageName'),
+    ('Amount', 'Amount'),
+    ('Probability', 'Probability'),
+    ('CloseDate', 'CloseDate'),
+    ('TypeOfSales', 'Type_of_Sales__c'),
+    ('AvgHourPrice', 'Average_Hour_Price__c'),
+    ('IsClosed', 'IsClosed'),
+    ('IsWon', 'IsWon'),
+))
+
+# Keys of the opportunity chatter details (see
+# SClient.getOpportunitiesChatterDetails()) holding opportunity fields, and
+# the field names. A detail only has the fields in opportunityFields.
+CHATTER_DETAIL_FIELDS = OrderedDict((
+    ('stage', 'StageName'),
+    ('amount', 'Amount'),
+    ('probability', 'Probability'),
+    ('close_date', 'CloseDate'),
+    ('type_of_sales', 'TypeOfSales'),
+    ('average_hour_price', 'AvgHourPrice'),
+    ('futu_team', 'FutuTeam'),
+))
+
+
+# Fields we always query for the other watched SObjects (see the
+# ‘watchedObjects’ configuration), to detect and describe changes.
+REQUIRED_WATCHED_FIELDS = OrderedDict((
+    ('Id', 'Id'),
+    ('CreatedDate', 'CreatedDate'),
+    ('CreatedByName', 'CreatedBy.Name'),
+    ('LastModifiedDate', 'LastModifiedDate'),
+    ('LastModifiedByName', 'LastModifiedBy.Name'),
+))
+
+# The field naming a record of a watched SObject in messages, unless the
+# SObject's ‘titleField’ is configured. Defaults to Name.
+WATCHED_TITLE_FIELDS = {
+    'Case': 'CaseNumber',
+    'Event': 'Subject',
+    'Task': 'Subject',
+}
+
+# A Composite API request has at most this many subrequests, and at most
+# COMPOSITE_MAX_QUERIES of them may be queries.
+COMPOSITE_MAX_SUBREQUESTS = 25
+COMPOSITE_MAX_QUERIES = 5
+
+
+def soqlDateTime(ts):
+    """
+    Format a POSIX timestamp as a SOQL dateTime literal.
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
+
+
+def soqlString(value):
+    """
+    Return value as a quoted and escaped SOQL string literal.
+    """
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def soqlLiteral(value, fieldType=None):
+    """
+    Return a number, boolean, None or string value as a SOQL literal.
+
+    fieldType is the field's describe type. A string for a 'date' field
+    must be a date (e.g. 2015-01-31) and for a 'datetime' field a date or a
+    dateTime (e.g. 2015-01-31T12:00:00Z), they're not quoted in SOQL. Raises
+    ValueError otherwise.
+    """
+    if value is None:
+        return 'null'
+    if type(value) == bool:
+        return 'true' if value else 'false'
+    if type(value) in (int, float):
+        return repr(value)
+    if fieldType == 'date':
+        if not re.match(r'\d{4}-\d\d-\d\d\Z', value):
+            raise ValueError('Not a SOQL date: ' + value)
+        return value
+    if fieldType == 'datetime':
+        if re.match(r'\d{4}-\d\d-\d\d\Z', value):
+            return value + 'T00:00:00Z'
+        if not re.match(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?' +
+                r'(Z|[+-]\d\d:\d\d)\Z', value):
+            raise ValueError('Not a SOQL dateTime: ' + value)
+        return value
+    return soqlString(value)
+
+
+def chooseChatterPageSize(recentItemCounts, minSize=10, maxSize=100):
+    """
+    Return a chatter page size for the number of items recent runs fetched.
+
+    Sized for the busiest recent run plus some headroom, so a typical run
+    needs one page. Returns None (the server default) without history.
+    """
+    if not recentItemCounts:
+        return None
+    need = max(recentItemCounts)
+    return max(minSize, min(maxSize, need + need // 4 + 1))
+
+
+def _bulkValue(value, fieldType):
+    """
+    Convert a Bulk API CSV value to what the REST API returns.
+    """
+    if value == '':
+        return None
+    if fieldType in ('double', 'currency', 'percent'):
+        return float(value)
+    if fieldType == 'int':
+        return int(value)
+    if fieldType == 'boolean':
+        return value == 'true'
+    if fieldType == 'datetime' and value.endswith('Z'):
+        return value[:-1] + '+0000'
+    return value
+
+
+def _bulkRecord(row, fieldTypes):
+    """
+    Convert a Bulk API CSV row to a REST API record.
+
+    Relationship columns like 'Account.Name' become nested dicts.
+    """
+    record = {}
+    for column, value in row.items():
+        path = column.split('.')
+        obj = record
+        for name in path[:-1]:
+            obj = obj.setdefault(name, {})
+        obj[path[-1]] = _bulkValue(value, fieldTypes.get(column))
+    return record
+
+
+def _fmtComment(createdDate, actorName, text):
+    """
+    Return the comment of a chatter item, for the details.
+    """
+    return {
+        'created_ts': int(util.parseTimestamp(createdDate)),
+        'actor_name': actorName or '¡Missing! actor name',
+        'text': text,
+    }
+
+
+def _fmtRecord(record, fields):
+    """
+    Map a SOQL record to a flat dict, fields maps our names to SOQL paths.
+    """
+    ns = util.getNested
+    return {name:ns(record, path) for name, path in fields.items()}
+
+
+def _isInvalidSession(resp):
+    """
+    Return True if SalesForce says the access token of resp's request expired.
+    """
+    if resp.status_code != 401:
+        return False
+    try:
+        j = resp.json()
+    except ValueError:
+        return False
+    return (type(j) == list and len(j) > 0 and type(j[0]) == dict and
+            j[0].get('errorCode') == 'INVALID_SESSION_ID')
+
+
+class HedgePolicy():
+    """
+    Duplicates slow idempotent requests, the first answer wins.
+
+    The latencies of the last window calls are kept. A call still running
+    after the recent percentile latency (but at least minDelay seconds) is
+    made once more and whichever answers first is returned; the other is
+    abandoned. At most maxHedgeRatio of the calls are duplicated, none before
+    minSamples latencies are known. Each attempt gets the remaining part of
+    deadline seconds as its timeout, TimeoutError if none answers by then.
+    The duplicates run in their own maxHedges threads, and only maxHedges
+    duplicated calls may have an attempt running, so abandoned attempts
+    never hold up other calls. Thread-safe.
+    """
+
+    def __init__(self, percentile=95, minDelay=0.5, deadline=60,
+            maxHedgeRatio=0.1, window=100, minSamples=10, maxHedges=2,
+            clock=time.monotonic):
+        import collections
+
+        self._percentile = percentile
+        self._minDelay = minDelay
+        self._deadline = deadline
+        self._maxHedgeRatio = maxHedgeRatio
+        self._minSamples = minSamples
+        self._maxHedges = maxHedges
+        self._hedgeSlots = threading.BoundedSemaphore(maxHedges)
+        self._clock = clock
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._hedgeExecutor = None
+        self.calls = 0
+        self.hedges = 0
+
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+
+    def getDelay(self):
+        """
+        Return the seconds after which a call is duplicated, None if never.
+        """
+        with self._lock:
+            if len(self._latencies) < self._minSamples:
+                return None
+            latencies = sorted(self._latencies)
+        i = min(len(latencies) - 1, len(latencies) * self._percentile // 100)
+        return max(self._minDelay, latencies[i])
+
+
+    def _getExecutors(self):
+        """
+        Return the executors for the first attempts and for the duplicates.
+        """
+        import concurrent.futures
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=8)
+                self._hedgeExecutor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self._maxHedges)
+            return self._executor, self._hedgeExecutor
+
+
+    def _releaseWhenDone(self, futures):
+        """
+        Release a hedge slot once all futures are done.
+        """
+        left = [len(futures)]
+        def onDone(future):
+            with self._lock:
+                left[0] -= 1
+                last = left[0] == 0
+            if last:
+                self._hedgeSlots.release()
+        for f in futures:
+            f.add_done_callback(onDone)
+
+
+    def call(self, fn, hedgeFn=None):
+        """
+        Return fn(timeout), or hedgeFn(timeout) (default fn) if it's faster.
+
+        If an attempt raises and the other one doesn't answer, its exception
+        is raised.
+        """
+        import concurrent.futures
+
+        start = self._clock()
+        end = start + self._deadline
+        executor, hedgeExecutor = self._getExecutors()
+        pending = [executor.submit(fn, self._deadline)]
+
+        delay = self.getDelay()
+        with self._lock:
+            self.calls += 1
+            mayHedge = (delay is not None and
+                    self.hedges < self._maxHedgeRatio * self.calls)
+        if mayHedge:
+            done, notDone = concurrent.futures.wait(pending, timeout=delay)
+            if notDone and self._hedgeSlots.acquire(blocking=False):
+                with self._lock:
+                    self.hedges += 1
+                getLogger().info('Hedging a request after %.2f seconds',
+                        delay)
+                pending.append(hedgeExecutor.submit(hedgeFn or fn,
+                    max(0, end - self._clock())))
+                self._releaseWhenDone(list(pending))
+
+        error = None
+        while pending:
+            done, notDone = concurrent.futures.wait(pending,
+                    timeout=max(0, end - self._clock()),
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break
+            for f in done:
+                pending.remove(f)
+                if f.exception() is None:
+                    for p in pending:
+                        p.cancel()
+                    self.record(self._clock() - start)
+                    return f.result()
+                if error is None:
+                    error = f.exception()
+        for p in pending:
+            p.cancel()
+        if error is not None and not pending:
+            raise error
+        raise TimeoutError('No answer in {} seconds'.format(self._deadline))
+
 
 class SClient():
     """
@@ -49,10 +374,13 @@ class SClient():
     _scopes = ['chatter_api', 'api', 'refresh_token']
 
 
-    def __init__(self, cfgFileName, tokenFileName):
+    def __init__(self, cfgFileName, tokenFileName,
+            describeCacheFileName=None):
         """
         cfgFileName - JSON file, see README.
         tokenFileName - JSON file, stores the OAuth2 Token.
+        describeCacheFileName - JSON file, caches SObject describe results.
+            Defaults to sforce-describe-cache.json next to tokenFileName.
 
         If the tokenFileName doesn't exist or has no token, the OAuth2
         authentication flow is started. This prints an authentication URL
@@ -64,6 +392,54 @@ class SClient():
         with open(cfgFileName, 'r', encoding='utf-8') as f:
             self._config = json.load(f)
         self._tokenFileName = tokenFileName
+        if describeCacheFileName is None:
+            describeCacheFileName = os.path.join(
+                    os.path.dirname(tokenFileName),
+                    'sforce-describe-cache.json')
+        self._describeCacheFileName = describeCacheFileName
+        # the describe cache file's contents, once read
+        self._describeCache = None
+
+        self.opportunityFields = OrderedDict(REQUIRED_OPPORTUNITY_FIELDS)
+        self.opportunityFields.update(self._config.get('opportunityFields',
+            DEFAULT_OPPORTUNITY_FIELDS))
+        self.opportunityChangedFields = OrderedDict(self._config.get(
+            'opportunityChangedFields', OPPORTUNITY_CHANGED_FIELDS))
+        for name in self.opportunityChangedFields:
+            if name not in self.opportunityFields:
+                raise ValueError('Changed field ' + name +
+                        ' is not in opportunityFields')
+        self._opportunityFieldsValidated = False
+        self._watchedFieldsValidated = False
+
+        self.watchedObjects = OrderedDict()
+        for name, cfg in self._config.get('watchedObjects', {}).items():
+            fields = OrderedDict(REQUIRED_WATCHED_FIELDS)
+            fields.update(cfg.get('fields', {}))
+            fields['Title'] = cfg.get('titleField',
+                    WATCHED_TITLE_FIELDS.get(name, 'Name'))
+            changedFields = OrderedDict(cfg.get('changedFields', {}))
+            for fName in changedFields:
+                if fName not in fields:
+                    raise ValueError('Changed field ' + fName + ' of ' +
+                            name + ' is not in its fields')
+            self.watchedObjects[name] = {
+                'fields': fields,
+                'changedFields': changedFields,
+                'team': cfg.get('team'),
+            }
+
+        self._hedgePolicy = None
+        hedgeCfg = self._config.get('hedgeRequests')
+        if hedgeCfg:
+            self._hedgePolicy = HedgePolicy(**(hedgeCfg
+                if type(hedgeCfg) == dict else {}))
+
+        # SClient may be used from several threads. Only one of them at a
+        # time may refresh the token, or describe or validate the fields.
+        self._tokenLock = threading.Lock()
+        self._describeLock = threading.RLock()
+
         self._ensureToken()
 
 
@@ -90,6 +466,7 @@ class SClient():
         Prints an auth url and waits for a code at stdin.
         """
         getLogger().info('Starting OAuth2 flow')
+        import requests_oauthlib
         # http://requests-oauthlib.readthedocs.org/en/latest/oauth2_workflow.html#web-application-flow
         client = requests_oauthlib.OAuth2Session(self._config['client_id'],
                 redirect_uri=self._config['redirect_uri'],
@@ -126,20 +503,13 @@ class SClient():
 
         It auto-refreshes the token and saves it.
         """
+        # Imported here, not at module level: requests_oauthlib pulls in
+        # requests, oauthlib and urllib3, which dominate our startup time.
+        import requests_oauthlib
         # http://requests-oauthlib.readthedocs.org/en/latest/oauth2_workflow.html#refreshing-tokens
         client = requests_oauthlib.OAuth2Session(self._config['client_id'],
                 token=self._token)
 
-        def refreshAndSaveToken():
-            getLogger().info('Refreshing SalesForce access token')
-            refresh_url = type(self)._tokenUri
-            refresh_kwargs = {
-                'client_id': self._config['client_id'],
-                'client_secret': self._config['client_secret'],
-            }
-            token = client.refresh_token(refresh_url, **refresh_kwargs)
-            self._saveToken(token)
-
         origRequest = client.request
 
         def autoRefreshingRequest(*args, **kwargs):
@@ -165,18 +535,10 @@ class SClient():
             result = origRequest(*args, **kwargs)
 
             # If the token is expired, refresh it and do the request again
-            if result.status_code == 401:
-                try:
-                    j = result.json()
-                except ValueError:
-                    pass
-                else:
-                    if type(j) == list and len(j):
-                        j = j[0]
-                        if (type(j) == dict and 'errorCode' in j and
-                                j['errorCode'] == 'INVALID_SESSION_ID'):
-                            refreshAndSaveToken()
-                            result = origRequest(*args, **kwargs)
+            if _isInvalidSession(result):
+                self._refreshToken(client.token['access_token'])
+                client.token = self._token
+                result = origRequest(*args, **kwargs)
 
             return result
 
@@ -184,6 +546,33 @@ class SClient():
         return client
 
 
+    def _refreshToken(self, accessToken):
+        """
+        Refresh the access token and save it.
+
+        Does nothing if it's no longer accessToken: another thread refreshed
+        it meanwhile.
+        """
+        import requests_oauthlib
+        with self._tokenLock:
+            if self._token['access_token'] != accessToken:
+                return
+            getLogger().info('Refreshing SalesForce access token')
+            client = requests_oauthlib.OAuth2Session(
+                    self._config['client_id'], token=self._token)
+            token = client.refresh_token(type(self)._tokenUri,
+                    client_id=self._config['client_id'],
+                    client_secret=self._config['client_secret'])
+            self._saveToken(token)
+
+
+    def _getSession(self):
+        """
+        Return a new session for the REST API requests.
+        """
+        return self._getOAuth2Client()
+
+
     def _getInstanceUrl(self):
         return self._token['instance_url']
 
@@ -197,7 +586,7 @@ class SClient():
         getting a token (thes instance url in returned with the token).
         Also keeps the design simpler to guarantee a token from the contructor.
         """
-        client = self._getOAuth2Client()
+        import urllib.request
         url = urljoin(self._getInstanceUrl(), '/services/data/')
         req = urllib.request.urlopen(url)
         return json.loads(req.read().decode('utf-8'))
@@ -210,33 +599,175 @@ class SClient():
         return url
 
 
+    def _get(self, client, url, **kwargs):
+        """
+        Return client.get(url, **kwargs), hedged if so configured, and the
+        session to use for the next requests.
+
+        Only for idempotent reads. With the ‘hedgeRequests’ configuration
+        (see HedgePolicy) a slow request is duplicated on a new session. If
+        the duplicate answers first, the abandoned attempt may still be
+        reading its response on client, so the duplicate's session is
+        returned to be used instead. The session which lost is closed once
+        its attempt is done.
+        """
+        if self._hedgePolicy is None:
+            return client.get(url, **kwargs), client
+
+        lock = threading.Lock()
+        # the session returned, and those whose attempt is over
+        state = {'chosen': None, 'finished': []}
+        def attempt(session, timeout):
+            try:
+                return session.get(url, timeout=timeout, **kwargs), session
+            finally:
+                with lock:
+                    state['finished'].append(session)
+                    abandoned = state['chosen'] not in (None, session)
+                if abandoned:
+                    session.close()
+
+        session = client
+        try:
+            resp, session = self._hedgePolicy.call(
+                    lambda timeout: attempt(client, timeout),
+                    lambda timeout: attempt(self._getSession(), timeout))
+        finally:
+            with lock:
+                state['chosen'] = session
+                abandoned = [s for s in state['finished'] if s is not session]
+            for s in abandoned:
+                s.close()
+        return resp, session
+
+
+    def getHedgeStats(self):
+        """
+        Return (calls, hedged calls) so far, None if hedging isn't enabled.
+        """
+        if self._hedgePolicy is None:
+            return None
+        return self._hedgePolicy.calls, self._hedgePolicy.hedges
+
+
     def getJson(self, url, params=None):
         """
         Returns the JSON from url. If relative, it's relative to the API Root.
 
         Use this to test & explore the API.
         """
-        client = self._getOAuth2Client()
+        client = self._getSession()
         url = urljoin(self._getAPIRootUrl(), url)
-        return client.get(url, params=params).json()
+        return self._get(client, url, params=params)[0].json()
+
+
+    def iterPages(self, url, params=None):
+        """
+        Yield the JSON pages from url, following nextRecordsUrl/nextPageUrl.
+
+        url is relative to the API Root like for getJson(). All pages are
+        fetched over the same connection, unless a hedged request's
+        duplicate answers first (see _get()).
+        """
+        client = self._getSession()
+        while url:
+            url = urljoin(self._getAPIRootUrl(), url)
+            resp, client = self._get(client, url, params=params)
+            resp.raise_for_status()
+            page = resp.json()
+            yield page
+            params = None
+            url = None
+            if type(page) == dict:
+                url = page.get('nextRecordsUrl') or page.get('nextPageUrl')
+
+
+    def iterRecords(self, url, params=None):
+        """
+        Yield the records (query results) or items (chatter) from iterPages().
+
+        A page with neither is yielded as a whole.
+        """
+        for page in self.iterPages(url, params=params):
+            for key in ('records', 'items', 'elements'):
+                if type(page) == dict and key in page:
+                    yield from page[key]
+                    break
+            else:
+                yield page
+
+
+    def _compositeUrl(self, url):
+        """
+        Return url (relative to the API Root) as a composite subrequest url.
+
+        Subrequest urls are absolute paths, e.g. /services/data/v32.0/query/.
+        """
+        parts = urlsplit(urljoin(self._getAPIRootUrl(), url))
+        if parts.query:
+            return parts.path + '?' + parts.query
+        return parts.path
+
+
+    def composite(self, urls):
+        """
+        GET several urls with Composite API requests, return their JSON.
+
+        https://developer.salesforce.com/docs/atlas.en-us.api_rest.meta/api_rest/resources_composite_composite.htm
+        urls is an OrderedDict mapping reference ids (letters, digits and
+        underscores) to urls relative to the API Root. They're fetched in as
+        few requests as the limits allow, usually one. Returns a dict with
+        the same keys. Raises RuntimeError if any of them fails.
+        """
+        chunks, chunk, queries = [], [], 0
+        for refId, url in urls.items():
+            isQuery = url.startswith('query')
+            if (len(chunk) >= COMPOSITE_MAX_SUBREQUESTS or
+                    (isQuery and queries >= COMPOSITE_MAX_QUERIES)):
+                chunks.append(chunk)
+                chunk, queries = [], 0
+            chunk.append({
+                'method': 'GET',
+                'url': self._compositeUrl(url),
+                'referenceId': refId,
+            })
+            queries += isQuery
+        if chunk:
+            chunks.append(chunk)
+
+        client = self._getSession()
+        url = urljoin(self._getAPIRootUrl(), 'composite')
+        result = {}
+        for chunk in chunks:
+            resp = client.post(url, json={
+                'allOrNone': False,
+                'compositeRequest': chunk,
+            })
+            resp.raise_for_status()
+            for sub in resp.json()['compositeResponse']:
+                if not 200 <= sub['httpStatusCode'] < 300:
+                    raise RuntimeError('Composite subrequest ' +
+                            sub['referenceId'] + ' failed: ' +
+                            json.dumps(sub['body']))
+                result[sub['referenceId']] = sub['body']
+        return result
 
 
     def getAvailableResources(self):
         """
         List the available API Resources.
         """
-        client = self._getOAuth2Client()
-        url = self._getAPIRootUrl()
-        # Still getting a ResourceWarning: unclosed ssl.SSLSocket when running
-        # the tests. This is probably because of a ‘connection pool’ in the
-        # ‘requests’ library, and we probably shouldn't manually close here.
-        with contextlib.closing(client.get(url)) as resp:
-            return resp.json()
+        client = self._getSession()
+        try:
+            return client.get(self._getAPIRootUrl()).json()
+        finally:
+            client.close()
 
 
     def getCompanyChatter(self, url='chatter/feeds/company/feed-items',
             maxSeconds=60*60*24*31, maxFeedItems=100, maxPages=5,
-            hardLimit=False):
+            hardLimit=False, pageSize=None, recentItemCounts=None,
+            firstPage=None):
         """
         Get chatter items and updatesUrl, stopping when any limits are reached.
 
@@ -246,41 +777,92 @@ class SClient():
         maxFeedItems or got maxPages of results.
         If hardLimit is True, drop any retrieved results which exceed these
         limits, otherwise keep them.
+        pageSize is the number of items to request per page (at most 100).
+        If not given, it's chosen from the list recentItemCounts if given (see
+        chooseChatterPageSize()), or left to the server. The number of items
+        retrieved is appended to recentItemCounts, which keeps the last 10.
+        firstPage is the JSON for url if it's already been fetched (e.g. by
+        getWatchedChanges()).
+
+        While a page is processed, the next one is fetched in the background,
+        unless this page already shows we won't need it.
         """
-        now = datetime.datetime.now().timestamp()
+        import concurrent.futures
+
+        now = time.time()
         items = []
         maxSecsExceeded = False
         pagesRetrieved = 0
         updatesUrl = None
 
-        client = self._getOAuth2Client()
-        while (url and not maxSecsExceeded and len(items) < maxFeedItems and
-                pagesRetrieved < maxPages):
+        client = self._getSession()
+        def fetch(url, params=None):
+            nonlocal client
             url = urljoin(self._getAPIRootUrl(), url)
-            data = client.get(url).json()
-            if pagesRetrieved == 0:
-                updatesUrl = data['updatesUrl']
-
-            pagesRetrieved += 1
-            for item in data['items']:
-                if hardLimit and len(items) >= maxFeedItems:
-                    break
-                then = iso8601.parse_date(item['modifiedDate']).timestamp()
-                if now - then > maxSeconds:
-                    maxSecsExceeded = True
-                if hardLimit and maxSecsExceeded:
-                    break
-                items.append(item)
+            resp, client = self._get(client, url, params=params)
+            return resp.json()
 
-            url = data['nextPageUrl']
+        def needNextPage(data):
+            """
+            Return True if the page after data is within our limits.
 
+            Items are newest first, so only the last one is checked against
+            maxSeconds.
+            """
+            if not data['nextPageUrl'] or pagesRetrieved >= maxPages:
+                return False
+            if len(items) + len(data['items']) >= maxFeedItems:
+                return False
+            if data['items']:
+                last = data['items'][-1]['modifiedDate']
+                if now - util.parseTimestamp(last) > maxSeconds:
+                    return False
+            return True
+
+        if pageSize is None and recentItemCounts is not None:
+            pageSize = chooseChatterPageSize(recentItemCounts)
+        params = {'pageSize': pageSize} if pageSize else None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            if firstPage is not None:
+                nextPage = concurrent.futures.Future()
+                nextPage.set_result(firstPage)
+            else:
+                nextPage = executor.submit(fetch, url, params)
+            while (nextPage and not maxSecsExceeded and
+                    len(items) < maxFeedItems and pagesRetrieved < maxPages):
+                data = nextPage.result()
+                if pagesRetrieved == 0:
+                    updatesUrl = data['updatesUrl']
+                pagesRetrieved += 1
+
+                nextPage = None
+                if needNextPage(data):
+                    nextPage = executor.submit(fetch, data['nextPageUrl'])
+
+                for item in data['items']:
+                    if hardLimit and len(items) >= maxFeedItems:
+                        break
+                    then = util.parseTimestamp(item['modifiedDate'])
+                    if now - then > maxSeconds:
+                        maxSecsExceeded = True
+                    if hardLimit and maxSecsExceeded:
+                        break
+                    items.append(item)
+
+        if recentItemCounts is not None:
+            recentItemCounts.append(len(items))
+            del recentItemCounts[:-10]
         return items, updatesUrl
 
 
-    def getOpportunitiesChatter(self, *args, maxOpportunities=None, **kwargs):
+    def getOpportunitiesChatter(self, *args, maxOpportunities=None,
+            skipItem=None, **kwargs):
         """
         Filter getCompanyChatter() results to opportunities & updatesUrl
 
+        If skipItem is given, it's called with each opportunity chatter item
+        and items for which it returns True are dropped. This happens before
+        any other objects are fetched for the items.
         If maxOpportunities is given, only that number of items are kept after
         filtering.
         Forwards all its other arguments to getCompanyChatter().
@@ -288,22 +870,62 @@ class SClient():
         result, updatesUrl = self.getCompanyChatter(*args, **kwargs)
         result = [x for x in result if
                 util.getNested(x, 'parent.type') == 'Opportunity']
+        if skipItem is not None:
+            result = [x for x in result if not skipItem(x)]
         if maxOpportunities is not None:
             result = result[:maxOpportunities]
         return result, updatesUrl
 
 
+    def getFeedElementComments(self, ids, batchSize=100):
+        """
+        Return {feed element id: [comment]} for the chatter items with ids.
+
+        The items are fetched batchSize at a time, with the Chatter batch
+        endpoint, so it takes a request per batch, not per item. Only their
+        first page of comments is included. Comments are dicts with
+        created_ts, actor_name and text, oldest first.
+        """
+        ns = util.getNested
+        ids = list(OrderedDict.fromkeys(ids))
+        result = {}
+        for i in range(0, len(ids), batchSize):
+            data = self.getJson('chatter/feed-elements/batch/' +
+                    ','.join(ids[i:i+batchSize]))
+            for r in data.get('results', []):
+                element = r.get('result')
+                if r.get('statusCode') != 200 or type(element) != dict:
+                    getLogger().warn('Cannot get chatter comments: %s',
+                            util.LazyJson(r))
+                    continue
+                comments = [_fmtComment(c['createdDate'],
+                    ns(c, 'user.name') or ns(c, 'user.displayName'),
+                    ns(c, 'body.text'))
+                    for c in ns(element, 'capabilities.comments.page.items')
+                    or ()]
+                result[element['id']] = sorted(comments,
+                        key=lambda c: c['created_ts'])
+        return result
+
+
     def getOpportunitiesChatterDetails(self, *args, maxTeamOpportunities=None,
-            **kwargs):
+            includeComments=False, filters=None, **kwargs):
         """
         Return custom data structures for the Opportunities chatter & updatesUrl
 
         If maxTeamOpportunities is given, keeps only so many opportunities for
-        each Futu_Team.
+        each team (the FutuTeam field).
+        If includeComments is True, the details have the item's ‘comments’,
+        see getFeedElementComments().
+        Items of opportunities not passing the filters (see
+        util.recordMatches()) are dropped as soon as the fields filtered on
+        are known: after fetching the opportunity, or its Account or Owner.
+        So their other objects and comments aren't fetched.
         Pass all other arguments to getOpportunitiesChatter(). Get additional
         objects from the API (e.g. Opportunities, Accounts, Users).
         Return a list of objects with information to display, one object for
-        each item in the opportunities chatter.
+        each item in the opportunities chatter. Opportunity fields not in
+        opportunityFields are left out, see CHATTER_DETAIL_FIELDS.
         """
         getLogger().info('Getting SalesForce opportunities chatter')
         opChatter, updatesUrl = self.getOpportunitiesChatter(*args, **kwargs)
@@ -320,18 +942,42 @@ class SClient():
             return result
 
         ns = util.getNested
+        teamPath = self._opportunityFieldPath('FutuTeam')
         opportunityIds = getSetOfNestedValues(opChatter, 'parent.id')
         getLogger().info('Getting {} SalesForce Opportunity objects'.format(
             len(opportunityIds)))
         oppById = {x:self.getOpportunity(x) for x in opportunityIds}
 
+        def passes(opC, related):
+            """
+            Return True if the item's opportunity passes the filters.
+
+            related is a dict of the Account and Owner by Id, or None if
+            they're not fetched yet.
+            """
+            opp = ns(oppById, ns(opC, 'parent.id'))
+            if not opp:
+                return True
+            record = {}
+            for name, path in self.opportunityFields.items():
+                rel, sep, rest = path.partition('.')
+                if not sep:
+                    record[name] = ns(opp, path)
+                elif related is not None and rel in related:
+                    record[name] = ns(related[rel], ns(opp, rel + 'Id', '') +
+                            '.' + rest)
+            return util.recordMatches(filters, ns(opp, teamPath, ''), record)
+
+        if filters:
+            opChatter = [x for x in opChatter if passes(x, None)]
+
         if maxTeamOpportunities is not None:
             opCountForTeam = {}
             def filterFunc(oc):
                 opp = ns(oppById, ns(oc, 'parent.id'))
                 if not opp:
                     return False
-                team = ns(opp, 'Futu_Team__c', '')
+                team = ns(opp, teamPath, '')
                 opCountForTeam[team] = 1 + (opCountForTeam[team]
                         if team in opCountForTeam else 0)
                 return opCountForTeam[team] <= maxTeamOpportunities
@@ -350,6 +996,17 @@ class SClient():
         getLogger().info('Getting {} SalesForce Users'.format(len(userIds)))
         usersById = {x:self.getUser(x) for x in userIds}
 
+        if filters:
+            related = {'Account': accById, 'Owner': usersById}
+            opChatter = [x for x in opChatter if passes(x, related)]
+
+        commentsById = None
+        if includeComments and opChatter:
+            getLogger().info('Getting comments of {} chatter items'.format(
+                len(opChatter)))
+            commentsById = self.getFeedElementComments(
+                    [x['id'] for x in opChatter])
+
         def customData(opC):
             """
             Create a custom data structure for an opportunity chatter item.
@@ -359,38 +1016,351 @@ class SClient():
             # caller. But if the fiels don't exist, the SalesForce data
             # structure is different than what we expect, so we return these
             # truthy warning strings.
-            return {
+            result = {
                 'opportunity_name': ns(opp, 'Name', 'Unknown Opportunity'),
                 'account_name': ns(accById,
                     ns(opp, 'AccountId', '') + '.Name', 'Unknown Account'),
                 'opportunity_owner': ns(usersById,
                     ns(opp, 'OwnerId', '') + '.Name', 'Unknown Owner'),
-                'stage': ns(opp, 'StageName', '¡Missing! StageName'),
-                'amount': ns(opp, 'Amount', '¡Missing! Amount'),
-                'probability': ns(opp, 'Probability', '¡Missing! Probability'),
-                'close_date': ns(opp, 'CloseDate', '¡Missing! CloseDate'),
-                'type_of_sales': ns(opp, 'Type_of_Sales__c',
-                    '¡Missing! Type_of_Sales__c'),
-                'average_hour_price': ns(opp, 'Average_Hour_Price__c',
-                    '¡Missing! Average_Hour_Price__c'),
-                'futu_team': ns(opp, 'Futu_Team__c', '¡Missing! Futu_Team__c'),
+                'opportunity_id': ns(opC, 'parent.id'),
 
+                'id': ns(opC, 'id'),
                 # not sure if the body.text is always present, so not reporting
                 # it with a warning string.
                 'text': ns(opC, 'body.text'),
-                'modified_ts': int(iso8601.parse_date(
-                    ns(opC, 'modifiedDate', 0)).timestamp()),
+                'modified_ts': int(util.parseTimestamp(
+                    ns(opC, 'modifiedDate', 0))),
                 'actor_name': ns(opC, 'actor.name', '¡Missing! actor.name'),
                 'type': ns(opC, 'type', '¡Missing! type'),
                 'preamble_text': ns(opC, 'preamble.text',
                     '¡Missing! preamble.text'),
             }
+            # fields which aren't configured are left out
+            for key, name in CHATTER_DETAIL_FIELDS.items():
+                path = self._opportunityFieldPath(name)
+                if path is not None:
+                    result[key] = ns(opp, path, '¡Missing! ' + path)
+            if commentsById is not None:
+                result['comments'] = commentsById.get(result['id'], [])
+            return result
 
         return [customData(x) for x in opChatter], updatesUrl
 
 
+    def getOpportunityFeedDetails(self, url=None, maxSeconds=60*60*24*31,
+            maxFeedItems=100, maxPages=5, maxOpportunities=None,
+            maxTeamOpportunities=None, skipItem=None, includeComments=False,
+            filters=None):
+        """
+        Like getOpportunitiesChatterDetails(), but only fetches opportunity
+        chatter, with a SOQL query over OpportunityFeed.
+
+        The opportunity fields come in the same query, so no other objects
+        are fetched. Items are read oldest first, at most maxFeedItems per
+        call. Returns the details and an updatesUrl: a query URL for the items
+        after the last one processed. Pass it as url next time. Otherwise
+        start at the items modified in the last maxSeconds. skipItem,
+        maxOpportunities, maxTeamOpportunities and includeComments work like
+        for getOpportunitiesChatterDetails(); the comments come in the same
+        query. The filters are added to the query. Items beyond
+        maxOpportunities are left for the updatesUrl; those beyond
+        maxTeamOpportunities are dropped.
+        """
+        getLogger().info('Getting SalesForce opportunity feed')
+        self._validateOpportunityFields()
+        if url is None:
+            url = self._opportunityFeedUrl(
+                    soqlDateTime(time.time() - maxSeconds), None,
+                    maxFeedItems, includeComments, filters)
+
+        startUrl = url
+        records = []
+        pagesRetrieved = 0
+        while url and pagesRetrieved < maxPages:
+            resp = self.getJson(url)
+            pagesRetrieved += 1
+            records.extend(resp['records'])
+            url = resp.get('nextRecordsUrl')
+
+        ns = util.getNested
+        def feedItem(r):
+            """
+            Return the record in the shape of a chatter API feed item.
+            """
+            return {
+                'id': r['Id'],
+                'type': r['Type'],
+                'parent': {'id': r['ParentId'], 'type': 'Opportunity'},
+                'modifiedDate': r['LastModifiedDate'],
+                'actor': {'name': ns(r, 'CreatedBy.Name')},
+                'body': {'text': r['Body']},
+                'record': r,
+            }
+        items = [feedItem(r) for r in records]
+
+        if filters:
+            # also for an updatesUrl from before the filters changed
+            def passes(item):
+                op = self._fmtOpportunity(item['record']['Parent'] or {})
+                return util.recordMatches(filters, op['FutuTeam'], op)
+        teamPath = 'Parent.' + self.opportunityFields['FutuTeam']
+        opCountForTeam = {}
+        kept = []
+        processed = 0
+        for item in items:
+            if maxOpportunities is not None and len(kept) >= maxOpportunities:
+                break
+            processed += 1
+            if skipItem is not None and skipItem(item):
+                continue
+            if filters and not passes(item):
+                continue
+            if maxTeamOpportunities is not None:
+                team = ns(item['record'], teamPath, '')
+                opCountForTeam[team] = opCountForTeam.get(team, 0) + 1
+                if opCountForTeam[team] > maxTeamOpportunities:
+                    continue
+            kept.append(item)
+
+        # The next query continues after the last item processed.
+        if processed:
+            last = items[processed - 1]
+            updatesUrl = self._opportunityFeedUrl(
+                    soqlDateTime(util.parseTimestamp(last['modifiedDate'])),
+                    last['id'], maxFeedItems, includeComments, filters)
+        else:
+            updatesUrl = startUrl
+        items = kept
+
+        def customData(item):
+            op = self._fmtOpportunity(item['record']['Parent'] or {})
+            result = {
+                'opportunity_name': op.get('Name') or 'Unknown Opportunity',
+                'account_name': op.get('AccountName') or 'Unknown Account',
+                'opportunity_owner': op.get('OwnerName') or 'Unknown Owner',
+                'opportunity_id': item['parent']['id'],
+
+                'id': item['id'],
+                'text': item['body']['text'],
+                'modified_ts': int(util.parseTimestamp(item['modifiedDate'])),
+                'actor_name': item['actor']['name'] or '¡Missing! actor.name',
+                'type': item['type'],
+                # the SOQL API has no preamble, the actor is the closest thing
+                'preamble_text': item['actor']['name'],
+            }
+            for key, name in CHATTER_DETAIL_FIELDS.items():
+                if name in op:
+                    result[key] = op[name]
+            if includeComments:
+                result['comments'] = [_fmtComment(c['CreatedDate'],
+                    ns(c, 'CreatedBy.Name'), c['CommentBody'])
+                    for c in ns(item['record'], 'FeedComments.records')
+                    or ()]
+            return result
+
+        return [customData(x) for x in items], updatesUrl
+
+
+    def _opportunityFeedUrl(self, minModified, afterId, maxFeedItems,
+            includeComments=False, filters=None):
+        """
+        Return the query URL for OpportunityFeed items of the opportunities
+        passing the filters, oldest first, starting at minModified (a SOQL
+        dateTime). If afterId is given, items modified exactly at minModified
+        must come after it in Id order.
+        """
+        fields = ['Id', 'Type', 'Body', 'LastModifiedDate', 'CreatedBy.Name',
+                'ParentId']
+        fields.extend(OrderedDict.fromkeys('Parent.' + p for n, p in
+            self.opportunityFields.items() if n != 'Id'))
+        if includeComments:
+            fields.append('(SELECT CommentBody, CreatedDate, CreatedBy.Name ' +
+                    'FROM FeedComments ORDER BY CreatedDate)')
+        q = 'SELECT ' + ','.join(fields) + ' FROM OpportunityFeed WHERE '
+        if afterId is None:
+            q += 'LastModifiedDate >= ' + minModified
+        else:
+            q += ('(LastModifiedDate > {0} OR (LastModifiedDate = {0}' +
+                    ' AND Id > {1}))').format(minModified, soqlString(afterId))
+        filterSoql = self.opportunityFilterSoql(filters, 'Parent.')
+        if filterSoql:
+            q += ' AND ' + filterSoql
+        q += (' ORDER BY LastModifiedDate ASC, Id ASC LIMIT ' +
+                str(int(maxFeedItems)))
+        return 'query/?' + urlencode({'q': q})
+
+
+    def describe(self, sobjectName):
+        """
+        Return the describe result for sobjectName, cached in a file.
+
+        Only the name, relationshipName and type of each field are kept.
+        The cache is used as is for the configured ‘describeMaxAge’ seconds
+        (default 1 day). After that it's revalidated with its ETag, which only
+        downloads the describe result again if it changed. The file is only
+        read once by each SClient.
+        """
+        with self._describeLock:
+            if self._describeCache is None:
+                try:
+                    with open(self._describeCacheFileName, 'r',
+                            encoding='utf-8') as f:
+                        self._describeCache = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    self._describeCache = {}
+            cache = self._describeCache
+
+            now = time.time()
+            maxAge = self._config.get('describeMaxAge', 60*60*24)
+            entry = cache.get(sobjectName)
+            if entry and now - entry['checked'] < maxAge:
+                return entry['describe']
+
+            headers = {}
+            if entry and entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            client = self._getSession()
+            url = urljoin(self._getAPIRootUrl(),
+                    'sobjects/' + sobjectName + '/describe')
+            resp, client = self._get(client, url, headers=headers)
+            if resp.status_code == 304 and entry:
+                getLogger().info('Describe for ' + sobjectName + ' unchanged')
+                entry['checked'] = now
+            else:
+                resp.raise_for_status()
+                getLogger().info('Caching describe for ' + sobjectName)
+                fieldKeys = ('name', 'relationshipName', 'type')
+                entry = {
+                    'etag': resp.headers.get('ETag'),
+                    'checked': now,
+                    'describe': {
+                        'name': sobjectName,
+                        'fields': [{k:f.get(k) for k in fieldKeys}
+                            for f in resp.json()['fields']],
+                    },
+                }
+                cache[sobjectName] = entry
+
+            # write to a temporary file first so other processes never read
+            # a half written cache
+            tmpFileName = self._describeCacheFileName + '.tmp'
+            with open(tmpFileName, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+            os.replace(tmpFileName, self._describeCacheFileName)
+            return entry['describe']
+
+
+    def _validateOpportunityFields(self):
+        """
+        Raise ValueError if a configured field path isn't in the describe.
+
+        See _checkFields(). Does nothing after the first successful
+        validation.
+        """
+        with self._describeLock:
+            if self._opportunityFieldsValidated:
+                return
+            self._checkFields('Opportunity', self.opportunityFields)
+            self._opportunityFieldsValidated = True
+
+
+    def _validateWatchedFields(self):
+        """
+        Like _validateOpportunityFields(), for the watchedObjects' fields.
+        """
+        with self._describeLock:
+            if self._watchedFieldsValidated:
+                return
+            for name, cfg in self.watchedObjects.items():
+                self._checkFields(name, cfg['fields'])
+            self._watchedFieldsValidated = True
+
+
+    def _checkFields(self, sobjectName, fields):
+        """
+        Raise ValueError if a path of fields (our name: SOQL path) isn't in
+        the describe result of sobjectName.
+
+        For relationship paths (e.g. Account.Name) only the first part is
+        checked.
+        """
+        describeFields = self.describe(sobjectName)['fields']
+        names = {f['name'] for f in describeFields}
+        names.update(f['relationshipName'] for f in describeFields
+                if f['relationshipName'])
+        for name, path in fields.items():
+            if path.split('.')[0] not in names:
+                raise ValueError(sobjectName + ' field ' + name + ' → ' +
+                        path + ' is not in the SalesForce describe result')
+
+
+    def _opportunityFieldPath(self, name):
+        """
+        Return the SOQL path for one of our field names or None.
+        """
+        return self.opportunityFields.get(name)
+
+
+    def opportunityFilterSoql(self, filters, prefix=''):
+        """
+        Return the ‘teamFilters’ (see util.recordMatches()) as a SOQL
+        condition, None if there are none.
+
+        prefix is the path to the Opportunity from the queried object, e.g.
+        'Parent.'. Raises ValueError for fields not in opportunityFields,
+        empty ‘in’ lists and values not fitting the field's type (see
+        soqlLiteral()). The types come from the Opportunity describe result;
+        relationship paths (e.g. Account.Name) are taken as strings.
+        """
+        teamPath = prefix + self.opportunityFields['FutuTeam']
+        fieldTypes = None
+        clauses = []
+        for team, conds in sorted((filters or {}).items()):
+            parts = []
+            for name, cond in conds.items():
+                if name not in self.opportunityFields:
+                    raise ValueError('Filter field ' + name +
+                            ' is not in opportunityFields')
+                if 'in' in cond and not cond['in']:
+                    raise ValueError('Filter field ' + name + ' of ' + team +
+                            ' has an empty ‘in’ list')
+                if fieldTypes is None:
+                    with self._describeLock:
+                        fieldTypes = {f['name']:f['type'] for f in
+                                self.describe('Opportunity')['fields']}
+                fieldType = fieldTypes.get(self.opportunityFields[name])
+                path = prefix + self.opportunityFields[name]
+                if 'in' in cond:
+                    parts.append(path + ' IN (' + ','.join(soqlLiteral(v,
+                        fieldType) for v in cond['in']) + ')')
+                if 'min' in cond:
+                    parts.append(path + ' >= ' + soqlLiteral(cond['min'],
+                        fieldType))
+                if 'max' in cond:
+                    parts.append(path + ' <= ' + soqlLiteral(cond['max'],
+                        fieldType))
+            if parts:
+                clauses.append('(' + teamPath + ' != ' + soqlString(team) +
+                        ' OR (' + ' AND '.join(parts) + '))')
+        return ' AND '.join(clauses) or None
+
+    def _fmtOpportunity(self, record):
+        """
+        Map a SOQL Opportunity record to a flat dict with our field names.
+        """
+        return _fmtRecord(record, self.opportunityFields)
+
+
     def getOpportunity(self, ID):
-        return self.getJson('sobjects/Opportunity/' + ID)
+        """
+        Get the Opportunity object, with only the fields we need.
+        """
+        self._validateOpportunityFields()
+        fields = ['AccountId', 'OwnerId']
+        fields.extend(p for p in self.opportunityFields.values()
+                if '.' not in p and p not in fields)
+        return self.getJson('sobjects/Opportunity/' + ID,
+                params={'fields': ','.join(fields)})
 
     def getAccount(self, ID):
         return self.getJson('sobjects/Account/' + ID)
@@ -405,102 +1375,461 @@ class SClient():
         If minModified is not None, only get Opportunities modified at or after
         this time.
         """
-        fields = (
-            'Id',
-            'Name',
-            'Description',
-            'Account.Name',
-            'Owner.Name',
-            'StageName',
-            'Amount',
-            'Probability',
-            'CloseDate',
-            'Type_of_Sales__c',
-            'Average_Hour_Price__c',
-            'Futu_Team__c',
-
-            'IsClosed',
-            'IsWon',
-
-            'CreatedDate',
-            'CreatedBy.Name',
-            'LastModifiedDate',
-            'LastModifiedBy.Name',
-        )
-        q = 'SELECT ' + ','.join(fields) + ' FROM Opportunity'
+        return list(self.iterOpportunities(minModified=minModified))
+
+    def iterOpportunities(self, minModified=None, resumeUrl=None,
+            onPage=None, filters=None):
+        """
+        Like getOpportunities() but yields the Opportunities page by page.
+
+        resumeUrl is a nextRecordsUrl from an earlier, interrupted iteration
+        to continue from. If SalesForce no longer accepts it, the query
+        starts over. After the records of a page have been consumed,
+        onPage(nextRecordsUrl) is called, with None after the last page.
+        With minModified, the filters (see opportunityFilterSoql()) are added
+        to the query; a full load gets all Opportunities.
+
+        A full load (no minModified or resumeUrl) of at least the configured
+        ‘bulkQueryThreshold’ Opportunities (default 10000, 0 disables it) is
+        done with a Bulk API 2.0 query job instead, see bulkQuery(). Those
+        records are not sorted, and onPage(None) is called at the end.
+        """
+        self._validateOpportunityFields()
+        if not minModified and not resumeUrl and self._useBulkQuery():
+            fields = list(OrderedDict.fromkeys(
+                self.opportunityFields.values()))
+            q = 'SELECT ' + ','.join(fields) + ' FROM Opportunity'
+            for r in self.bulkQuery(q, sobjectName='Opportunity'):
+                yield self._fmtOpportunity(r)
+            if onPage is not None:
+                onPage(None)
+            return
+
+        resp = None
+        if resumeUrl:
+            resp = self.getJson(resumeUrl)
+            if type(resp) != dict or 'records' not in resp:
+                getLogger().warn('Cannot resume the Opportunities query, ' +
+                        'starting over: %s', util.LazyJson(resp))
+                resp = None
+        if resp is None:
+            fields = list(OrderedDict.fromkeys(
+                self.opportunityFields.values()))
+            q = 'SELECT ' + ','.join(fields) + ' FROM Opportunity'
+            if minModified:
+                q += ' WHERE LastModifiedDate >= ' + minModified
+                filterSoql = self.opportunityFilterSoql(filters)
+                if filterSoql:
+                    q += ' AND ' + filterSoql
+            q += ' ORDER BY LastModifiedDate DESC'
+            resp = self.getJson('query/', params={'q': q})
+            if type(resp) != dict or 'records' not in resp:
+                raise RuntimeError('Opportunities query failed: ' +
+                        json.dumps(resp))
+        while True:
+            for r in resp['records']:
+                yield self._fmtOpportunity(r)
+            nextUrl = resp.get('nextRecordsUrl')
+            if onPage is not None:
+                onPage(nextUrl)
+            if not nextUrl:
+                break
+            resp = self.getJson(nextUrl)
+
+    def iterOpportunitiesById(self, ids, chunkSize=200):
+        """
+        Yield the Opportunities with these Ids, like iterOpportunities().
+
+        They're queried chunkSize Ids at a time.
+        """
+        self._validateOpportunityFields()
+        ids = list(OrderedDict.fromkeys(ids))
+        fields = list(OrderedDict.fromkeys(self.opportunityFields.values()))
+        for i in range(0, len(ids), chunkSize):
+            q = ('SELECT ' + ','.join(fields) + ' FROM Opportunity' +
+                    ' WHERE Id IN (' + ','.join(soqlString(x)
+                        for x in ids[i:i+chunkSize]) + ')')
+            for r in self.iterRecords('query/', params={'q': q}):
+                yield self._fmtOpportunity(r)
+
+    def countOpportunities(self, minModified=None):
+        """
+        Return how many Opportunities there are, with a COUNT() query.
+
+        If minModified is not None, only count those modified at or after
+        this time. Much cheaper than fetching them.
+        """
+        q = 'SELECT COUNT() FROM Opportunity'
+        if minModified:
+            q += ' WHERE LastModifiedDate >= ' + minModified
+        return self.getJson('query/', params={'q': q})['totalSize']
+
+    def hasOpportunityChanges(self, watermark, knownIds, filters=None):
+        """
+        Return True if an Opportunity was modified after watermark (a SOQL
+        dateTime), or at it but isn't among knownIds. Only those passing the
+        filters (see opportunityFilterSoql()) count.
+
+        knownIds are those we have with LastModifiedDate = watermark. At most
+        len(knownIds) + 1 Ids are fetched, much cheaper than the
+        Opportunities. LastModifiedDate has whole seconds, so a known
+        Opportunity modified again within the watermark's second only shows
+        once it's modified again later.
+        """
+        known = set(knownIds)
+        q = ('SELECT Id, LastModifiedDate FROM Opportunity' +
+                ' WHERE LastModifiedDate >= ' + watermark)
+        filterSoql = self.opportunityFilterSoql(filters)
+        if filterSoql:
+            q += ' AND ' + filterSoql
+        q += ' ORDER BY LastModifiedDate DESC LIMIT ' + str(len(known) + 1)
+        watermarkTs = util.parseTimestamp(watermark)
+        for r in self.getJson('query/', params={'q': q})['records']:
+            if (r['Id'] not in known or
+                    util.parseTimestamp(r['LastModifiedDate']) > watermarkTs):
+                return True
+        return False
+
+    def _useBulkQuery(self):
+        """
+        Return True if the Opportunities are many enough for a bulk query.
+        """
+        threshold = self._config.get('bulkQueryThreshold', 10000)
+        if not threshold:
+            return False
+        count = self.countOpportunities()
+        getLogger().info('%d Opportunities, bulk query threshold %d', count,
+                threshold)
+        return count >= threshold
+
+    def bulkQuery(self, soql, sobjectName=None, pollSeconds=2,
+            maxRecordsPerRequest=50000, maxWaitSeconds=None):
+        """
+        Run soql as a Bulk API 2.0 query job and yield the result records.
+
+        https://developer.salesforce.com/docs/atlas.en-us.api_asynch.meta/api_asynch/queries.htm
+        Creates the job, polls it until it's complete, then streams the CSV
+        results, maxRecordsPerRequest at a time. Records have the same shape
+        as REST query records: relationship columns (e.g. Account.Name)
+        become nested dicts and empty values None. If sobjectName is given,
+        its describe result is used to convert numbers, booleans and dates
+        from the CSV strings; otherwise all values are strings.
+        Raises RuntimeError if the job fails. If it isn't complete after
+        maxWaitSeconds (default the ‘bulkQueryMaxWait’ configuration, 900),
+        it's aborted and TimeoutError is raised.
+        """
+        import csv
+        import io
+
+        fieldTypes = {}
+        if sobjectName:
+            fieldTypes = {f['name']:f['type'] for f in
+                    self.describe(sobjectName)['fields']}
+
+        client = self._getOAuth2Client()
+        jobsUrl = urljoin(self._getAPIRootUrl(), 'jobs/query')
+        resp = client.post(jobsUrl, json={
+            'operation': 'query',
+            'query': soql,
+            'contentType': 'CSV',
+        })
+        resp.raise_for_status()
+        jobUrl = jobsUrl + '/' + resp.json()['id']
+        getLogger().info('Started bulk query job %s', jobUrl)
+
+        if maxWaitSeconds is None:
+            maxWaitSeconds = self._config.get('bulkQueryMaxWait', 900)
+        deadline = time.monotonic() + maxWaitSeconds
+        while True:
+            resp = client.get(jobUrl)
+            resp.raise_for_status()
+            job = resp.json()
+            if job['state'] == 'JobComplete':
+                break
+            if job['state'] in ('Failed', 'Aborted'):
+                raise RuntimeError('Bulk query job ' + job['state'] + ': ' +
+                        str(job.get('errorMessage')))
+            if time.monotonic() >= deadline:
+                try:
+                    client.patch(jobUrl, json={'state': 'Aborted'
+                        }).raise_for_status()
+                except:
+                    getLogger().exception('While aborting bulk query job %s:',
+                            jobUrl)
+                raise TimeoutError('Bulk query job still ' + job['state'] +
+                        ' after {} seconds'.format(maxWaitSeconds))
+            time.sleep(pollSeconds)
+        getLogger().info('Bulk query job complete, %s records',
+                job.get('numberRecordsProcessed'))
+
+        locator = None
+        while True:
+            params = {'maxRecords': maxRecordsPerRequest}
+            if locator:
+                params['locator'] = locator
+            with contextlib.closing(client.get(jobUrl + '/results',
+                    params=params, stream=True)) as resp:
+                resp.raise_for_status()
+                resp.raw.decode_content = True
+                text = io.TextIOWrapper(resp.raw, encoding='utf-8',
+                        newline='')
+                for row in csv.DictReader(text):
+                    yield _bulkRecord(row, fieldTypes)
+                locator = resp.headers.get('Sforce-Locator')
+            if not locator or locator == 'null':
+                break
+
+    def iterOpportunityChanges(self, getKnownOp, saveOp, maxTeamItems,
+            minModified=None, teamCounts=None, opportunities=None,
+            filters=None, **kwargs):
+        """
+        Yield (kind, oldOp, newOp) for new and changed Opportunities.
+
+        kind is 'new' (oldOp is None) or 'changed'. Opportunities modified at
+        or after minModified are streamed from SalesForce and compared to
+        getKnownOp(Id), which returns the known version or None. Every
+        incoming Opportunity is passed to saveOp(op) before its event is
+        yielded, whether it's new, changed or not, so nothing needs to be kept
+        in memory.
+        The events have at most maxTeamItems for each team. teamCounts, if
+        given, is the dict counting the events for each team, e.g. restored
+        when resuming. Other arguments are passed to iterOpportunities().
+        If opportunities (an iterable) is given, those are compared instead.
+        Opportunities not passing the filters (see util.recordMatches()) give
+        no event. When only those modified since minModified are queried, the
+        filters are added to the query, so the failing ones aren't fetched
+        or saved: once one passes again, it's compared to the version last
+        saved, the one its team last got.
+        """
+        ns = util.getNested
+        def opHasChanged(v1, v2):
+            for f in self.opportunityChangedFields.keys():
+                if ns(v1, f) != ns(v2, f):
+                    return True
+            return False
+
+        teamOps = teamCounts if teamCounts is not None else {}
+        if opportunities is None:
+            opportunities = self.iterOpportunities(minModified=minModified,
+                    filters=filters, **kwargs)
+        for op in opportunities:
+            team = op['FutuTeam']
+            event = None
+            if (teamOps.get(team, 0) < maxTeamItems and
+                    util.recordMatches(filters, team, op)):
+                oldOp = getKnownOp(op['Id'])
+                if oldOp is None:
+                    event = ('new', None, op)
+                elif opHasChanged(oldOp, op):
+                    event = ('changed', oldOp, op)
+                if event:
+                    teamOps[team] = teamOps.get(team, 0) + 1
+
+            saveOp(op)
+            if event:
+                yield event
+
+    def _historyFieldNames(self):
+        """
+        Return {OpportunityFieldHistory Field: our field name}.
+
+        A relationship path (e.g. Account.Name) is tracked as its
+        relationship (Account).
+        """
+        result = {}
+        for name, path in self.opportunityFields.items():
+            result.setdefault(path.split('.')[0], name)
+        return result
+
+    def getOpportunityHistoryChanges(self, maxTeamItems, minCreated,
+            excludeIds=(), filters=None):
+        """
+        Return (kind, oldOp, newOp) events from OpportunityFieldHistory.
+
+        Needs field history tracking for the opportunityChangedFields. The
+        history rows created at or after minCreated (a SOQL dateTime), except
+        those in excludeIds, are fetched with one query. The rows of an
+        opportunity with the same time and author are one edit, and each
+        edit is an event, so a field changed twice since the last call gives
+        two. newOp is the opportunity as it is now, with the edited fields
+        set to their new values and the edit's LastModifiedDate and
+        LastModifiedByName; oldOp has their old values. A 'created' row
+        gives a 'new' event. Edits of other fields are ignored. Only the
+        edited opportunities are fetched, see iterOpportunitiesById().
+
+        Returns the events, oldest first, keeping the newest maxTeamItems for
+        each team, and the (minCreated, excludeIds) for the next call.
+        The filters (see util.recordMatches()) are added to the query, so
+        the history of other opportunities isn't fetched.
+        """
+        ns = util.getNested
+        q = ('SELECT Id, OpportunityId, Field, DataType, OldValue, ' +
+                'NewValue, CreatedDate, CreatedBy.Name ' +
+                'FROM OpportunityFieldHistory ' +
+                'WHERE CreatedDate >= ' + minCreated)
+        if excludeIds:
+            q += ' AND Id NOT IN (' + ','.join(soqlString(x)
+                for x in excludeIds) + ')'
+        filterSoql = self.opportunityFilterSoql(filters, 'Opportunity.')
+        if filterSoql:
+            q += ' AND ' + filterSoql
+        q += ' ORDER BY CreatedDate, Id'
+        rows = list(self.iterRecords('query/', params={'q': q}))
+
+        fieldNames = self._historyFieldNames()
+        edits = OrderedDict()
+        for r in rows:
+            # A lookup change has a row with the Ids and one with the names.
+            if r.get('DataType') == 'EntityId':
+                continue
+            edit = edits.setdefault((r['OpportunityId'], r['CreatedDate'],
+                ns(r, 'CreatedBy.Name')), {'created': False, 'old': {},
+                    'new': {}})
+            name = fieldNames.get(r['Field'])
+            if r['Field'] == 'created':
+                edit['created'] = True
+            elif name in self.opportunityChangedFields:
+                edit['old'][name] = r['OldValue']
+                edit['new'][name] = r['NewValue']
+        edits = OrderedDict((k, e) for k, e in edits.items()
+                if e['created'] or e['new'])
+
+        current = {}
+        if edits:
+            current = {op['Id']:op for op in self.iterOpportunitiesById(
+                opId for opId, created, actor in edits)}
+        events, teamOps = [], {}
+        for (opId, created, actor), edit in reversed(edits.items()):
+            op = current.get(opId)
+            if op is None:
+                # deleted since
+                continue
+            team = op['FutuTeam']
+            if (teamOps.get(team, 0) >= maxTeamItems or
+                    not util.recordMatches(filters, team, op)):
+                continue
+            teamOps[team] = teamOps.get(team, 0) + 1
+            if edit['created']:
+                events.append(('new', None, op))
+            else:
+                newOp = dict(op, LastModifiedDate=created,
+                        LastModifiedByName=actor)
+                newOp.update(edit['new'])
+                oldOp = dict(newOp)
+                oldOp.update(edit['old'])
+                events.append(('changed', oldOp, newOp))
+        events.reverse()
+
+        # The next query starts at the second of the newest row, excluding
+        # the rows we got from that second (in this call or earlier ones).
+        if rows:
+            newestTs = int(util.parseTimestamp(rows[-1]['CreatedDate']))
+            newestIds = [r['Id'] for r in rows if
+                    int(util.parseTimestamp(r['CreatedDate'])) == newestTs]
+            if soqlDateTime(newestTs) != minCreated:
+                excludeIds = ()
+            minCreated = soqlDateTime(newestTs)
+            excludeIds = list(excludeIds) + newestIds
+        return events, (minCreated, list(excludeIds))
+
+    def _watchedQueryUrl(self, sobjectName, minModified):
+        """
+        Return the query URL for the watched records modified at or after
+        minModified (all of them if None).
+        """
+        fields = OrderedDict.fromkeys(
+                self.watchedObjects[sobjectName]['fields'].values())
+        q = 'SELECT ' + ','.join(fields) + ' FROM ' + sobjectName
         if minModified:
             q += ' WHERE LastModifiedDate >= ' + minModified
         q += ' ORDER BY LastModifiedDate DESC'
-        resp = self.getJson('query/', params={'q': q})
-        results = resp['records']
+        return 'query/?' + urlencode({'q': q})
+
+    def getWatchedChanges(self, getKnown, saveRecord, watermarks, maxItems,
+            extraUrls=None):
+        """
+        Return the new and changed records of the watched SObjects & extras.
+
+        The first page of the query for each object in watchedObjects, and
+        of each of the extraUrls (see composite()), is fetched in a single
+        Composite API request, so watching more objects costs no more round
+        trips. Only further pages are fetched separately.
+        Records modified at or after watermarks[sobjectName] are compared to
+        getKnown(sobjectName, Id) like in iterOpportunityChanges(), and each
+        is passed to saveRecord(sobjectName, record). If an object has no
+        watermark, all its records are saved but none are returned as
+        changes (first run). At most maxItems changes are kept per object.
+
+        Returns a list of (sobjectName, kind, oldRecord, newRecord) and a dict
+        with the JSON for each of extraUrls. The records' Title is their
+        ‘titleField’.
+        """
+        self._validateWatchedFields()
+        urls = OrderedDict()
+        for name in self.watchedObjects:
+            urls['watched_' + name] = self._watchedQueryUrl(name,
+                    watermarks.get(name))
+        if extraUrls:
+            urls.update(extraUrls)
+        responses = self.composite(urls)
 
-        while 'nextRecordsUrl' in resp and resp['nextRecordsUrl']:
-            # Can't test this – we get all the results in one call.
-            # But the docs describe this ‘next…’ field.
-            resp = self.getJson(resp['nextRecordsUrl'])
-            results.extend(resp['records'])
+        ns = util.getNested
+        events = []
+        for name, cfg in self.watchedObjects.items():
+            resp = responses['watched_' + name]
+            count = 0
+            while True:
+                for r in resp['records']:
+                    rec = _fmtRecord(r, cfg['fields'])
+                    oldRec = getKnown(name, rec['Id'])
+                    saveRecord(name, rec)
+                    if watermarks.get(name) is None or count >= maxItems:
+                        continue
+                    if oldRec is None:
+                        events.append((name, 'new', None, rec))
+                        count += 1
+                    elif any(ns(oldRec, f) != ns(rec, f)
+                            for f in cfg['changedFields']):
+                        events.append((name, 'changed', oldRec, rec))
+                        count += 1
+                if not resp.get('nextRecordsUrl'):
+                    break
+                resp = self.getJson(resp['nextRecordsUrl'])
 
-        def fmtObj(x):
-            return {
-                'Id':           x['Id'],
-                'Name':         x['Name'],
-                'Description':  x['Description'],
-                'AccountName':  x['Account']['Name'],
-                'OwnerName':    x['Owner']['Name'],
-                'StageName':    x['StageName'],
-                'Amount':       x['Amount'],
-                'Probability':  x['Probability'],
-                'CloseDate':    x['CloseDate'],
-                'TypeOfSales':  x['Type_of_Sales__c'],
-                'AvgHourPrice': x['Average_Hour_Price__c'],
-                'FutuTeam':     x['Futu_Team__c'],
-                'IsClosed':     x['IsClosed'],
-                'IsWon':        x['IsWon'],
-
-                'CreatedDate':  x['CreatedDate'],
-                'CreatedByName':    x['CreatedBy']['Name'],
-                'LastModifiedDate': x['LastModifiedDate'],
-                'LastModifiedByName':   x['LastModifiedBy']['Name'],
-            }
-        return [fmtObj(r) for r in results]
+        extras = {k:responses[k] for k in extraUrls or ()}
+        return events, extras
 
     def getOpportunityChanges(self, knownOpsSet, maxTeamItems):
         """
         Return allOps, newOps, changedOps.
 
         newOps and changedOps together have at most maxTeamItems for each team.
+        This keeps all Opportunities in memory, see iterOpportunityChanges()
+        for an alternative.
+        If hasOpportunityChanges() shows nothing was modified since the newest
+        known Opportunity, they aren't fetched.
         """
         latestModified, latestModifiedTs = None, 0
         for op in knownOpsSet.values():
-            opTs = iso8601.parse_date(op['LastModifiedDate']).timestamp()
+            opTs = util.parseTimestamp(op['LastModifiedDate'])
             if opTs > latestModifiedTs:
                 latestModified = op['LastModifiedDate']
                 latestModifiedTs = opTs
-        incoming = self.getOpportunities(minModified=latestModified)
 
-        ns = util.getNested
-        def opHasChanged(v1, v2):
-            for f in OPPORTUNITY_CHANGED_FIELDS.keys():
-                if ns(v1, f) != ns(v2, f):
-                    return True
-            return False
+        if latestModified is not None:
+            atLatest = [op['Id'] for op in knownOpsSet.values() if
+                    util.parseTimestamp(op['LastModifiedDate']) ==
+                    latestModifiedTs]
+            if not self.hasOpportunityChanges(latestModified, atLatest):
+                return list(knownOpsSet.values()), [], []
 
         # don't modify the caller's object, copy it
         allOps = {k:v for k, v in knownOpsSet.items()}
+        def saveOp(op):
+            allOps[op['Id']] = op
         newOps, changedOps = [], []
-        teamOps = {}
-        for op in incoming:
-            opId = op['Id']
-            team = op['FutuTeam']
-
-            if teamOps.get(team, 0) < maxTeamItems:
-                if opId not in allOps:
-                    teamOps[team] = teamOps.get(team, 0) + 1
-                    newOps.append(op)
-                elif opHasChanged(allOps[opId], op):
-                    teamOps[team] = teamOps.get(team, 0) + 1
-                    changedOps.append(op)
-
-            allOps[opId] = op
+        for kind, oldOp, op in self.iterOpportunityChanges(allOps.get, saveOp,
+                maxTeamItems, minModified=latestModified):
+            (newOps if kind == 'new' else changedOps).append(op)
 
         return list(allOps.values()), newOps, changedOps
@@ -0,0 +1,66 @@
+import os.path
+import sqlite3
+import tempfile
+import unittest
+
+from s2f.archive import HistoryArchive
+
+
+class TestHistoryArchive(unittest.TestCase):
+
+    def testQuery(self):
+        def op(modified):
+            return {'Id': '006a', 'FutuTeam': 'A', 'Name': 'Deal',
+                    'CreatedDate': '2015-03-01T00:00:00.000+0000',
+                    'CreatedByName': 'Ann', 'LastModifiedDate': modified,
+                    'LastModifiedByName': 'Bob'}
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, 'history.sqlite')
+            archive = HistoryArchive(fileName)
+            archive.addOpportunityChange('new', None,
+                    op('2015-03-01T00:00:00.000+0000'))
+            archive.addOpportunityChange('changed', op('x'),
+                    op('2015-03-10T00:00:00.000+0000'))
+            archive.addChatterDetail({'id': 'f1', 'opportunity_id': '006b',
+                'futu_team': 'B', 'modified_ts': 1425945600,
+                'actor_name': 'Cid', 'text': 'Hi'})
+            archive.close()
+
+            archive = HistoryArchive(fileName)
+            events = archive.query(recordId='006a')
+            self.assertEqual([e['kind'] for e in events], ['new', 'changed'])
+            self.assertEqual(events[0]['actor'], 'Ann')
+            self.assertEqual(events[1]['data']['old']['LastModifiedDate'],
+                    'x')
+            self.assertEqual([e['kind'] for e in archive.query(
+                since=1425168000 + 1)], ['changed', 'chatter'])
+            self.assertEqual([e['recordId'] for e in archive.query(team='B')],
+                    ['006b'])
+            self.assertEqual(len(archive.query(limit=1)), 1)
+            archive.close()
+
+    def testResumedRunAddsNothingTwice(self):
+        op = {'Id': '006a', 'FutuTeam': 'A', 'CreatedDate':
+                '2015-03-01T00:00:00.000+0000', 'CreatedByName': 'Ann'}
+        chatter = {'id': 'f1', 'opportunity_id': '006a', 'futu_team': 'A',
+                'modified_ts': 1425945600, 'actor_name': 'Cid'}
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, 'history.sqlite')
+            # an archive from before events had keys
+            conn = sqlite3.connect(fileName)
+            conn.execute('CREATE TABLE events (id INTEGER PRIMARY KEY, ' +
+                    'recordId TEXT NOT NULL, sobject TEXT NOT NULL, ' +
+                    'team TEXT, ts REAL NOT NULL, kind TEXT NOT NULL, ' +
+                    'actor TEXT, data TEXT NOT NULL)')
+            conn.commit()
+            conn.close()
+
+            for i in range(2):
+                archive = HistoryArchive(fileName)
+                archive.addOpportunityChange('new', None, op)
+                archive.addChatterDetail(chatter)
+                archive.close()
+            archive = HistoryArchive(fileName)
+            self.assertEqual([e['kind'] for e in archive.query()],
+                    ['new', 'chatter'])
+            archive.close()
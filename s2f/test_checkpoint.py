@@ -0,0 +1,36 @@
+import os.path
+import tempfile
+import unittest
+
+from s2f.checkpoint import Checkpoint
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def testResumeAndClear(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, 'checkpoint.json')
+            cp = Checkpoint(fileName)
+            self.assertIs(cp.get('a'), None)
+            cp.set('a', 1)
+            cp.update({'b': [2], 'c': None})
+            cp.markPosted('x')
+            cp.markPosted('x')
+            cp.addQueued({'key': 'q1'})
+            cp.addQueued({'key': 'q2'})
+            with open(fileName + '.posted', 'a', encoding='utf-8') as f:
+                f.write('"cut sho')
+
+            cp = Checkpoint(fileName)
+            self.assertEqual(cp.get('a'), 1)
+            self.assertEqual(cp.get('b'), [2])
+            self.assertTrue(cp.isPosted('x'))
+            self.assertFalse(cp.isPosted('y'))
+            self.assertEqual(cp.getQueued(), [{'key': 'q1'}, {'key': 'q2'}])
+
+            cp.clear()
+            self.assertFalse(os.path.exists(fileName))
+            self.assertFalse(os.path.exists(fileName + '.posted'))
+            self.assertFalse(os.path.exists(fileName + '.queued'))
+            self.assertIs(Checkpoint(fileName).get('a'), None)
+            cp.clear()
@@ -0,0 +1,71 @@
+import os.path
+import tempfile
+import unittest
+
+from s2f import dedup
+
+
+class TestDedup(unittest.TestCase):
+
+    def testBoundedIndex(self):
+        idx = dedup.BoundedIndex(['a', 'b'], maxSize=2)
+        self.assertIn('a', idx)
+        idx.add('a')
+        idx.add('c')
+        self.assertNotIn('b', idx)
+        self.assertEqual(idx.toJson(), ['a', 'c'])
+        self.assertRaises(ValueError, dedup.BoundedIndex, maxSize=0)
+
+    def testEventIndex(self):
+        idx = dedup.EventIndex()
+        idx.addOpportunityChange({
+            'Id': 'op1',
+            'LastModifiedDate': '2015-03-10T12:00:00.000+0000',
+            'LastModifiedByName': 'Ann',
+        })
+        item = {
+            'type': 'TrackedChange',
+            'parent': {'id': 'op1', 'type': 'Opportunity'},
+            'modifiedDate': '2015-03-10T12:00:02.000Z',
+            'actor': {'name': 'Ann'},
+        }
+        self.assertTrue(idx.hasChatterChange(item))
+        self.assertFalse(idx.hasChatterChange(dict(item, type='TextPost')))
+        self.assertFalse(idx.hasChatterChange(dict(item,
+            actor={'name': 'Bob'})))
+        self.assertFalse(idx.hasChatterChange(dict(item,
+            modifiedDate='2015-03-10T12:01:00.000Z')))
+
+    def testPostedEvents(self):
+        idx = dedup.EventIndex()
+        chatter = {'type': 'chatter', 'sobject': 'Opportunity',
+                'itemType': 'TrackedChange', 'opportunityId': 'op1',
+                'modifiedTs': 1426089601, 'actorName': 'Ann'}
+        self.assertFalse(idx.hasChatterEvent(chatter))
+        idx.addPostedEvent({'type': 'chatter', 'sobject': 'Opportunity'})
+        idx.addPostedEvent({'type': 'changed', 'sobject': 'Opportunity',
+            'record': {
+                'Id': 'op1',
+                'LastModifiedDate': '2015-03-11T16:00:00.000+0000',
+                'LastModifiedByName': 'Ann',
+            }})
+        self.assertEqual(len(idx), 1)
+        self.assertTrue(idx.hasChatterEvent(chatter))
+        self.assertFalse(idx.hasChatterEvent(dict(chatter,
+            itemType='TextPost')))
+        self.assertFalse(idx.hasChatterEvent(None))
+
+    def testSeenItems(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, 'seen.json')
+            seen = dedup.SeenItems.fromFile(fileName)
+            self.assertEqual(len(seen), 0)
+            seen.addDetail({'id': 'f1', 'modified_ts': 60})
+            seen.saveFile(fileName)
+
+            seen = dedup.SeenItems.fromFile(fileName)
+            item = {'id': 'f1', 'modifiedDate': '1970-01-01T00:01:00.000Z'}
+            self.assertTrue(seen.hasItem(item))
+            self.assertFalse(seen.hasItem(dict(item, id='f2')))
+            self.assertFalse(seen.hasItem(dict(item,
+                modifiedDate='1970-01-01T00:02:00.000Z')))
@@ -0,0 +1,78 @@
+import os.path
+import tempfile
+import unittest
+
+from s2f import lanes
+from s2f.checkpoint import Checkpoint
+
+
+def message(kind, changedFields=()):
+    return {'teamName': 'T', 'subject': kind, 'textContent': '',
+            'event': {'type': kind, 'sobject': 'Opportunity',
+                'changedFields': list(changedFields)}}
+
+
+class TestPostingQueue(unittest.TestCase):
+
+    def testPriorityOrder(self):
+        queue = lanes.PostingQueue()
+        queue.add('a', message('chatter'))
+        queue.add('b', message('changed', ['Amount']))
+        queue.add('c', message('changed', ['StageName']))
+        queue.add('d', message('new'))
+        self.assertFalse(queue.add('a', message('chatter')))
+
+        posted = []
+        self.assertEqual(queue.drain(lambda m: posted.append(m['subject'])),
+                [])
+        self.assertEqual(posted, ['changed', 'new', 'changed', 'chatter'])
+        self.assertEqual(len(queue), 0)
+
+    def testDeadline(self):
+        now = [0]
+        def post(m):
+            now[0] += 1
+            return True
+        done = []
+        queue = lanes.PostingQueue(rules=[])
+        for key in 'abc':
+            queue.add(key, message('new'), onDone=lambda k=key: done.append(k))
+        deferred = queue.drain(post, deadline=2, clock=lambda: now[0])
+        self.assertEqual([d['key'] for d in deferred], ['c'])
+        # not for the deferred one
+        self.assertEqual(done, ['a', 'b'])
+
+        queue = lanes.PostingQueue()
+        queue.addAll(deferred)
+        self.assertEqual([d['key'] for d in queue.toJson()], ['c'])
+
+    def testOnDoneOnlyWhenPosted(self):
+        done = []
+        queue = lanes.PostingQueue(rules=[])
+        for key in ('posted', 'spooled', 'failed'):
+            queue.add(key, message(key), onDone=lambda k=key: done.append(k))
+        def post(m):
+            if m['subject'] == 'failed':
+                raise RuntimeError('failed')
+            return m['subject'] == 'posted'
+        queue.drain(post)
+        self.assertEqual(done, ['posted'])
+
+    def testCheckpoint(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, 'checkpoint.json')
+            queue = lanes.PostingQueue(checkpoint=Checkpoint(fileName))
+            queue.add('a', message('new'))
+            queue.add('b', message('chatter'))
+            # out of time after posting the first one
+            now = iter([0, 1])
+            queue.drain(lambda m: None, deadline=1, clock=lambda: next(now))
+
+            checkpoint = Checkpoint(fileName)
+            self.assertEqual([d['key'] for d in checkpoint.getQueued()],
+                    ['a', 'b'])
+            queue = lanes.PostingQueue(checkpoint=checkpoint)
+            queue.resume()
+            self.assertEqual([d['key'] for d in queue.toJson()], ['b'])
+            # resuming doesn't queue them in the checkpoint again
+            self.assertEqual(len(Checkpoint(fileName).getQueued()), 2)
@@ -0,0 +1,47 @@
+import io
+import json
+import logging
+import unittest
+
+from s2f import logqueue, util
+
+
+class TestLogQueue(unittest.TestCase):
+
+    def testTruncate(self):
+        self.assertEqual(util.truncate('abc', 3), 'abc')
+        self.assertEqual(util.truncate('abcd', 3), 'abc… (1 more characters)')
+
+    def testFormatters(self):
+        record = logging.LogRecord('s2f', logging.INFO, __file__, 1,
+                'Posting %s', (util.LazyJson({'a': 'x' * 20}),), None)
+        txt = logqueue.TruncatingFormatter('%(message)s',
+                maxLength=10).format(record)
+        self.assertEqual(txt, 'Posting {"… (27 more characters)')
+
+        line = logqueue.JsonLinesFormatter(maxLength=100).format(record)
+        data = json.loads(line)
+        self.assertEqual(data['level'], 'INFO')
+        self.assertEqual(data['message'], 'Posting {"a": "' + 'x' * 20 + '"}')
+
+    def testQueueLogging(self):
+        rootL = logging.getLogger()
+        oldHandlers = list(rootL.handlers)
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logqueue.JsonLinesFormatter())
+        errStream = io.StringIO()
+        errHandler = logging.StreamHandler(errStream)
+        errHandler.setLevel(logging.ERROR)
+        listener = logqueue.setupQueueLogging(handler, errHandler)
+        try:
+            logging.getLogger('s2f.test').warning('hello %s', 'world')
+        finally:
+            listener.stop()
+            for h in list(rootL.handlers):
+                rootL.removeHandler(h)
+            for h in oldHandlers:
+                rootL.addHandler(h)
+        self.assertEqual(json.loads(stream.getvalue())['message'],
+                'hello world')
+        self.assertEqual(errStream.getvalue(), '')
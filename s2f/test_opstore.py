@@ -0,0 +1,68 @@
+import json
+import os.path
+import tempfile
+import unittest
+
+from s2f.opstore import OpportunityStore
+
+
+def op(opId, modified, name='Op'):
+    return {
+        'Id': opId,
+        'Name': name,
+        'LastModifiedDate': modified,
+    }
+
+
+class TestOpportunityStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.fileName = os.path.join(self.tmpDir.name, 'ops.sqlite')
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def testPutGet(self):
+        store = OpportunityStore(self.fileName)
+        self.assertTrue(store.isEmpty())
+        self.assertIs(store.latestModified(), None)
+        store.put(op('a', '2015-01-02T00:00:00.000+0000'))
+        store.put(op('b', '2015-01-01T00:00:00.000+0000'))
+        store.put(op('b', '2015-01-03T00:00:00.000+0000', 'New'))
+        store.setMeta('watermark', 'w')
+        store.close()
+
+        store = OpportunityStore(self.fileName)
+        self.assertFalse(store.isEmpty())
+        self.assertEqual(store.get('b')['Name'], 'New')
+        self.assertIs(store.get('c'), None)
+        self.assertEqual(store.latestModified(),
+                '2015-01-03T00:00:00.000+0000')
+        self.assertEqual(store.getMeta('watermark'), 'w')
+        self.assertIs(store.getMeta('missing'), None)
+        self.assertEqual(store.idsModifiedAt(
+            '2015-01-02T00:00:00.000+0000'), ['a'])
+        store.close()
+
+    def testCommitsOnlyWhenAsked(self):
+        store = OpportunityStore(self.fileName)
+        for i in range(2000):
+            store.put(op(str(i), '2015-01-02T00:00:00.000+0000'))
+        other = OpportunityStore(self.fileName)
+        self.assertTrue(other.isEmpty())
+        store.commit()
+        self.assertEqual(other.get('1999')['Id'], '1999')
+        other.close()
+        store.close()
+
+    def testImportJsonFile(self):
+        jsonFileName = os.path.join(self.tmpDir.name, 'ops.json')
+        with open(jsonFileName, 'w', encoding='utf-8') as f:
+            json.dump([op('a', '2015-01-02T00:00:00.000+0000')], f)
+        store = OpportunityStore(self.fileName)
+        store.importJsonFile(jsonFileName)
+        self.assertEqual(store.get('a')['Id'], 'a')
+        self.assertEqual(store.getMeta('watermark'),
+                '2015-01-02T00:00:00.000+0000')
+        store.close()
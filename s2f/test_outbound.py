@@ -0,0 +1,57 @@
+import unittest
+
+from s2f import outbound
+
+
+MESSAGE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+    xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+ <soapenv:Body>
+  <notifications xmlns="http://soap.sforce.com/2005/09/outbound">
+   <OrganizationId>00D000000000001AAA</OrganizationId>
+   <ActionId>04k000000000001AAA</ActionId>
+   <SessionId xsi:nil="true"/>
+   <Notification>
+    <Id>04l000000000001AAA</Id>
+    <sObject xsi:type="sf:Opportunity"
+        xmlns:sf="urn:sobject.enterprise.soap.sforce.com">
+     <sf:Id>006000000000001AAA</sf:Id>
+     <sf:StageName>Closed Won</sf:StageName>
+     <sf:Description xsi:nil="true"/>
+    </sObject>
+   </Notification>
+  </notifications>
+ </soapenv:Body>
+</soapenv:Envelope>'''
+
+
+class TestOutbound(unittest.TestCase):
+
+    def testParse(self):
+        msg = outbound.parseOutboundMessage(MESSAGE)
+        self.assertEqual(msg['organizationId'], '00D000000000001AAA')
+        self.assertEqual(msg['notifications'], [{
+            'id': '04l000000000001AAA',
+            'sobject': 'Opportunity',
+            'fields': {'Id': '006000000000001AAA',
+                'StageName': 'Closed Won', 'Description': None},
+        }])
+        with self.assertRaises(ValueError):
+            outbound.parseOutboundMessage(b'<a/>')
+
+    def testReceiveAndReplay(self):
+        receiver = outbound.OutboundReceiver(host='localhost',
+                organizationId='00D000000000001')
+        receiver.start()
+        try:
+            url = 'http://localhost:{}/'.format(receiver.port)
+            self.assertEqual(outbound.replay(url, [MESSAGE, MESSAGE,
+                b'junk', MESSAGE.replace(b'00D0', b'00DX')]),
+                [200, 200, 400, 403])
+            batch = receiver.getBatch(timeout=1)
+            self.assertEqual([n['fields']['Id'] for n in batch],
+                    ['006000000000001AAA'] * 2)
+            self.assertEqual(receiver.getBatch(timeout=0), [])
+        finally:
+            receiver.stop()
@@ -0,0 +1,133 @@
+import json
+import os.path
+import runpy
+import tempfile
+import unittest
+
+import s2f.flowdock
+import s2f.s2f
+from s2f import sforce
+from s2f.opstore import OpportunityStore
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WATERMARK = '2015-03-10T12:00:00.000+0000'
+
+
+def op(stage, modified):
+    return {'Id': 'a', 'Name': 'Op a', 'FutuTeam': 'T', 'StageName': stage,
+            'CreatedDate': WATERMARK, 'CreatedByName': 'Ann',
+            'LastModifiedDate': modified, 'LastModifiedByName': 'Ann'}
+
+
+class FakeSClient(sforce.SClient):
+
+    def __init__(self):
+        self.opportunityFields = dict(sforce.REQUIRED_OPPORTUNITY_FIELDS)
+        self.opportunityChangedFields = {'StageName': 'Stage'}
+        self.watchedObjects = {}
+
+    def iterOpportunitiesById(self, ids):
+        return [op('Won', '2015-03-10T12:00:05.000+0000')]
+
+    def hasOpportunityChanges(self, watermark, knownIds, filters=None):
+        raise RuntimeError('SalesForce is down')
+
+
+class FakeFClient():
+    """
+    Spools every message while failing, like an open circuit breaker.
+    """
+
+    def __init__(self, failing):
+        self.failing = failing
+        self.posted = []
+        self.spooled = []
+
+    def getTeamTzName(self, teamName):
+        return 'UTC'
+
+    def close(self):
+        pass
+
+    def postToInbox(self, **message):
+        if self.failing:
+            self.spooled.append(dict(message, flowName=message['teamName'],
+                fanOut=False))
+            return False
+        self.posted.append(message['subject'])
+        return True
+
+
+class TestPostToFlowdock(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.oldClients = sforce.SClient, s2f.flowdock.FClient
+        sforce.SClient = lambda *args: FakeSClient()
+        script = runpy.run_path(os.path.join(REPO_DIR, 'post-to-flowdock.py'),
+                run_name='post_to_flowdock')
+        self.postNotifications = script['postNotifications']
+        self.postNewActivity = script['postNewActivity']
+
+    def tearDown(self):
+        sforce.SClient, s2f.flowdock.FClient = self.oldClients
+        self.tmpDir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpDir.name, name)
+
+    def loadState(self):
+        with open(self.path('state.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def saveOpportunity(self):
+        with open(self.path('limits.json'), 'w', encoding='utf-8') as f:
+            json.dump({'maxTeamOpportunities': 10}, f)
+        store = OpportunityStore(self.path('known-opportunities.sqlite'))
+        store.put(op('Open', WATERMARK))
+        store.setMeta('watermark', WATERMARK)
+        store.close()
+
+    def testSpoolsWhileFlowFails(self):
+        self.saveOpportunity()
+        notifications = [{'id': 'n1', 'sobject': 'Opportunity',
+            'fields': {'Id': 'a', 'StageName': 'Won'}}]
+
+        fClient = FakeFClient(failing=True)
+        s2f.flowdock.FClient = lambda *args: fClient
+        self.postNotifications(self.tmpDir.name, notifications)
+        self.assertEqual([m['subject'] for m in
+            self.loadState()['spooledMessages']],
+                ['[updated] Op a — Ann'])
+
+        # the same notification again: the store already has the change
+        fClient = FakeFClient(failing=False)
+        s2f.flowdock.FClient = lambda *args: fClient
+        self.postNotifications(self.tmpDir.name, notifications)
+        self.assertEqual(fClient.posted, ['[updated] Op a — Ann'])
+        self.assertNotIn('spooledMessages', self.loadState())
+
+
+    def testSavesStateWhenFailing(self):
+        self.saveOpportunity()
+        message = {'teamName': 'T', 'subject': 'spooled',
+                'textContent': '', 'flowName': 'T', 'fanOut': False}
+        with open(self.path('state.json'), 'w', encoding='utf-8') as f:
+            json.dump({'updatesUrl': 'updates',
+                'spooledMessages': [message],
+                'deferredMessages': [{'key': 'k', 'priority': 1,
+                    'message': dict(message, subject='deferred')}]}, f)
+
+        fClient = FakeFClient(failing=False)
+        s2f.flowdock.FClient = lambda *args: fClient
+        with self.assertRaisesRegex(RuntimeError, 'SalesForce is down'):
+            self.postNewActivity(self.tmpDir.name)
+        self.assertEqual(fClient.posted, ['spooled', 'deferred'])
+        state = self.loadState()
+        # posted: not in the state to be posted again
+        self.assertNotIn('spooledMessages', state)
+        self.assertNotIn('deferredMessages', state)
+        self.assertEqual(state['updatesUrl'], 'updates')
+        self.assertIn('eventIndex', state)
@@ -0,0 +1,360 @@
+import json
+import os.path
+import tempfile
+import threading
+import unittest
+
+import s2f.s2f
+from s2f import sforce
+from s2f.checkpoint import Checkpoint
+from s2f.opstore import OpportunityStore
+
+
+WATERMARK = '2015-03-10T12:00:00.000+0000'
+
+
+def op(opId, modified):
+    return {'Id': opId, 'Name': 'Op ' + opId, 'Description': None,
+            'AccountName': 'ACME', 'OwnerName': 'Ann', 'StageName': 'Open',
+            'Amount': 1000, 'Probability': 10, 'CloseDate': '2015-04-01',
+            'TypeOfSales': None, 'AvgHourPrice': None, 'FutuTeam': 'T',
+            'IsClosed': False, 'IsWon': False, 'CreatedDate': modified,
+            'CreatedByName': 'Ann', 'LastModifiedDate': modified,
+            'LastModifiedByName': 'Ann'}
+
+
+class FakeSClient(sforce.SClient):
+
+    def __init__(self):
+        self.opportunityFields = dict(sforce.REQUIRED_OPPORTUNITY_FIELDS)
+        self.opportunityChangedFields = {'StageName': 'Stage'}
+        self.watchedObjects = {}
+        self.queries = []
+
+    def iterOpportunities(self, minModified=None, resumeUrl=None,
+            onPage=None, filters=None):
+        self.queries.append((minModified, resumeUrl))
+        yield op('b', '2015-03-10T12:00:05.000+0000')
+        onPage(None)
+
+    def getHedgeStats(self):
+        return None
+
+
+class PhasedSClient(FakeSClient):
+    """
+    Records whether the chatter was fetched while the opportunities were.
+    """
+
+    def __init__(self, chatter=(), opportunityError=None, chatterError=None):
+        super().__init__()
+        self.chatter = list(chatter)
+        self.opportunityError = opportunityError
+        self.chatterError = chatterError
+        self.chatterFetched = threading.Event()
+        self.overlapped = None
+
+    def hasOpportunityChanges(self, watermark, knownIds, filters=None):
+        return True
+
+    def iterOpportunities(self, minModified=None, resumeUrl=None,
+            onPage=None, filters=None):
+        self.overlapped = self.chatterFetched.wait(5)
+        yield op('b', '2015-03-10T12:00:05.000+0000')
+        if self.opportunityError is not None:
+            # fetching the next page failed
+            raise self.opportunityError
+        onPage(None)
+
+    def getOpportunitiesChatterDetails(self, **kwargs):
+        self.chatterFetched.set()
+        if self.chatterError is not None:
+            raise self.chatterError
+        return self.chatter, 'updates'
+
+
+class WatchedSClient(PhasedSClient):
+    """
+    Watches Cases, recording the extra urls fetched with them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chatterFetched.set()
+        self.watchedObjects = {'Case': {}}
+        self.extraUrls = None
+
+    def getWatchedChanges(self, getKnown, saveRecord, watermarks, maxItems,
+            extraUrls=None):
+        self.extraUrls = extraUrls
+        return [], {k:{} for k in extraUrls}
+
+
+def chatterDetail(itemId, itemType, actorName, text):
+    return {'id': itemId, 'type': itemType, 'actor_name': actorName,
+            'text': text, 'opportunity_id': 'b', 'opportunity_name': 'Op b',
+            'account_name': 'ACME', 'opportunity_owner': 'Ann',
+            'futu_team': 'T', 'preamble_text': actorName,
+            # the time of op('b', …) above
+            'modified_ts': 1425988805}
+
+
+class FakeFClient():
+
+    def __init__(self):
+        self.posted = []
+        self.spooled = []
+
+    def getTeamTzName(self, teamName):
+        return 'UTC'
+
+    def close(self):
+        pass
+
+    def postToInbox(self, **message):
+        self.posted.append(message['subject'])
+        return True
+
+    def getBreakerStates(self):
+        return {}
+
+
+class TestPostNewActivity(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.sClient = FakeSClient()
+        self.fClient = FakeFClient()
+        self.oldClients = sforce.SClient, s2f.flowdock.FClient
+        sforce.SClient = lambda *args: self.sClient
+        s2f.flowdock.FClient = lambda *args: self.fClient
+
+    def tearDown(self):
+        sforce.SClient, s2f.flowdock.FClient = self.oldClients
+        self.tmpDir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpDir.name, name)
+
+    def testResumeFromCheckpoint(self):
+        with open(self.path('limits.json'), 'w', encoding='utf-8') as f:
+            json.dump({'maxTeamOpportunities': 10}, f)
+        store = OpportunityStore(self.path('ops.sqlite'))
+        store.put(op('a', WATERMARK))
+        store.setMeta('watermark', WATERMARK)
+        store.close()
+
+        # the run stopped after posting the first queued message
+        checkpoint = Checkpoint(self.path('checkpoint.json'))
+        checkpoint.update({
+            'opportunitiesNextUrl': 'page2',
+            'opportunityTeamCounts': {'T': 1},
+            'chatter': {'items': [], 'updatesUrl': 'saved-updates'},
+        })
+        for k in ('posted', 'left'):
+            checkpoint.addQueued({'key': k, 'priority': 1, 'message': {
+                'teamName': 'T', 'subject': k, 'textContent': ''}})
+        checkpoint.markPosted('posted')
+
+        updatesUrl = s2f.s2f.postNewActivity('sforce.json', 'token.json',
+                'flowdock.json', self.path('limits.json'),
+                self.path('ops.sqlite'), startUrl='old-updates', state={},
+                checkpointFileName=self.path('checkpoint.json'))
+        self.assertEqual(updatesUrl, 'saved-updates')
+        self.assertEqual(self.sClient.queries, [(WATERMARK, 'page2')])
+        self.assertEqual(self.fClient.posted, ['Op b — Ann', 'left'])
+        store = OpportunityStore(self.path('ops.sqlite'))
+        self.assertEqual(store.getMeta('watermark'),
+                '2015-03-10T12:00:05.000+0000')
+        store.close()
+
+    def postNewActivity(self, state=None):
+        with open(self.path('limits.json'), 'w', encoding='utf-8') as f:
+            json.dump({'maxTeamOpportunities': 10, 'maxSeconds': 3600,
+                'maxPages': 1}, f)
+        store = OpportunityStore(self.path('ops.sqlite'))
+        store.put(op('a', WATERMARK))
+        store.setMeta('watermark', WATERMARK)
+        store.close()
+        return s2f.s2f.postNewActivity('sforce.json', 'token.json',
+                'flowdock.json', self.path('limits.json'),
+                self.path('ops.sqlite'), state={} if state is None else state,
+                checkpointFileName=self.path('checkpoint.json'),
+                watchedObjectsDir=self.tmpDir.name)
+
+    def testPhasesOverlapAndDedup(self):
+        self.sClient = PhasedSClient([
+            chatterDetail('f1', 'TrackedChange', 'Ann', None),
+            chatterDetail('f2', 'TextPost', 'Bob', 'Hi'),
+        ])
+        self.assertEqual(self.postNewActivity(), 'updates')
+        self.assertTrue(self.sClient.overlapped)
+        # the tracked change of the opportunity change posted is dropped
+        self.assertEqual(self.fClient.posted,
+                ['Op b — Ann', '[chatter] Op b – Bob'])
+
+    def testChatterFailureStillPostsOpportunities(self):
+        self.sClient = PhasedSClient(chatterError=RuntimeError('chatter'))
+        with self.assertRaisesRegex(RuntimeError, 'chatter'):
+            self.postNewActivity()
+        self.assertEqual(self.fClient.posted, ['Op b — Ann'])
+        checkpoint = Checkpoint(self.path('checkpoint.json'))
+        self.assertTrue(checkpoint.get('opportunitiesDone'))
+        self.assertTrue(checkpoint.isPosted(
+            'opportunity|b|2015-03-10T12:00:05.000+0000'))
+
+    def testOpportunityFailureStillCheckpointsChatter(self):
+        self.sClient = PhasedSClient(
+                [chatterDetail('f2', 'TextPost', 'Bob', 'Hi')],
+                opportunityError=RuntimeError('opportunities'))
+        with self.assertRaisesRegex(RuntimeError, 'opportunities'):
+            self.postNewActivity()
+        # the opportunity queued before the failure is posted
+        self.assertEqual(self.fClient.posted, ['Op b — Ann'])
+        checkpoint = Checkpoint(self.path('checkpoint.json'))
+        self.assertFalse(checkpoint.get('opportunitiesDone'))
+        self.assertEqual([x['id'] for x in checkpoint.get('chatter')['items']],
+                ['f2'])
+
+    def testFirstRunWatchingObjects(self):
+        self.sClient = WatchedSClient()
+        state = {}
+        self.postNewActivity(state=state)
+        # no chatterItemCounts yet: the server's page size
+        self.assertEqual(self.sClient.extraUrls,
+                {'chatter': 'chatter/feeds/company/feed-items'})
+        self.assertEqual(state['chatterItemCounts'], [])
+
+
+class TestCompanyChatterUrl(unittest.TestCase):
+
+    def testPageSize(self):
+        limits = {}
+        url = 'chatter/feeds/company/feed-items'
+        self.assertEqual(s2f.s2f.companyChatterUrl(limits, url, []), url)
+        self.assertEqual(s2f.s2f.companyChatterUrl(limits, url, [40]),
+                url + '?pageSize=51')
+        self.assertEqual(s2f.s2f.companyChatterUrl(limits,
+            url + '?updatedSince=x&pageSize=25', [40]),
+            url + '?updatedSince=x&pageSize=51')
+
+
+class HistorySClient(FakeSClient):
+
+    def getOpportunityHistoryChanges(self, maxTeamItems, minCreated,
+            excludeIds=(), filters=None):
+        return ([('new', None, op('b', '2015-03-10T12:00:05.000+0000'))],
+                ('2015-03-10T12:00:05Z', ['h1']))
+
+
+class FailingQueue(s2f.lanes.PostingQueue):
+
+    def add(self, key, message, priority=None, onDone=None):
+        raise RuntimeError('crash')
+
+
+class TestFieldHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.fileName = os.path.join(self.tmpDir.name, 'ops.sqlite')
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def getWatermark(self):
+        store = OpportunityStore(self.fileName)
+        try:
+            return store.getMeta('historyWatermark')
+        finally:
+            store.close()
+
+    def testWatermarkMovesOnceQueued(self):
+        store = OpportunityStore(self.fileName)
+        store.setMeta('historyWatermark', ['2015-03-10T12:00:00Z', []])
+        store.close()
+        sClient, fClient = HistorySClient(), FakeFClient()
+        limits = {'maxTeamOpportunities': 10}
+
+        with self.assertRaisesRegex(RuntimeError, 'crash'):
+            s2f.s2f.postOpportunityFieldHistory(sClient, fClient, limits,
+                    self.fileName, postingQueue=FailingQueue())
+        # the change isn't skipped next time
+        self.assertEqual(self.getWatermark(), ['2015-03-10T12:00:00Z', []])
+
+        s2f.s2f.postOpportunityFieldHistory(sClient, fClient, limits,
+                self.fileName)
+        self.assertEqual(fClient.posted, ['Op b — Ann'])
+        self.assertEqual(self.getWatermark(),
+                ['2015-03-10T12:00:05Z', ['h1']])
+
+
+class CaseSClient(FakeSClient):
+    """
+    Watches Cases: one new Case, then the next page fails if pageError.
+    """
+
+    def __init__(self, pageError=None):
+        super().__init__()
+        self.watchedObjects = {'Case': {'team': 'T',
+            'changedFields': {'StageName': 'Stage'}}}
+        self.pageError = pageError
+
+    def getWatchedChanges(self, getKnown, saveRecord, watermarks, maxItems,
+            extraUrls=None):
+        rec = dict(op('c', '2015-03-10T12:00:05.000+0000'), Title='Case c')
+        old = getKnown('Case', 'c')
+        saveRecord('Case', rec)
+        if self.pageError is not None:
+            raise self.pageError
+        return ([('Case', 'new', None, rec)] if old is None else []), {}
+
+
+class TestWatchedObjects(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        store = OpportunityStore(self.path('known-Case.sqlite'))
+        store.setMeta('watermark', WATERMARK)
+        store.close()
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpDir.name, name)
+
+    def post(self, sClient, fClient, postingQueue=None):
+        s2f.s2f.postWatchedObjectChanges(sClient, fClient,
+                {'maxTeamOpportunities': 10}, self.tmpDir.name,
+                postingQueue=postingQueue)
+
+    def testRecordsKnownOnceQueued(self):
+        fClient = FakeFClient()
+        with self.assertRaisesRegex(RuntimeError, 'next page'):
+            self.post(CaseSClient(RuntimeError('next page')), fClient)
+        with self.assertRaisesRegex(RuntimeError, 'crash'):
+            self.post(CaseSClient(), fClient, postingQueue=FailingQueue())
+        store = OpportunityStore(self.path('known-Case.sqlite'))
+        self.assertIs(store.get('c'), None)
+        self.assertEqual(store.getMeta('watermark'), WATERMARK)
+        store.close()
+
+        self.post(CaseSClient(), fClient)
+        self.assertEqual(fClient.posted, ['[Case] Case c — Ann'])
+        self.post(CaseSClient(), fClient)
+        self.assertEqual(fClient.posted, ['[Case] Case c — Ann'])
+
+
+class TestFormatting(unittest.TestCase):
+
+    def testChatterWithoutUnconfiguredFields(self):
+        detail = {'opportunity_name': 'Op', 'account_name': 'ACME',
+                'opportunity_owner': 'Ann', 'futu_team': 'T', 'amount': 1000,
+                'opportunity_id': 'o1', 'id': 'f1', 'text': 'Hi',
+                'modified_ts': 1425988800, 'actor_name': 'Bob',
+                'type': 'TextPost', 'preamble_text': 'Bob'}
+        txt = s2f.s2f.fmtOpChatterForTeamInbox(detail, 'UTC')['textContent']
+        self.assertIn('\nOwner: Ann, Account: ACME.\nAmount 1,000.', txt)
+        self.assertNotIn('None', txt)
+        self.assertNotIn('None', s2f.s2f.fmtForChat(detail))
@@ -1,7 +1,14 @@
+import io
+import json
+import os.path
+import tempfile
+import threading
+import time
 import unittest
+from urllib.parse import parse_qs, urlsplit
 
 from s2f.sforce import SClient
-from s2f import util
+from s2f import sforce, util
 
 
 util.setupLogging()
@@ -11,6 +18,24 @@ def getSClient():
     return SClient(util.SForceCfgFileName, util.SForceTokenFileName)
 
 
+def newSClient(testCase, **config):
+    """
+    Return an SClient for https://x/ from a temporary configuration.
+
+    config is added to the configuration file, see README.
+    """
+    tmpDir = tempfile.TemporaryDirectory()
+    testCase.addCleanup(tmpDir.cleanup)
+    cfgFileName = os.path.join(tmpDir.name, 'sforce-config.json')
+    tokenFileName = os.path.join(tmpDir.name, 'sforce-token.json')
+    with open(cfgFileName, 'w', encoding='utf-8') as f:
+        json.dump(dict({'client_id': 'c', 'client_secret': 's',
+            'redirect_uri': 'r', 'apiVersionUrl': '/'}, **config), f)
+    with open(tokenFileName, 'w', encoding='utf-8') as f:
+        json.dump({'access_token': 't', 'instance_url': 'https://x'}, f)
+    return SClient(cfgFileName, tokenFileName)
+
+
 class TestClient(unittest.TestCase):
 
     def test_getAPIVersions(self):
@@ -41,3 +66,661 @@ class TestClient(unittest.TestCase):
         self.assertTrue(len(client.getOpportunities()) >= 0)
         self.assertTrue(len(client.getOpportunities(
             minModified='2014-01-01T00:00:00.000+0000')) >= 0)
+
+
+class TestHelpers(unittest.TestCase):
+
+    def testSoqlDateTime(self):
+        self.assertEqual(sforce.soqlDateTime(86400.5), '1970-01-02T00:00:00Z')
+
+    def testSoqlString(self):
+        self.assertEqual(sforce.soqlString("a'b\\c"), "'a\\'b\\\\c'")
+
+    def testChooseChatterPageSize(self):
+        self.assertIs(sforce.chooseChatterPageSize([]), None)
+        self.assertEqual(sforce.chooseChatterPageSize([0, 1]), 10)
+        self.assertEqual(sforce.chooseChatterPageSize([3, 40]), 51)
+        self.assertEqual(sforce.chooseChatterPageSize([500]), 100)
+
+    def testBulkRecord(self):
+        row = {
+            'Id': '006x',
+            'Amount': '1500.0',
+            'IsWon': 'false',
+            'Description': '',
+            'LastModifiedDate': '2015-03-10T12:00:00.000Z',
+            'Account.Name': 'ACME',
+        }
+        fieldTypes = {
+            'Amount': 'currency',
+            'IsWon': 'boolean',
+            'Description': 'textarea',
+            'LastModifiedDate': 'datetime',
+        }
+        self.assertEqual(sforce._bulkRecord(row, fieldTypes), {
+            'Id': '006x',
+            'Amount': 1500.0,
+            'IsWon': False,
+            'Description': None,
+            'LastModifiedDate': '2015-03-10T12:00:00.000+0000',
+            'Account': {'Name': 'ACME'},
+        })
+
+    def testGetCompanyChatter(self):
+        client = newSClient(self)
+        client._getSession = lambda: None
+        def item(age):
+            return {'modifiedDate': time.strftime('%Y-%m-%dT%H:%M:%S.000+0000',
+                time.gmtime(time.time() - age))}
+        pages = {
+            'https://x/first': {'items': [item(10), item(20)],
+                'nextPageUrl': 'second', 'updatesUrl': 'updates'},
+            'https://x/second': {'items': [item(30), item(1000)],
+                'nextPageUrl': 'third', 'updatesUrl': None},
+            'https://x/third': {'items': [item(2000)],
+                'nextPageUrl': None, 'updatesUrl': None},
+        }
+        fetched = []
+        class Response():
+            def __init__(self, url):
+                self._url = url
+            def json(self):
+                return pages[self._url]
+        def get(session, url, params=None):
+            fetched.append(url)
+            return Response(url), session
+        client._get = get
+
+        # no more pages
+        items, updatesUrl = client.getCompanyChatter('first', maxSeconds=5000)
+        self.assertEqual((len(items), updatesUrl), (5, 'updates'))
+        self.assertEqual(fetched, ['https://x/first', 'https://x/second',
+            'https://x/third'])
+
+        # the item limit reached: the next page isn't prefetched
+        del fetched[:]
+        items, updatesUrl = client.getCompanyChatter('first', maxFeedItems=2)
+        self.assertEqual(len(items), 2)
+        self.assertEqual(fetched, ['https://x/first'])
+
+        # older items reached, presumably seen by an earlier run
+        del fetched[:]
+        recentItemCounts = []
+        items, updatesUrl = client.getCompanyChatter('first', maxSeconds=500,
+                hardLimit=True, recentItemCounts=recentItemCounts)
+        self.assertEqual(len(items), 3)
+        self.assertEqual(fetched, ['https://x/first', 'https://x/second'])
+        self.assertEqual(recentItemCounts, [3])
+
+    def testIterOpportunityChanges(self):
+        client = newSClient(self, opportunityChangedFields={
+            'StageName': 'Stage'})
+        def op(opId, team, stage, description='x'):
+            return {'Id': opId, 'FutuTeam': team, 'StageName': stage,
+                    'Description': description}
+        known = {
+            'a1': op('a1', 'A', 'Open'),
+            'a2': op('a2', 'A', 'Open'),
+            'b1': op('b1', 'B', 'Open'),
+        }
+        incoming = [
+            op('a1', 'A', 'Won'),
+            op('a2', 'A', 'Open', 'only the description'),
+            op('a3', 'A', 'Open'),
+            op('a4', 'A', 'Open'),
+            op('b1', 'B', 'Lost'),
+        ]
+        client.iterOpportunities = lambda **kwargs: iter(incoming)
+        saved = []
+        teamCounts = {'B': 0}
+        events = list(client.iterOpportunityChanges(known.get,
+            lambda op: saved.append(op['Id']), 2, teamCounts=teamCounts))
+        self.assertEqual([(kind, old and old['StageName'], new['Id'])
+            for kind, old, new in events], [
+                ('changed', 'Open', 'a1'),
+                ('new', None, 'a3'),
+                ('changed', 'Open', 'b1'),
+            ])
+        # all are saved, even those past the team's cap
+        self.assertEqual(saved, ['a1', 'a2', 'a3', 'a4', 'b1'])
+        self.assertEqual(teamCounts, {'A': 2, 'B': 1})
+
+    def testBulkQuery(self):
+        class Response():
+            def __init__(self, data=None, body=b'', headers=None):
+                self._data = data
+                self.raw = io.BytesIO(body)
+                self.headers = headers or {}
+            def json(self):
+                return self._data
+            def raise_for_status(self):
+                pass
+            def close(self):
+                pass
+
+        class Session():
+            def __init__(self, states, pages):
+                self.states = states
+                self.pages = pages
+                self.requests = []
+            def post(self, url, json=None):
+                self.requests.append(('POST', url, json['query']))
+                return Response({'id': 'J1'})
+            def patch(self, url, json=None):
+                self.requests.append(('PATCH', url, json))
+                return Response()
+            def get(self, url, params=None, stream=False):
+                self.requests.append(('GET', url, params))
+                if not url.endswith('/results'):
+                    return Response(self.states.pop(0))
+                body, locator = self.pages.pop(0)
+                return Response(body=body,
+                        headers={'Sforce-Locator': locator})
+
+        client = newSClient(self)
+        client.describe = lambda name: {'fields': [
+            {'name': 'Amount', 'type': 'currency'}]}
+        session = Session([{'state': 'InProgress'},
+            {'state': 'JobComplete', 'numberRecordsProcessed': 3}],
+            [(b'Id,Amount,Account.Name\r\n1,10.5,A\r\n2,,B\r\n', 'L1'),
+                (b'Id,Amount,Account.Name\r\n3,7,C\r\n', 'null')])
+        client._getOAuth2Client = lambda: session
+        records = list(client.bulkQuery('SELECT Id FROM Opportunity',
+            sobjectName='Opportunity', pollSeconds=0,
+            maxRecordsPerRequest=2))
+        self.assertEqual(records, [
+            {'Id': '1', 'Amount': 10.5, 'Account': {'Name': 'A'}},
+            {'Id': '2', 'Amount': None, 'Account': {'Name': 'B'}},
+            {'Id': '3', 'Amount': 7.0, 'Account': {'Name': 'C'}},
+        ])
+        self.assertEqual(session.requests, [
+            ('POST', 'https://x/jobs/query', 'SELECT Id FROM Opportunity'),
+            ('GET', 'https://x/jobs/query/J1', None),
+            ('GET', 'https://x/jobs/query/J1', None),
+            ('GET', 'https://x/jobs/query/J1/results', {'maxRecords': 2}),
+            ('GET', 'https://x/jobs/query/J1/results',
+                {'maxRecords': 2, 'locator': 'L1'}),
+        ])
+
+        client._getOAuth2Client = lambda: Session([{'state': 'Failed',
+            'errorMessage': 'INVALID_FIELD'}], [])
+        with self.assertRaisesRegex(RuntimeError, 'Failed: INVALID_FIELD'):
+            list(client.bulkQuery('SELECT Nope FROM Opportunity',
+                pollSeconds=0))
+
+        session = Session([{'state': 'InProgress'}], [])
+        client._getOAuth2Client = lambda: session
+        with self.assertRaisesRegex(TimeoutError, 'still InProgress'):
+            list(client.bulkQuery('SELECT Id FROM Opportunity',
+                pollSeconds=0, maxWaitSeconds=0))
+        self.assertEqual(session.requests[-1], ('PATCH',
+            'https://x/jobs/query/J1', {'state': 'Aborted'}))
+
+    def testOpportunityFilterSoql(self):
+        client = newSClient(self, opportunityFields={'Amount': 'Amount',
+            'OwnerName': 'Owner.Name', 'CloseDate': 'CloseDate'},
+            opportunityChangedFields={})
+        client.describe = lambda name: {'fields': [
+            {'name': 'Amount', 'type': 'currency'},
+            {'name': 'CloseDate', 'type': 'date'},
+            {'name': 'CreatedDate', 'type': 'datetime'}]}
+        self.assertIsNone(client.opportunityFilterSoql({}))
+        self.assertEqual(client.opportunityFilterSoql({
+            'B': {'OwnerName': {'in': ["O'Neil", 'Ann']}},
+            'A': {'Amount': {'min': 1000, 'max': 2.5e6}},
+            }, 'Parent.'),
+            "(Parent.Futu_Team__c != 'A' OR (Parent.Amount >= 1000 AND " +
+            "Parent.Amount <= 2500000.0)) AND " +
+            "(Parent.Futu_Team__c != 'B' OR " +
+            "(Parent.Owner.Name IN ('O\\'Neil','Ann')))")
+        with self.assertRaises(ValueError):
+            client.opportunityFilterSoql({'A': {'Nope': {'min': 1}}})
+        # dates aren't quoted
+        self.assertEqual(client.opportunityFilterSoql({'A': {
+            'CloseDate': {'min': '2015-01-01'},
+            'CreatedDate': {'min': '2015-01-01',
+                'max': '2015-06-30T12:00:00Z'}}}),
+            "(Futu_Team__c != 'A' OR (CloseDate >= 2015-01-01 AND " +
+            "CreatedDate >= 2015-01-01T00:00:00Z AND " +
+            "CreatedDate <= 2015-06-30T12:00:00Z))")
+        with self.assertRaisesRegex(ValueError, 'date'):
+            client.opportunityFilterSoql({'A': {
+                'CloseDate': {'min': "2015' OR Id != '"}}})
+        with self.assertRaisesRegex(ValueError, 'empty'):
+            client.opportunityFilterSoql({'A': {'OwnerName': {'in': []}}})
+
+    def testGetWatchedChanges(self):
+        client = newSClient(self, watchedObjects={
+            'Lead': {
+                'fields': {'Status': 'Status'},
+                'titleField': 'Nickname',
+                'changedFields': {'Status': 'Status'},
+            },
+        })
+        describeFields = ['Id', 'CreatedDate', 'CreatedBy', 'LastModifiedDate',
+                'LastModifiedBy', 'Status']
+        client.describe = lambda name: {'fields': [{'name': n,
+            'relationshipName': None} for n in describeFields]}
+        with self.assertRaises(ValueError):
+            client.getWatchedChanges(None, None, {}, 10)
+        describeFields.append('Nickname')
+        def record(recId, status):
+            return {'Id': recId, 'Status': status, 'Nickname': 'N' + recId,
+                    'LastModifiedDate': '2015-03-10T12:00:00.000+0000'}
+        def composite(urls):
+            self.assertEqual(list(urls), ['watched_Lead', 'chatter'])
+            return {
+                'watched_Lead': {'records': [record('1', 'Open'),
+                    record('2', 'Open')], 'nextRecordsUrl': 'next'},
+                'chatter': {'items': []},
+            }
+        client.composite = composite
+        client.getJson = lambda url: {'records': [record('3', 'New')]}
+
+        known = {'1': record('1', 'New'), '2': record('2', 'Open')}
+        saved = []
+        events, extras = client.getWatchedChanges(
+                lambda name, recId: known.get(recId),
+                lambda name, rec: saved.append(rec['Id']),
+                {'Lead': '2015-03-01T00:00:00Z'}, 10,
+                extraUrls={'chatter': 'chatter/feeds/company/feed-items'})
+        self.assertEqual([(n, k, new['Title']) for n, k, old, new in events],
+                [('Lead', 'changed', 'N1'), ('Lead', 'new', 'N3')])
+        self.assertEqual(saved, ['1', '2', '3'])
+        self.assertEqual(extras, {'chatter': {'items': []}})
+
+    def testGetFeedElementComments(self):
+        client = newSClient(self)
+        urls = []
+        def getJson(url):
+            urls.append(url)
+            return {'results': [
+                {'statusCode': 200, 'result': {'id': '0D5a', 'capabilities':
+                    {'comments': {'page': {'items': [
+                        {'createdDate': '2015-03-10T12:00:01.000+0000',
+                            'user': {'name': 'Bob'}, 'body': {'text': 'B'}},
+                        {'createdDate': '2015-03-10T12:00:00.000+0000',
+                            'user': {'name': 'Ann'}, 'body': {'text': 'A'}},
+                    ]}}}}},
+                {'statusCode': 404, 'result': [{'errorCode': 'NOT_FOUND'}]},
+            ]}
+        client.getJson = getJson
+        comments = client.getFeedElementComments(['0D5a', '0D5b', '0D5a'])
+        self.assertEqual(urls, ['chatter/feed-elements/batch/0D5a,0D5b'])
+        self.assertEqual([c['text'] for c in comments['0D5a']], ['A', 'B'])
+        self.assertNotIn('0D5b', comments)
+
+    def testGetOpportunityHistoryChanges(self):
+        client = newSClient(self, opportunityFields={
+            'StageName': 'StageName', 'OwnerName': 'Owner.Name'},
+            opportunityChangedFields={'StageName': 'Stage',
+                'OwnerName': 'Owner'})
+        def row(rowId, opId, field, old, new, second, dataType='Text'):
+            return {'Id': rowId, 'OpportunityId': opId, 'Field': field,
+                    'DataType': dataType, 'OldValue': old, 'NewValue': new,
+                    'CreatedDate': '2015-03-10T12:00:0{}.000+0000'.format(
+                        second), 'CreatedBy': {'Name': 'Ann'}}
+        queries = []
+        def iterRecords(url, params=None):
+            queries.append(params['q'])
+            return [
+                row('h1', 'o1', 'StageName', 'A', 'B', 1),
+                row('h2', 'o1', 'Owner', '005a', '005b', 1, 'EntityId'),
+                row('h3', 'o1', 'Owner', 'Bob', 'Eve', 1),
+                row('h4', 'o1', 'StageName', 'B', 'C', 2),
+                row('h5', 'o2', 'created', None, None, 3),
+                row('h6', 'o2', 'Description', 'x', 'y', 3),
+            ]
+        client.iterRecords = iterRecords
+        current = {
+            'o1': {'Id': 'o1', 'FutuTeam': 'T', 'StageName': 'C',
+                'OwnerName': 'Eve'},
+            'o2': {'Id': 'o2', 'FutuTeam': 'T', 'StageName': 'A',
+                'OwnerName': 'Eve'},
+        }
+        client.iterOpportunitiesById = lambda ids: [current[x] for x in ids]
+
+        events, nextArgs = client.getOpportunityHistoryChanges(10,
+                '2015-03-10T12:00:00Z', ['h0'])
+        self.assertIn("Id NOT IN ('h0')", queries[0])
+        self.assertEqual([(k, old and old['StageName'], new['StageName'],
+            new['OwnerName']) for k, old, new in events], [
+                ('changed', 'A', 'B', 'Eve'),
+                ('changed', 'B', 'C', 'Eve'),
+                ('new', None, 'A', 'Eve'),
+            ])
+        self.assertEqual(events[0][1]['OwnerName'], 'Bob')
+        self.assertEqual(events[0][2]['LastModifiedByName'], 'Ann')
+        self.assertEqual(nextArgs, ('2015-03-10T12:00:03Z', ['h5', 'h6']))
+        events, nextArgs = client.getOpportunityHistoryChanges(10,
+                '2015-03-10T12:00:03Z', ['h0'])
+        self.assertEqual(nextArgs, ('2015-03-10T12:00:03Z',
+            ['h0', 'h5', 'h6']))
+
+        events, nextArgs = client.getOpportunityHistoryChanges(1,
+                '2015-03-10T12:00:00Z')
+        self.assertEqual([k for k, old, new in events], ['new'])
+
+    def testHasOpportunityChanges(self):
+        client = newSClient(self, opportunityFields={},
+                opportunityChangedFields={})
+        watermark = '2015-03-10T12:00:00.000+0000'
+        def rec(opId, second):
+            return {'Id': opId,
+                    'LastModifiedDate': '2015-03-10T12:00:0{}.000+0000'
+                    .format(second)}
+        queries = []
+        records = []
+        def getJson(url, params=None):
+            queries.append(params['q'])
+            return {'records': records}
+        client.getJson = getJson
+
+        records[:] = [rec('a', 0)]
+        self.assertFalse(client.hasOpportunityChanges(watermark, ['a']))
+        self.assertIn('LastModifiedDate >= ' + watermark, queries[0])
+        self.assertTrue(queries[0].endswith(' LIMIT 2'))
+        # the one at the watermark modified again: the count stays the same
+        records[:] = [rec('a', 1)]
+        self.assertTrue(client.hasOpportunityChanges(watermark, ['a']))
+        # another one modified in the watermark's second
+        records[:] = [rec('b', 0), rec('a', 0)]
+        self.assertTrue(client.hasOpportunityChanges(watermark, ['a']))
+        # deleted
+        records[:] = []
+        self.assertFalse(client.hasOpportunityChanges(watermark, ['a']))
+
+    def testIterOpportunitiesFilters(self):
+        client = newSClient(self, bulkQueryThreshold=0,
+                opportunityFields={'Amount': 'Amount'},
+                opportunityChangedFields={})
+        client.describe = lambda name: {'fields': [
+            {'name': 'Amount', 'type': 'currency'}]}
+        client._validateOpportunityFields = lambda: None
+        queries = []
+        def getJson(url, params=None):
+            queries.append(params['q'])
+            return {'records': []}
+        client.getJson = getJson
+        filters = {'A': {'Amount': {'min': 1000}}}
+
+        list(client.iterOpportunities(minModified='2015-03-10T12:00:00Z',
+            filters=filters))
+        list(client.iterOpportunities(filters=filters))
+        self.assertIn("LastModifiedDate >= 2015-03-10T12:00:00Z AND " +
+                "(Futu_Team__c != 'A' OR (Amount >= 1000))", queries[0])
+        # a full load gets them all
+        self.assertNotIn('Amount >=', queries[1])
+
+        client.getJson = lambda url, params=None: [
+                {'errorCode': 'MALFORMED_QUERY'}]
+        with self.assertRaisesRegex(RuntimeError, 'MALFORMED_QUERY'):
+            list(client.iterOpportunities(minModified='2015-03-10T12:00:00Z',
+                filters=filters))
+
+    def testGetOpportunityFeedDetails(self):
+        client = newSClient(self, opportunityFields={},
+                opportunityChangedFields={})
+        client._validateOpportunityFields = lambda: None
+        def rec(itemId, second):
+            return {'Id': itemId, 'Type': 'TextPost', 'Body': itemId,
+                    'ParentId': 'o1', 'CreatedBy': {'Name': 'Ann'},
+                    'LastModifiedDate': '2015-03-10T12:00:0{}.000+0000'
+                    .format(second), 'Parent': {'Name': 'Op'}}
+        urls = []
+        def getJson(url):
+            urls.append(url)
+            if len(urls) == 1:
+                return {'records': [rec('f1', 1), rec('f2', 2)],
+                        'nextRecordsUrl': 'next'}
+            return {'records': [rec('f3', 2), rec('f4', 3)]}
+        client.getJson = getJson
+
+        details, updatesUrl = client.getOpportunityFeedDetails(
+                maxOpportunities=2, skipItem=lambda x: x['id'] == 'f1')
+        self.assertEqual(urls[1], 'next')
+        self.assertIn('ASC', parse_qs(urlsplit(urls[0]).query)['q'][0])
+        self.assertEqual([d['id'] for d in details], ['f2', 'f3'])
+        # f4 was not processed, so the next query starts after f3
+        q = parse_qs(urlsplit(updatesUrl).query)['q'][0]
+        self.assertIn("(LastModifiedDate > 2015-03-10T12:00:02Z OR " +
+                "(LastModifiedDate = 2015-03-10T12:00:02Z AND Id > 'f3'))", q)
+
+
+class TestDescribe(unittest.TestCase):
+
+    def testCacheAndRevalidate(self):
+        client = newSClient(self, describeMaxAge=60)
+        class Response():
+            def __init__(self, status, data=None):
+                self.status_code = status
+                self.headers = {'ETag': '"v1"'} if data else {}
+                self._data = data
+            def json(self):
+                return self._data
+            def raise_for_status(self):
+                pass
+        responses = [Response(200, {'fields': [{'name': 'Amount',
+            'relationshipName': None, 'type': 'currency', 'label': 'A'}]}),
+            Response(304)]
+        requests = []
+        class Session():
+            def get(self, url, headers=None):
+                requests.append((url, headers))
+                return responses.pop(0)
+        client._getSession = Session
+
+        expected = {'name': 'Opportunity', 'fields': [{'name': 'Amount',
+            'relationshipName': None, 'type': 'currency'}]}
+        self.assertEqual(client.describe('Opportunity'), expected)
+        self.assertEqual(requests, [
+            ('https://x/sobjects/Opportunity/describe', {})])
+        with open(client._describeCacheFileName, 'r',
+                encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['Opportunity']['etag'], '"v1"')
+        # within describeMaxAge, the cache is used as is
+        self.assertEqual(client.describe('Opportunity'), expected)
+        self.assertEqual(len(requests), 1)
+        # without reading the file again
+        os.remove(client._describeCacheFileName)
+        self.assertEqual(client.describe('Opportunity'), expected)
+        self.assertEqual(len(requests), 1)
+        # then it's revalidated, and unchanged
+        client._config['describeMaxAge'] = 0
+        self.assertEqual(client.describe('Opportunity'), expected)
+        self.assertEqual(requests[1][1], {'If-None-Match': '"v1"'})
+        with open(client._describeCacheFileName, 'r',
+                encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['Opportunity']['describe'],
+                    expected)
+
+    def testValidateAndProjectFields(self):
+        def describe(names):
+            return lambda sobjectName: {'fields': [{'name': n,
+                'relationshipName': n[:-2] if n.endswith('Id') else None,
+                'type': 'string'} for n in names]}
+        names = ['Id', 'Futu_Team__c', 'CreatedDate', 'CreatedById',
+                'LastModifiedDate', 'LastModifiedById', 'AccountId',
+                'OwnerId', 'Amount']
+        config = {'opportunityFields': {'Amount': 'Amount',
+            'AccountName': 'Account.Name'}, 'opportunityChangedFields': {}}
+
+        client = newSClient(self, **config)
+        client.describe = describe(names[:-1])
+        with self.assertRaisesRegex(ValueError, 'Amount'):
+            client.getOpportunity('o1')
+
+        client = newSClient(self, **config)
+        client.describe = describe(names)
+        opp = {'Id': 'o1', 'Name': 'Op', 'AccountId': 'a1', 'OwnerId': 'u1',
+                'Amount': 1000, 'Futu_Team__c': 'T'}
+        requests = []
+        def getJson(url, params=None):
+            requests.append(params)
+            return opp
+        client.getJson = getJson
+        self.assertEqual(client.getOpportunity('o1'), opp)
+        self.assertEqual(requests[0]['fields'], 'AccountId,OwnerId,Id,' +
+                'Futu_Team__c,CreatedDate,LastModifiedDate,Amount')
+
+        client.getOpportunitiesChatter = lambda **kwargs: ([{'id': 'f1',
+            'parent': {'id': 'o1', 'type': 'Opportunity'},
+            'modifiedDate': '2015-03-10T12:00:00.000+0000',
+            'actor': {'name': 'Ann'}, 'type': 'TextPost',
+            'preamble': {'text': 'Ann'}, 'body': {'text': 'Hi'}}], 'next')
+        client.getOpportunity = lambda opId: opp
+        client.getAccount = lambda accId: {'Name': 'ACME'}
+        client.getUser = lambda userId: {'Name': 'Ann'}
+        details, updatesUrl = client.getOpportunitiesChatterDetails()
+        self.assertEqual((details[0]['amount'], details[0]['futu_team']),
+                (1000, 'T'))
+        # not configured
+        self.assertNotIn('stage', details[0])
+        self.assertNotIn('close_date', details[0])
+
+
+class TestHedgedReads(unittest.TestCase):
+
+    def testNextPageAfterHedge(self):
+        client = newSClient(self, hedgeRequests={'minDelay': 0.05,
+            'deadline': 5, 'minSamples': 1, 'maxHedgeRatio': 1})
+        client._hedgePolicy.record(0.01)
+        pages = {
+            'https://x/first': {'records': [1], 'nextRecordsUrl': 'second'},
+            'https://x/second': {'records': [2]},
+        }
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slowUrls = {'https://x/first'}
+        class Response():
+            def __init__(self, url):
+                self._url = url
+            def raise_for_status(self):
+                pass
+            def json(self):
+                return pages[self._url]
+        class Session():
+            def __init__(self):
+                self.busy = False
+            def get(self, url, params=None, timeout=None):
+                if self.busy:
+                    raise RuntimeError('Session used concurrently')
+                self.busy = True
+                try:
+                    if url in slowUrls:
+                        # only the first attempt is slow
+                        slowUrls.remove(url)
+                        release.wait(timeout)
+                    return Response(url)
+                finally:
+                    self.busy = False
+            def close(self):
+                pass
+        client._getSession = Session
+
+        # the first attempt at the first page is still running while the
+        # second page is fetched
+        self.assertEqual(list(client.iterRecords('first')), [1, 2])
+        self.assertEqual(client.getHedgeStats(), (2, 1))
+
+    def testReuseSessionUnlessHedged(self):
+        client = newSClient(self, hedgeRequests={'minDelay': 0.05,
+            'deadline': 5, 'minSamples': 1, 'maxHedgeRatio': 1})
+        client._hedgePolicy.record(0.01)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        sessions = []
+        class Response():
+            def __init__(self, page):
+                self._page = page
+            def raise_for_status(self):
+                pass
+            def json(self):
+                return self._page
+        class Session():
+            def __init__(self):
+                self.gets = 0
+                self.closed = threading.Event()
+                sessions.append(self)
+            def get(self, url, params=None, timeout=None):
+                self.gets += 1
+                if url == 'https://x/slow' and len(sessions) == 1:
+                    release.wait(timeout)
+                return Response({'records': [url],
+                    'nextRecordsUrl': 'slow' if url.endswith('/a') else None})
+            def close(self):
+                self.closed.set()
+        client._getSession = Session
+
+        # one session for all the pages, until one of them is hedged
+        self.assertEqual(list(client.iterRecords('a')),
+                ['https://x/a', 'https://x/slow'])
+        self.assertEqual(len(sessions), 2)
+        self.assertEqual([s.gets for s in sessions], [2, 1])
+        # the first session is closed once its abandoned attempt is done
+        self.assertFalse(sessions[0].closed.is_set())
+        release.set()
+        self.assertTrue(sessions[0].closed.wait(5))
+        self.assertFalse(sessions[1].closed.is_set())
+
+
+class TestHedgePolicy(unittest.TestCase):
+
+    def testHedgesSlowCall(self):
+        policy = sforce.HedgePolicy(minDelay=0.05, deadline=5, minSamples=2,
+                maxHedgeRatio=1)
+        self.assertIsNone(policy.getDelay())
+        policy.record(0.01)
+        policy.record(0.02)
+        self.assertEqual(policy.getDelay(), 0.05)
+
+        release = threading.Event()
+        def slow(timeout):
+            release.wait(timeout)
+            return 'slow'
+        try:
+            self.assertEqual(policy.call(slow, lambda t: 'hedge'), 'hedge')
+        finally:
+            release.set()
+        self.assertEqual((policy.calls, policy.hedges), (1, 1))
+        self.assertEqual(policy.call(lambda t: 'fast'), 'fast')
+        self.assertEqual((policy.calls, policy.hedges), (2, 1))
+
+    def testLimits(self):
+        policy = sforce.HedgePolicy(minDelay=0.01, deadline=0.2,
+                minSamples=1, maxHedgeRatio=0)
+        policy.record(0.01)
+        release = threading.Event()
+        def slow(timeout):
+            release.wait(1)
+        try:
+            with self.assertRaises(TimeoutError):
+                policy.call(slow, lambda t: 'hedge')
+        finally:
+            release.set()
+        self.assertEqual(policy.hedges, 0)
+
+        def fail(timeout):
+            raise ValueError('fail')
+        with self.assertRaises(ValueError):
+            policy.call(fail)
+
+    def testMaxHedges(self):
+        policy = sforce.HedgePolicy(minDelay=0.01, deadline=5, minSamples=1,
+                maxHedgeRatio=1, maxHedges=1)
+        policy.record(0.01)
+        release = threading.Event()
+        def slow(timeout):
+            release.wait(timeout)
+            return 'slow'
+        def slowish(timeout):
+            time.sleep(0.05)
+            return 'first'
+        try:
+            self.assertEqual(policy.call(slow, lambda t: 'hedge'), 'hedge')
+            # the abandoned attempt still holds the only hedge slot
+            self.assertEqual(policy.call(slowish, lambda t: 'hedge'),
+                    'first')
+            self.assertEqual(policy.hedges, 1)
+        finally:
+            release.set()
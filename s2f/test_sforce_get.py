@@ -0,0 +1,53 @@
+import io
+import json
+import os.path
+import runpy
+import unittest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeClient():
+
+    def __init__(self, records):
+        self._records = records
+
+    def iterRecords(self, url, params=None):
+        for record in self._records[url if params is None else params['q']]:
+            if isinstance(record, Exception):
+                raise record
+            yield record
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.export = runpy.run_path(os.path.join(REPO_DIR, 'sforce-get.py'),
+                run_name='sforce_get')['export']
+
+    def testExport(self):
+        client = FakeClient({
+            'chatter/feeds/company/feed-items': [{'id': 'f1'}, {'id': 'f2'}],
+            'SELECT Id FROM Lead': [{'Id': str(i)} for i in range(2500)],
+        })
+        out = io.StringIO()
+        self.export(client, [('chatter/feeds/company/feed-items', None),
+            ('query/', {'q': 'SELECT Id FROM Lead'})], out, 2)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(records), 2502)
+        self.assertEqual([r['id'] for r in records if 'id' in r],
+                ['f1', 'f2'])
+        self.assertEqual([r['Id'] for r in records if 'Id' in r],
+                [str(i) for i in range(2500)])
+
+    def testError(self):
+        client = FakeClient({
+            'ok': [{'Id': '1'}],
+            'SELECT Nope FROM Lead': [ValueError('bad query')],
+        })
+        out = io.StringIO()
+        with self.assertRaises(ValueError):
+            self.export(client, [('ok', None),
+                ('query/', {'q': 'SELECT Nope FROM Lead'})], out, 2)
+        self.assertEqual(out.getvalue(), '{"Id": "1"}\n')
@@ -0,0 +1,143 @@
+import http.server
+import json
+import os.path
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from s2f.opstore import OpportunityStore
+
+
+# Modules which must only be imported on the code paths that use them.
+HEAVY_MODULES = ('requests_oauthlib', 'requests', 'oauthlib', 'urllib3',
+        'pytz', 'iso8601', 'urllib.request', 'argparse')
+
+# Of those, the ones SClient needs as soon as it makes a request.
+HTTP_MODULES = ('requests_oauthlib', 'requests', 'oauthlib', 'urllib3',
+        'urllib.request')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ('post-to-flowdock.py', 'sforce-get.py',
+        'sforce-show-api-versions.py', 'sforce-history.py')
+
+# Import time (microseconds) an entry point may add to a bare interpreter.
+# requests_oauthlib alone takes about 150 ms on a laptop, our own modules
+# about 40 ms.
+STARTUP_BUDGET_US = 120000
+
+
+def importedModules(code, env=None):
+    """
+    Run code in a fresh interpreter and return the set of modules imported.
+    """
+    output = subprocess.check_output([sys.executable, '-c', code +
+        '\nimport json, sys; print(json.dumps(sorted(sys.modules)))'],
+        cwd=REPO_DIR, env=env, universal_newlines=True)
+    return set(json.loads(output.splitlines()[-1]))
+
+
+def importTimes(code):
+    """
+    Run code in a fresh interpreter with -X importtime and return
+    {module name: microseconds spent importing it, without its imports}.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+            cwd=REPO_DIR, stderr=subprocess.PIPE, universal_newlines=True,
+            check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        selfUs, cumulativeUs, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(selfUs)
+    return times
+
+
+class TestStartup(unittest.TestCase):
+
+    def testPackageImportsLazily(self):
+        modules = importedModules('import s2f.s2f, s2f.sforce, s2f.flowdock')
+        for name in HEAVY_MODULES:
+            self.assertNotIn(name, modules)
+
+    def testEntryPointsImportLazily(self):
+        for script in ENTRY_POINTS:
+            code = ('import runpy; runpy.run_path({!r}, run_name="s2f_test")'
+                    ).format(script)
+            modules = importedModules(code)
+            for name in HEAVY_MODULES:
+                self.assertNotIn(name, modules, script)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs -X importtime')
+    def testEntryPointsStartupBudget(self):
+        bare = importTimes('pass')
+        for script in ENTRY_POINTS:
+            code = ('import runpy; runpy.run_path({!r}, run_name="s2f_test")'
+                    ).format(script)
+            # the best of a few runs, to leave out a busy machine
+            spent = min(sum(us for name, us in importTimes(code).items()
+                if name not in bare) for i in range(3))
+            self.assertLess(spent, STARTUP_BUDGET_US, script)
+
+    def testIdleRunImportsLazily(self):
+        """
+        A run with nothing to post only imports the HTTP modules.
+        """
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if '/chatter/' in self.path:
+                    body = {'items': [], 'nextPageUrl': None,
+                            'updatesUrl': self.path}
+                else:
+                    body = {'totalSize': 0, 'done': True, 'records': []}
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        tmpDir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpDir.cleanup)
+        files = {
+            'sforce-config.json': {'client_id': 'c', 'client_secret': 's',
+                'redirect_uri': 'r', 'apiVersionUrl': '/services/data/v32.0/'},
+            'sforce-token.json': {'access_token': 't', 'instance_url':
+                'http://127.0.0.1:{}'.format(server.server_address[1])},
+            'flowdock-config.json': {'teams': {}, 'teamInbox': {}},
+            'limits.json': {'maxSeconds': 3600, 'maxPages': 1,
+                'maxTeamOpportunities': 10},
+        }
+        for name, data in files.items():
+            with open(os.path.join(tmpDir.name, name), 'w',
+                    encoding='utf-8') as f:
+                json.dump(data, f)
+        opportunitiesFileName = os.path.join(tmpDir.name, 'known.sqlite')
+        store = OpportunityStore(opportunitiesFileName)
+        store.setMeta('watermark', '2015-01-01T00:00:00.000+0000')
+        store.close()
+
+        args = [os.path.join(tmpDir.name, name) for name in files]
+        args.append(opportunitiesFileName)
+        modules = importedModules('import s2f.s2f; ' +
+                's2f.s2f.postNewActivity(*{!r}, state={{}})'.format(args),
+                # the fake API is plain http
+                env=dict(os.environ, OAUTHLIB_INSECURE_TRANSPORT='1'))
+        for name in HEAVY_MODULES:
+            if name not in HTTP_MODULES:
+                self.assertNotIn(name, modules)
@@ -23,3 +23,32 @@ class TestUtil(unittest.TestCase):
         self.assertIs(util.getNested({'a': {'b': 8}}, 'a.b'), 8)
         self.assertIs(util.getNested({'a': {'': 7}}, 'a.'), 7)
         self.assertIs(util.getNested({'x': 'X'}, 'x', 'Y'), 'X')
+
+    def testParseTimestamp(self):
+        self.assertEqual(util.parseTimestamp('1970-01-01T00:01:00.000+0000'),
+                60)
+        self.assertEqual(util.parseTimestamp('1970-01-01T02:00:00.000+0200'),
+                0)
+        self.assertEqual(util.parseTimestamp('1970-01-01T00:00:01.500Z'),
+                1.5)
+
+    def testRecordMatches(self):
+        filters = {'T': {'Amount': {'min': 100, 'max': 200},
+            'StageName': {'in': ['Won', 'Lost']}}}
+        self.assertTrue(util.recordMatches(filters, 'T',
+            {'Amount': 100, 'StageName': 'Won'}))
+        self.assertFalse(util.recordMatches(filters, 'T',
+            {'Amount': 201, 'StageName': 'Won'}))
+        self.assertFalse(util.recordMatches(filters, 'T',
+            {'Amount': None, 'StageName': 'Won'}))
+        self.assertFalse(util.recordMatches(filters, 'T',
+            {'StageName': 'Open'}))
+        # unknown fields aren't checked yet, other teams get everything
+        self.assertTrue(util.recordMatches(filters, 'T', {'Amount': 150}))
+        self.assertTrue(util.recordMatches(filters, 'U', {'Amount': 1}))
+        self.assertTrue(util.recordMatches(None, 'T', {'Amount': 1}))
+        # values of another type don't pass
+        self.assertFalse(util.recordMatches(filters, 'T',
+            {'Amount': '150', 'StageName': 'Won'}))
+        self.assertFalse(util.recordMatches({'T': {'CloseDate': {'max':
+            '2015-01-31'}}}, 'T', {'CloseDate': 20150101}))
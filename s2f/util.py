@@ -2,12 +2,19 @@
 Helpers for this package.
 """
 
+import datetime
+import json
 import logging
 import time
 
 
 SForceCfgFileName = 'config/sforce-config.json'
 SForceTokenFileName = 'config/sforce-token.json'
+HistoryArchiveFileName = 'config/history.sqlite'
+
+# Longest message (in characters) written to the log by s2f.logqueue. Longer
+# ones, e.g. whole Flowdock payloads or opportunities, are cut.
+MAX_MESSAGE_LENGTH = 2000
 
 
 def setupLogging():
@@ -54,3 +61,99 @@ def getNested(dictObj, dotPath, default=None):
             return default
         return get(obj[nextField], fieldsArr, default)
     return get(dictObj, dotPath.split('.'), default)
+
+
+def parseTimestamp(isoStr):
+    """
+    Return the POSIX timestamp (float) for a SalesForce ISO 8601 date string.
+
+    SalesForce always sends e.g. '2015-03-10T12:34:56.000+0000', which the
+    standard library parses quickly. Anything else falls back to iso8601,
+    which is only imported if needed to keep startup fast.
+    """
+    try:
+        return datetime.datetime.strptime(isoStr,
+                '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+    except (TypeError, ValueError):
+        import iso8601
+        return iso8601.parse_date(isoStr).timestamp()
+
+
+def eventMatches(rule, teamName, event):
+    """
+    Return True if a rule's conditions match a message's team and event.
+
+    Used for the fan-out and priority rules. All the conditions present must
+    match: ‘teams’, ‘types’, ‘sobjects’, ‘changedFields’ (any of them
+    changed) and ‘values’ (of the event's record). A rule with conditions
+    on the event never matches a message without one.
+    """
+    if 'teams' in rule and teamName not in rule['teams']:
+        return False
+    if not {'types', 'sobjects', 'changedFields', 'values'} & set(rule):
+        return True
+    if event is None:
+        return False
+    if 'types' in rule and event.get('type') not in rule['types']:
+        return False
+    if 'sobjects' in rule and event.get('sobject') not in rule['sobjects']:
+        return False
+    if 'changedFields' in rule and not (set(rule['changedFields']) &
+            set(event.get('changedFields', ()))):
+        return False
+    record = event.get('record') or {}
+    for k, v in rule.get('values', {}).items():
+        if record.get(k) != v:
+            return False
+    return True
+
+
+def recordMatches(filters, teamName, record):
+    """
+    Return True if an opportunity passes the filter rules of its team.
+
+    filters is the ‘teamFilters’ limit: {team: {field name: condition}}.
+    A condition has any of ‘in’ (a list of values), ‘min’ and ‘max’
+    (inclusive); None, or a value which can't be compared to them (e.g. a
+    string to a number), never passes them. Teams without rules get
+    everything. Fields not in record aren't checked, so a partial record can
+    be filtered before fetching the rest.
+    """
+    for name, cond in (filters or {}).get(teamName, {}).items():
+        if name not in record:
+            continue
+        value = record[name]
+        if 'in' in cond and value not in cond['in']:
+            return False
+        try:
+            if 'min' in cond and (value is None or value < cond['min']):
+                return False
+            if 'max' in cond and (value is None or value > cond['max']):
+                return False
+        except TypeError:
+            return False
+    return True
+
+
+def truncate(text, maxLength=MAX_MESSAGE_LENGTH):
+    """
+    Return text, or its start and how much was cut if it's too long.
+    """
+    if len(text) <= maxLength:
+        return text
+    return '{}… ({} more characters)'.format(text[:maxLength],
+            len(text) - maxLength)
+
+
+class LazyJson():
+    """
+    Log argument which is serialized to JSON only if the record is written.
+
+    E.g. getLogger().info('Posting %s', LazyJson(payload))
+    """
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __str__(self):
+        return json.dumps(self._obj)
@@ -1,23 +1,119 @@
 #! /usr/bin/env python3
 
-import argparse
 import json
+import sys
+import time
 from s2f.sforce import SClient
 from s2f import util
 
 
 def parseArgs():
-    p = argparse.ArgumentParser(description='Print JSON from SalesForce URL')
-    p.add_argument('url', help='''SalesForce URL to GET JSON from.
+    import argparse
+    p = argparse.ArgumentParser(description='''Print JSON from SalesForce URL,
+            or export the records from many URLs and queries as NDJSON''')
+    p.add_argument('url', nargs='*', help='''SalesForce URL to GET JSON from.
             If relative, it's interpreted as relative to the API root.
             You can start the exploration by passing an empty string ''
-            for this argument.
+            for this argument. With --export, any number of URLs.
             ''')
-    return p.parse_args()
+    p.add_argument('--export', action='store_true', help='''Follow the
+            nextRecordsUrl/nextPageUrl of each URL and query and write every
+            record (or chatter item) as one JSON line. Progress goes to
+            stderr.''')
+    p.add_argument('-q', '--soql', action='append', default=[],
+            help='''SOQL query to export; may be repeated.
+            Implies --export.''')
+    p.add_argument('-o', '--output', help='''File to write the NDJSON to,
+            instead of stdout.''')
+    p.add_argument('-j', '--jobs', type=int, default=4, help='''How many URLs
+            and queries to fetch concurrently (default: %(default)s).''')
+    args = p.parse_args()
+    if args.soql:
+        args.export = True
+    if not args.export and len(args.url) != 1:
+        p.error('exactly one url is needed without --export')
+    if args.export and not (args.url or args.soql):
+        p.error('nothing to export')
+    return args
+
+
+def export(client, sources, out, jobs):
+    """
+    Write the records of all sources to out as NDJSON, fetching concurrently.
+
+    sources are (url, params) pairs. Records are handed to this thread over
+    a bounded queue, so they are never all in memory.
+    """
+    import concurrent.futures
+    import queue
+    import threading
+
+    lines = queue.Queue(maxsize=1000)
+    done = object()
+    stopped = threading.Event()
+
+    def put(line):
+        # give up if the writer stopped, instead of blocking on a full queue
+        while not stopped.is_set():
+            try:
+                lines.put(line, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def fetch(url, params):
+        try:
+            for record in client.iterRecords(url, params=params):
+                if stopped.is_set():
+                    break
+                put(json.dumps(record))
+        finally:
+            put(done)
+
+    start = lastReport = time.time()
+    count = nBytes = 0
+
+    def report(final=False):
+        elapsed = max(time.time() - start, 1e-6)
+        print('\r{:,} records, {:,} KiB, {:.0f} records/s'.format(count,
+            nBytes // 1024, count / elapsed), end='\n' if final else '',
+            file=sys.stderr, flush=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(fetch, url, params)
+                for url, params in sources]
+        pending = len(futures)
+        try:
+            while pending:
+                line = lines.get()
+                if line is done:
+                    pending -= 1
+                    continue
+                out.write(line + '\n')
+                count += 1
+                nBytes += len(line) + 1
+                if time.time() - lastReport >= 1:
+                    lastReport = time.time()
+                    report()
+        finally:
+            stopped.set()
+        report(final=True)
+        # raise the first error, if any
+        for f in futures:
+            f.result()
 
 
 if __name__ == '__main__':
     args = parseArgs()
     util.setupLogging()
     client = SClient(util.SForceCfgFileName, util.SForceTokenFileName)
-    print(json.dumps(client.getJson(args.url), indent=2))
+    if not args.export:
+        print(json.dumps(client.getJson(args.url[0]), indent=2))
+    else:
+        sources = [(url, None) for url in args.url]
+        sources.extend(('query/', {'q': q}) for q in args.soql)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                export(client, sources, f, args.jobs)
+        else:
+            export(client, sources, sys.stdout, args.jobs)
@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+
+"""
+Query the local archive of posted changes and chatter, without API calls.
+"""
+
+import datetime
+import json
+import os.path
+import sys
+
+from s2f import util
+
+
+def parseArgs():
+    import argparse
+    p = argparse.ArgumentParser(description='''Print the changes and chatter
+            items found by post-to-flowdock.py, from its local archive.''')
+    p.add_argument('-f', '--file', default=util.HistoryArchiveFileName,
+            help='''The archive (default: %(default)s).''')
+    p.add_argument('-i', '--id', help='''Only this opportunity (or other
+            record) Id.''')
+    p.add_argument('-t', '--team', help='''Only this team.''')
+    p.add_argument('-k', '--kind', choices=('new', 'changed', 'chatter'),
+            help='''Only this kind of event.''')
+    p.add_argument('--since', type=parseTime, help='''Only events at or
+            after this UTC time, e.g. 2015-03-01 or 2015-03-01T12:00.''')
+    p.add_argument('--until', type=parseTime, help='''Only events before
+            this UTC time.''')
+    p.add_argument('-n', '--limit', type=int, help='''At most this many
+            events, oldest first.''')
+    p.add_argument('-j', '--json', action='store_true', help='''Print each
+            event as one JSON line, with all its data.''')
+    return p.parse_args()
+
+
+def parseTime(text):
+    """
+    Return the POSIX timestamp for a UTC date or date and time.
+    """
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            dt = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+    raise ValueError('Unknown time format: ' + text)
+
+
+def fmtEvent(event):
+    """
+    Return a one-line summary of an archived event.
+    """
+    data = event['data']
+    if event['kind'] == 'chatter':
+        what = data.get('text') or data.get('preamble_text') or ''
+    else:
+        what = data['new'].get('Name') or ''
+    ts = datetime.datetime.utcfromtimestamp(event['ts'])
+    return '{} {:7} {} {} {} ({}) {}'.format(ts.strftime('%Y-%m-%d %H:%M:%S'),
+            event['kind'], event['sobject'], event['recordId'],
+            event['team'], event['actor'],
+            util.truncate(what.replace('\n', ' '), 80))
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    if not os.path.exists(args.file):
+        sys.exit('No archive ' + args.file)
+    from s2f.archive import HistoryArchive
+    archive = HistoryArchive(args.file)
+    events = archive.query(recordId=args.id, team=args.team,
+            since=args.since, until=args.until, kind=args.kind,
+            limit=args.limit)
+    for event in events:
+        if args.json:
+            print(json.dumps(event))
+        else:
+            print(fmtEvent(event))
+    archive.close()